@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import math
+import socket
+import sys
+import threading
+
+from paho.mqtt import client as mqtt_client
+from utils import Job
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+class AsyncScheduler:
+    """Scheduler with the same interface as utils.Scheduler, running the jobs on an asyncio event loop.
+
+    Jobs run as callbacks on the loop, jobs marked as blocking (e.g. HTTP polling) are awaited in a thread via
+    asyncio.to_thread. They must not change state shared with the loop, but pass their results to callSoon(). Jobs
+    may be scheduled from any thread.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.clock = loop.time
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def every(
+        self,
+        interval: float,
+        function,
+        *args,
+        kwargs: dict | None = None,
+        fixed_rate: bool = True,
+        name: str | None = None,
+        blocking: bool = False,
+    ) -> Job:
+        job = Job(function, args, kwargs or {}, interval, repeat=True, fixed_rate=fixed_rate, name=name)
+        job.blocking = blocking
+        self._schedule(job, self.clock() + interval)
+        return job
+
+    def after(
+        self,
+        delay: float,
+        function,
+        *args,
+        kwargs: dict | None = None,
+        name: str | None = None,
+        blocking: bool = False,
+    ) -> Job:
+        job = Job(function, args, kwargs or {}, delay, repeat=False, fixed_rate=False, name=name)
+        job.blocking = blocking
+        self._schedule(job, self.clock() + delay)
+        return job
+
+    def callSoon(self, function, *args):
+        """Runs function on the event loop, e.g. to apply the result of a blocking job from its thread"""
+        if self.onLoop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def stats(self) -> list:
+        with self._lock:
+            return [job.stats() for job in self.jobs if job.repeat]
+
+    def stop(self):
+        self._stopped = True
+
+    def _schedule(self, job: Job, deadline: float):
+        with self._lock:
+            if job not in self.jobs:
+                self.jobs.append(job)
+        job.deadline = deadline
+        if self.onLoop():
+            self.loop.call_at(deadline, self._fire, job)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.call_at, deadline, self._fire, job)
+
+    def _unschedule(self, job: Job):
+        with self._lock:
+            job in self.jobs and self.jobs.remove(job)
+
+    def onLoop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _fire(self, job: Job):
+        if job.cancelled or self._stopped:
+            self._unschedule(job)
+            return
+
+        if job.repeat and job.fixed_rate:
+            deadline = job.deadline + job.interval
+            now = self.clock()
+            if deadline <= now:
+                missed = math.ceil((now - deadline) / job.interval)
+                job.skipped += missed
+                deadline += missed * job.interval
+            self._schedule(job, deadline)
+
+        if job.running:
+            job.skipped += 1
+            return
+        job.running = True
+        if job.blocking:
+            self.loop.create_task(self._runBlocking(job))
+        else:
+            start = self.clock()
+            self._call(job, job.function)
+            self._done(job, start)
+
+    async def _runBlocking(self, job: Job):
+        start = self.clock()
+        await asyncio.to_thread(self._call, job, job.function)
+        self._done(job, start)
+
+    def _call(self, job: Job, function):
+        try:
+            function(*job.args, **job.kwargs)
+        except Exception:
+            job.errors += 1
+            log.exception(f"Scheduled job {job.name} failed")
+
+    def _done(self, job: Job, start: float):
+        end = self.clock()
+        job.record(end - start)
+        job.running = False
+        if not job.repeat or job.cancelled:
+            self._unschedule(job)
+        elif not job.fixed_rate:
+            self._schedule(job, end + job.interval)
+
+
+class AsyncRuntime:
+    """Runs the MQTT client, the scheduled jobs and the control cycles on one asyncio event loop.
+
+    The paho client's socket is driven by the loop's reader/writer callbacks instead of paho's network thread. Control
+    cycles run on the loop as well, so they never overlap with each other or with the processing of MQTT messages.
+    """
+
+    MISC_INTERVAL = 1
+    RECONNECT_DELAY = 5
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.scheduler = AsyncScheduler(loop)
+        self.client = None
+        self.workers = {}
+        self.misc = None
+        self.stopped = asyncio.Event()
+
+    def attach(self, client: mqtt_client.Client):
+        self.client = client
+        client.on_socket_open = self.onSocketOpen
+        client.on_socket_close = self.onSocketClose
+        client.on_socket_register_write = self.onSocketRegisterWrite
+        client.on_socket_unregister_write = self.onSocketUnregisterWrite
+
+    def onSocketOpen(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
+        self.misc = self.loop.create_task(self.miscLoop())
+
+    def onSocketClose(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.misc and self.misc.cancel()
+        self.stopped.is_set() or self.loop.call_later(self.RECONNECT_DELAY, self.reconnect)
+
+    def reconnect(self):
+        try:
+            self.client.reconnect()
+        except OSError as e:
+            log.error(f"Reconnecting to MQTT broker failed: {e}, retrying in {self.RECONNECT_DELAY}s")
+            self.loop.call_later(self.RECONNECT_DELAY, self.reconnect)
+
+    def onSocketRegisterWrite(self, client, userdata, sock):
+        # messages may also be published from threads (e.g. blocking jobs)
+        if self.scheduler.onLoop():
+            self.loop.add_writer(sock, client.loop_write)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def onSocketUnregisterWrite(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def miscLoop(self):
+        # keepalive pings and retries, which paho's network thread would do otherwise
+        while self.client.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    async def run(self):
+        """Serve until stop() is called"""
+        await self.stopped.wait()
+        self.scheduler.stop()
+        self.client and self.client.disconnect()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def drive(self, worker):
+        """Run the cycles of an inline ControlWorker on the loop"""
+        self.workers[worker] = None
+        worker.on_trigger = lambda: self.loop.call_soon_threadsafe(self.arm, worker)
+
+    def arm(self, worker):
+        handle = self.workers.get(worker)
+        handle and handle.cancel()
+        due = worker.nextDue()
+        if due is not None:
+            self.workers[worker] = self.loop.call_later(max(due - worker.clock(), 0), self.runWorker, worker)
+
+    def runWorker(self, worker):
+        self.workers[worker] = None
+        worker.runDue()
+        # triggers may have arrived during the cycle or it wasn't due yet
+        self.arm(worker)
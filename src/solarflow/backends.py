@@ -0,0 +1,32 @@
+import importlib
+import logging
+import sys
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+Registry of the device backends selectable by dtu_type and smartmeter_type. A backend is resolved by importing only
+the module it lives in, so backends which aren't configured (and what they depend on) don't add to the startup time.
+"""
+
+BACKENDS = {
+    "dtu": {
+        "OpenDTU": "dtus",
+        "AhoyDTU": "dtus",
+    },
+    "smartmeter": {
+        "Smartmeter": "smartmeters",
+        "Poweropti": "smartmeters",
+        "ShellyEM3": "smartmeters",
+        "VZLogger": "smartmeters",
+    },
+}
+
+
+def resolve(kind: str, name: str) -> type:
+    module = BACKENDS[kind].get(name)
+    if module is None:
+        raise ValueError(f"Unknown {kind} type {name}, use one of: {', '.join(BACKENDS[kind])}")
+    return getattr(importlib.import_module(module), name)
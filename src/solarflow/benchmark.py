@@ -0,0 +1,426 @@
+import asyncio
+import getopt
+import importlib
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from astral import LocationInfo
+from paho.mqtt.client import MQTTMessage
+import dtus
+import metrics
+import recorder
+import smartmeters
+import solarflow
+from router import TopicRouter
+from utils import Scheduler, TimewindowBuffer, getScheduler, setScheduler
+from aioruntime import AsyncRuntime
+from worker import ControlWorker
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+"""
+Micro-benchmarks for the hot paths of solarflow-control: the TimewindowBuffer at various fill levels, the message
+handlers of each component, message dispatch, a full limitHomeInput cycle and the memory per site. They run without
+a broker, results are printed as one line per case so they can be compared across commits:
+
+    python3 benchmark.py [-n <samples>] [-r <recording>] [-i <seconds>]
+
+Messages are handled with a stub client and scheduler, no messages leave the process. Dispatch is measured on the
+messages of a recording (see recorder.py, made with "solarflow-control.py --record"), by default on
+bench/topicmix.rec next to the package directory: 5 minutes of a hub, an OpenDTU and a smartmeter around noon, recorded
+from the simulated plant (simulator.py), not from a real setup. The components have the topics of the example
+config.ini, messages of a recording of another setup reach no handler. The broadcast to all handlers is the dispatch
+before the topic router, which is measured as configured by default and with the metrics enabled, which count every
+message and time a sample of them.
+With -i the idle CPU time and memory of the threads and the asyncio runtime are compared, each one running the
+components (with their periodic jobs) and a control worker in a separate process for the given time.
+"""
+
+
+# repetitions of the dispatch cases
+REPEAT = 5
+
+
+class SteppingClock:
+    """Monotonic clock that advances by a fixed step on every sample, to simulate a given sample rate"""
+
+    def __init__(self, rate: float):
+        self.step = 1 / rate
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def tick(self):
+        self.now += self.step
+
+
+def bench_buffer(samples: int):
+    for rate in (1, 10, 50, 200):
+        clock = SteppingClock(rate)
+        buffer = TimewindowBuffer(minutes=1, clock=clock)
+        # filling the window from empty, including the growth of the ring buffer
+        fill = rate * 60
+        start = time.perf_counter()
+        for i in range(fill):
+            clock.tick()
+            buffer.add(i % 500)
+        elapsed = time.perf_counter() - start
+        log.info(
+            f"TimewindowBuffer.add @ {rate:>3} Hz, filling 0-{fill:>5} samples:   {fill / elapsed:>10.0f} samples/s, {elapsed / fill * 1e6:>6.2f} us/sample"
+        )
+
+        # steady state, with the window full samples enter and expire
+        start = time.perf_counter()
+        for i in range(samples):
+            clock.tick()
+            buffer.add(i % 500)
+        elapsed = time.perf_counter() - start
+        log.info(
+            f"TimewindowBuffer.add @ {rate:>3} Hz, full at {buffer._next - buffer._head:>5} samples: {samples / elapsed:>10.0f} samples/s, {elapsed / samples * 1e6:>6.2f} us/sample"
+        )
+
+
+class StubClient:
+    """Stands in for the paho client, published messages are only counted"""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+class StubScheduler:
+    """Keeps scheduled jobs from running (and from starting the scheduler thread) during benchmarks"""
+
+    def every(self, interval, function, *args, **kwargs):
+        pass
+
+    def after(self, delay, function, *args, **kwargs):
+        pass
+
+
+def no_trigger(client, force=False):
+    return False
+
+
+def message(topic: str, payload) -> MQTTMessage:
+    msg = MQTTMessage(topic=topic.encode())
+    if isinstance(payload, bytes):
+        msg.payload = payload
+    else:
+        msg.payload = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+    return msg
+
+
+def hub_report(hub, packs: int) -> MQTTMessage:
+    """A full properties/report of the hub with the given number of battery packs"""
+    report = {
+        "properties": {
+            "electricLevel": 54,
+            "solarInputPower": 312,
+            "outputPackPower": 120,
+            "packInputPower": 0,
+            "outputHomePower": 190,
+            "outputLimit": 190,
+            "inverseMaxPower": 800,
+            "pass": 0,
+            "passMode": 1,
+            "socSet": 1000,
+            "minSoc": 100,
+        },
+        "packData": [{"sn": f"CO4HLMEBD{i + 1:06d}", "socLevel": 55 + i, "totalVol": 4980 + i} for i in range(packs)],
+    }
+    return message(f"/{hub.productId}/{hub.deviceId}/properties/report", report)
+
+
+def topic_mix(hub, dtu, smt) -> list:
+    """A topic mix as seen by a typical setup in one interval: a smartmeter reader, an OpenDTU with 4 channels
+    and a hub with a battery pack"""
+    msgs = [hub_report(hub, packs=1)]
+    for _ in range(5):
+        msgs.append(message(smt.base_topic, {"Power": {"Power_curr": 230, "Total_in": 12345.6}}))
+    msgs += [message(f"{dtu.base_topic}/{ch}/power", "95.3") for ch in range(5)]
+    msgs += [
+        message(f"{dtu.base_topic}/0/powerdc", "98.7"),
+        message(f"{dtu.base_topic}/0/efficiency", "95.4"),
+        message(f"{dtu.base_topic}/status/producing", "1"),
+        message(f"{dtu.base_topic}/status/reachable", "1"),
+        message(f"{dtu.base_topic}/status/limit_absolute", "400"),
+        message(f"{dtu.base_topic}/status/limit_relative", "50"),
+    ]
+    return msgs
+
+
+def components(client: StubClient, scheduler=None, index: int = 0, site=None):
+    """The devices of a site, wired to site (a control module Site) or to a bare holder of their peers"""
+    setScheduler(scheduler or StubScheduler())
+    # the devices of further sites get topics of their own
+    suffix = f"-{index}" if index else ""
+    hub = solarflow.Solarflow(
+        client=client, product_id="73bkTV", device_id=f"5ak8yGU7{suffix}", full_charge_interval=32, callback=no_trigger
+    )
+    dtu = dtus.OpenDTU(
+        client=client,
+        base_topic=f"solar{suffix}",
+        inverter_serial="116491132532",
+        sf_inverter_channels=[3],
+        callback=no_trigger,
+    )
+    smt = smartmeters.Smartmeter(client=client, base_topic=f"tele/E220{suffix}/SENSOR", callback=no_trigger)
+    site = site or SimpleNamespace(name="")
+    site.deviceId = hub.deviceId
+    site.hub, site.dtu, site.smartmeter = hub, dtu, smt
+    hub.site = dtu.site = smt.site = site
+    return hub, dtu, smt
+
+
+def ahoy_mix(dtu) -> list:
+    """The topics of an AhoyDTU with a 4 channel inverter"""
+    name = f"{dtu.base_topic}/{dtu.inverter_name}"
+    msgs = [message(f"{name}/ch{ch}/P_DC", "95.3") for ch in range(5)]
+    msgs += [
+        message(f"{name}/ch0/P_AC", "360.2"),
+        message(f"{name}/ch0/Efficiency", "95.4"),
+        message(f"{name}/ch0/active_PowerLimit", "50"),
+        message(f"{dtu.base_topic}/status", "1"),
+    ]
+    return msgs
+
+
+def measure(name: str, handler, msgs: list, rounds: int):
+    logging.disable(logging.WARNING)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for msg in msgs:
+            handler(msg)
+    elapsed = time.perf_counter() - start
+    logging.disable(logging.NOTSET)
+    log.info(
+        f"{name:<45}: {rounds * len(msgs) / elapsed:>10.0f} msgs/s, {elapsed / rounds / len(msgs) * 1e6:>7.2f} us/msg"
+    )
+
+
+def bench_handlers(rounds: int):
+    client = StubClient()
+    hub, dtu, smt = components(client)
+    ahoy = dtus.AhoyDTU(
+        client=client,
+        base_topic="ahoy",
+        inverter_name="HM-1500",
+        inverter_id="0",
+        inverter_max_power=1500,
+        sf_inverter_channels=[3],
+        callback=no_trigger,
+    )
+
+    # alternating readings, so the trigger checks see changes
+    scalar = [message(smt.base_topic, str(power)) for power in (230, 260, 245, 300)]
+    nested = [message(smt.base_topic, {"Power": {"Power_curr": power, "Total_in": 12345.6}}) for power in (230, 260)]
+    opendtu = [msg for msg in topic_mix(hub, dtu, smt) if msg.topic.startswith(dtu.base_topic)]
+
+    measure("Smartmeter.handleMsg (scalar payload)", smt.handleMsg, scalar, rounds)
+    measure("Smartmeter.handleMsg (JSON payload, deep_get)", smt.handleMsg, nested, rounds)
+    measure("OpenDTU.handleMsg", dtu.handleMsg, opendtu, rounds)
+    measure("AhoyDTU.handleMsg", ahoy.handleMsg, ahoy_mix(ahoy), rounds)
+    for packs in (1, 4):
+        measure(f"Solarflow.handleMsg (full report, {packs} packs)", hub.handleMsg, [hub_report(hub, packs)], rounds)
+
+
+def bench_cycle(rounds: int):
+    # imported here, the control module reads config.ini from the working directory on import
+    sfc = importlib.import_module("solarflow-control")
+
+    client = StubClient()
+    site = sfc.Site(sfc.config)
+    site.client = client
+    site.router = TopicRouter()
+    hub, dtu, smt = components(client, site=site)
+    logging.disable(logging.WARNING)
+    sfc.updateConfigParams(site)
+    site.location = LocationInfo(timezone="Europe/Berlin", latitude=48.1, longitude=11.6)
+    for msg in topic_mix(hub, dtu, smt):
+        hub.handleMsg(msg)
+        dtu.handleMsg(msg)
+        smt.handleMsg(msg)
+
+    sfc.limitHomeInput(site)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        sfc.limitHomeInput(site)
+    elapsed = time.perf_counter() - start
+    logging.disable(logging.NOTSET)
+    log.info(f"limitHomeInput cycle: {rounds / elapsed:>10.0f} cycles/s, {elapsed / rounds * 1e3:>7.3f} ms/cycle")
+
+
+def bench_dispatch(rounds: int, recording: str):
+    client = StubClient()
+    hub, dtu, smt = components(client)
+    msgs = [message(topic, payload) for _, topic, payload in recorder.readRecording(recording)]
+    if not msgs:
+        log.error(f"No messages found in {recording}, skipping the dispatch benchmark")
+        return
+    router = TopicRouter()
+    router.add(f"solarflow-hub/{hub.deviceId}/control/#", lambda msg, metric: None)
+    hub.subscribe(router)
+    dtu.subscribe(router)
+    smt.subscribe(router)
+    unhandled = sum(not router.resolve(msg.topic)[0] for msg in msgs)
+    log.info(
+        f"Dispatch: {len(msgs)} messages of {os.path.basename(recording)}, {len(set(msg.topic for msg in msgs))} topics"
+        f"{f', {unhandled} messages reach no handler' if unhandled else ''}"
+    )
+
+    def broadcast(msg):
+        smt.handleMsg(msg)
+        hub.handleMsg(msg)
+        dtu.handleMsg(msg)
+
+    logging.disable(logging.WARNING)
+    cases = [
+        ("broadcast to all handlers", broadcast, False),
+        ("topic router", router.dispatch, False),
+        ("topic router, metrics enabled", router.dispatch, True),
+    ]
+    # the cases take turns and the best of the repetitions is reported, so a busy machine affects them alike
+    best = {}
+    for _ in range(REPEAT):
+        for name, deliver, enabled in cases:
+            metrics.enabled = enabled
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for msg in msgs:
+                    deliver(msg)
+            best[name] = min(best.get(name, float("inf")), time.perf_counter() - start)
+    metrics.enabled = False
+    logging.disable(logging.NOTSET)
+    for name, elapsed in best.items():
+        log.info(f"Dispatch ({name}): {rounds * len(msgs) / elapsed:>10.0f} msgs/s")
+
+
+def bench_sites(count: int):
+    """Memory allocated per site (its components with filled buffers, routes, control worker and decision log) when
+    running count sites in one process, compared to the RSS of a process for one site"""
+    sfc = importlib.import_module("solarflow-control")
+    client = StubClient()
+    router = TopicRouter()
+    logging.disable(logging.WARNING)
+    sites = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for index in range(count):
+        site = sfc.Site(sfc.config, f"site{index}")
+        site.client = client
+        site.router = router
+        hub, dtu, smt = components(client, index=index, site=site)
+        hub.subscribe(router)
+        dtu.subscribe(router)
+        smt.subscribe(router)
+        site.control = ControlWorker(sfc.limitHomeInput, site, inline=True)
+        for msg in topic_mix(hub, dtu, smt) * 60:
+            router.dispatch(msg)
+        sites.append(site)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    logging.disable(logging.NOTSET)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    log.info(f"Sites: {count} sites, {allocated / count / 1024:>8.1f} KB per site, process max RSS {rss:.1f} MB")
+
+
+def idle(runtime: str, seconds: float):
+    """Run the components without any messages, report the CPU time after startup and the RSS of this process"""
+
+    def serve():
+        client = StubClient()
+        hub, dtu, smt = components(client, scheduler=getScheduler())
+        control = ControlWorker(no_trigger, client, inline=runtime == "asyncio")
+        return client, control
+
+    if runtime == "asyncio":
+
+        async def serveAsync() -> float:
+            aio = AsyncRuntime(asyncio.get_running_loop())
+            setScheduler(aio.scheduler)
+            client, control = serve()
+            aio.drive(control)
+            start = time.process_time()
+            await asyncio.sleep(seconds)
+            aio.scheduler.stop()
+            return time.process_time() - start
+
+        cpu = asyncio.run(serveAsync())
+    else:
+        setScheduler(Scheduler())
+        serve()
+        start = time.process_time()
+        time.sleep(seconds)
+        cpu = time.process_time() - start
+        getScheduler().stop()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{runtime} {cpu:.3f} {rss:.1f}")
+
+
+def bench_idle(seconds: float):
+    for runtime in ("threads", "asyncio"):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--idle-run", f"{runtime}:{seconds}"],
+            capture_output=True,
+            text=True,
+        ).stdout
+        _, cpu, rss = out.strip().splitlines()[-1].split()
+        log.info(
+            f"Idle {runtime:>8} runtime: {float(cpu) / seconds * 100:>6.3f}% CPU ({float(cpu):.3f}s in {seconds:.0f}s), {float(rss):>6.1f} MB max RSS"
+        )
+
+
+def main(argv):
+    samples = 100000
+    idle_seconds = None
+    recording = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench", "topicmix.rec")
+    opts, args = getopt.getopt(argv, "hn:r:i:", ["samples=", "recording=", "idle=", "idle-run="])
+    for opt, arg in opts:
+        if opt == "-h":
+            log.info("benchmark.py -n <samples> -r <recording> -i <idle seconds>")
+            sys.exit()
+        elif opt in ("-n", "--samples"):
+            samples = int(arg)
+        elif opt in ("-r", "--recording"):
+            recording = os.path.abspath(arg)
+        elif opt in ("-i", "--idle"):
+            idle_seconds = float(arg)
+        elif opt == "--idle-run":
+            # child process of bench_idle
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+            logging.disable(logging.WARNING)
+            runtime, seconds = arg.split(":")
+            idle(runtime, float(seconds))
+            sys.exit()
+
+    # the components expect to find their Homeassistant templates relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if idle_seconds:
+        bench_idle(idle_seconds)
+        return
+    bench_buffer(samples)
+    bench_handlers(max(samples // 100, 100))
+    bench_dispatch(max(samples // 5000, 10), recording)
+    bench_cycle(max(samples // 1000, 100))
+    bench_sites(10)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import sys
+import threading
+
+import clock
+from utils import getScheduler
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+Warm restarts: the state which takes long to rebuild after a restart (the day's SoC statistics of the hub, the
+inverter's detected capacity, the smoothing filters, the control parameters) is written to a local file periodically
+and restored on startup.
+
+The file is JSON: {"version": 1, "ts": <epoch>, "sections": {"<name>": {...}}}. Every component registers a section
+with a function returning its state and one restoring it, which gets the state and its age in seconds, so it can
+decide what is still valid. Checkpoints are written to a temporary file which is synced and renamed over the previous
+one, so a crash leaves either the old or the new checkpoint. Checkpoints of another version are ignored.
+"""
+
+VERSION = 1
+
+
+class Checkpointer:
+    def __init__(self, path: str, interval: float = 60):
+        self.path = path
+        self.interval = interval
+        self.sections = {}
+        self.state = {}
+        self.age = None
+        self.restored = set()
+        self.lock = None
+        self.saves = 0
+
+    def load(self) -> bool:
+        """Reads the last checkpoint, its sections are restored as the components register"""
+        try:
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            log.info(f"No checkpoint found at {self.path}, starting cold")
+            return False
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read checkpoint {self.path}: {e}, starting cold")
+            return False
+
+        if checkpoint.get("version") != VERSION:
+            log.warning(f"Ignoring checkpoint {self.path} of version {checkpoint.get('version')}, expecting {VERSION}")
+            return False
+        self.state = checkpoint.get("sections", {})
+        self.age = max(clock.time() - checkpoint.get("ts", 0), 0)
+        log.info(f"Loaded checkpoint {self.path} from {self.age:.0f}s ago: {', '.join(self.state)}")
+        return True
+
+    def register(self, name: str, save, restore):
+        """Adds a section, it is restored right away if the loaded checkpoint has it"""
+        self.sections[name] = save
+        state = self.state.pop(name, None)
+        if state is None:
+            return
+        try:
+            restore(state, self.age)
+            self.restored.add(name)
+        except Exception:
+            log.exception(f"Restoring {name} from checkpoint failed")
+
+    def start(self, lock=None):
+        """Saves a checkpoint every interval seconds, collecting the state while holding lock (e.g. the lock under
+        which the components are updated)"""
+        self.lock = lock
+        getScheduler().every(self.interval, self.save, name="checkpoint", blocking=True)
+
+    def save(self):
+        with self.lock or threading.Lock():
+            sections = {name: save() for name, save in self.sections.items()}
+        data = json.dumps(
+            {"version": VERSION, "ts": round(clock.time(), 3), "sections": sections}, separators=(",", ":")
+        )
+
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning(f"Writing checkpoint {self.path} failed: {e}")
+            return
+        self.saves += 1
+        log.debug(f"Saved checkpoint {self.path} ({len(data)} bytes)")
@@ -0,0 +1,73 @@
+import logging
+import sys
+import time as _time
+from datetime import datetime
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+class RealClock:
+    """The system clock"""
+
+    def monotonic(self) -> float:
+        return _time.monotonic()
+
+    def time(self) -> float:
+        return _time.time()
+
+    def now(self, tz=None) -> datetime:
+        return datetime.now(tz)
+
+
+class SimulatedClock:
+    """A clock that only moves when it is told to, e.g. by a replay or a simulation.
+
+    monotonic() and time() return the same (epoch) seconds, so both move in lockstep.
+    """
+
+    def __init__(self, start: float = 0.0):
+        self.t = start
+
+    def monotonic(self) -> float:
+        return self.t
+
+    def time(self) -> float:
+        return self.t
+
+    def now(self, tz=None) -> datetime:
+        return datetime.fromtimestamp(self.t, tz)
+
+    def set(self, t: float):
+        # never go back in time, monotonic() must stay monotonic
+        self.t = max(self.t, t)
+
+    def advance(self, seconds: float):
+        self.t += seconds
+
+
+_clock = RealClock()
+
+
+def getClock():
+    return _clock
+
+
+def setClock(clock):
+    global _clock
+    _clock = clock
+
+
+# module level accessors, reading the clock that is current at call time. They can be passed wherever a clock
+# function is expected (e.g. clock=clock.monotonic)
+def monotonic() -> float:
+    return _clock.monotonic()
+
+
+def time() -> float:
+    return _clock.time()
+
+
+def now(tz=None) -> datetime:
+    return _clock.now(tz)
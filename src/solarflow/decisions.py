@@ -0,0 +1,95 @@
+import json
+import logging
+import sys
+from collections import deque
+from enum import IntEnum
+
+import clock
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+Decision log: every control cycle is kept as a compact record (its inputs, the path of decisions as codes and the
+resulting limits) in a fixed size ring, so the decisions of the last hours can be inspected after the fact, without
+running at debug level. The ring is exported as JSON lines, with the codes by name, e.g. on request through the
+solarflow-hub/<device>/control/dumpDecisions topic.
+"""
+
+
+class Decision(IntEnum):
+    NOT_READY = 1  # not all devices have reported yet, no limits set
+
+    # limitHomeInput: how demand is split between direct panels and hub
+    DIRECT_COVERS = 10  # direct panels cover the demand, hub off
+    DIRECT_NEAR_LIMIT = 11  # direct panels are close to the channel limit, raising it to get more from them
+    ASK_TOO_SMALL = 12  # less than 5W asked from the hub, limits unchanged
+    AC_LIMIT = 13  # hub contribution reduced to stay within the AC limit
+    INVERTER_LIMITS = 14  # hub fully open, the inverter limits its contribution (more precise)
+    HUB_LIMITS = 15  # hub limits its contribution
+    NO_DIRECT = 16  # direct panels not producing, everything from the hub
+
+    # getSFPowerLimit: what the hub could contribute
+    BYPASS = 20
+    BYPASS_LEAVE = 21  # leaving bypass after sunset
+    BYPASS_KEEP = 22
+    HUB = 23  # hub not in bypass
+    SURPLUS = 24  # enough power to cover demand and minimum charge power
+    SURPLUS_CAPPED = 25  # solar power minus minimum charge power limits the contribution
+    DEFICIT = 26  # not enough solar power to cover demand and minimum charge power
+    DISCHARGE_NIGHT = 27
+    DISCHARGE_SUNRISE = 28  # enough battery after sunrise to continue discharge
+    NO_DISCHARGE = 29  # during the day
+    NO_DEMAND = 30
+
+
+# the notation of the hub's decision path in the logs
+STEPS = {
+    Decision.BYPASS: "0.",
+    Decision.BYPASS_LEAVE: "1.",
+    Decision.BYPASS_KEEP: "2.",
+    Decision.HUB: "1.",
+    Decision.SURPLUS: "1. (enough power to cover demand and minimum charge power)",
+    Decision.SURPLUS_CAPPED: "2.",
+    Decision.DEFICIT: "3.",
+    Decision.DISCHARGE_NIGHT: "1. (not enough power to cover demand and minimum charge power during night/dusk/dawn)",
+    Decision.DISCHARGE_SUNRISE: "2. (enough battery after sunrise to continue discharge)",
+    Decision.NO_DISCHARGE: "3. (not enough power to cover demand and minimum charge power during day)",
+}
+
+INPUTS = ("grid", "direct", "hub", "demand", "solar", "soc", "bypass", "hub_limit", "inverter_limit")
+OUTPUTS = ("ask", "contribution", "hub_limit", "direct_limit", "inverter_limit")
+
+
+def pathString(path: list) -> str:
+    return "".join(STEPS.get(code, "") for code in path)
+
+
+class DecisionLog:
+    """Ring of the last size control cycles, each a tuple of (epoch, inputs, decision codes, outputs)"""
+
+    def __init__(self, size: int = 2880):
+        self.records = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.records)
+
+    def record(self, inputs: tuple, path: list, outputs: tuple):
+        self.records.append((clock.time(), inputs, tuple(path), outputs))
+
+    def dump(self, since: float = None) -> str:
+        """The records since the epoch since (all if None) as JSON lines"""
+        lines = []
+        for ts, inputs, path, outputs in list(self.records):
+            if since is not None and ts < since:
+                continue
+            entry = {"ts": round(ts, 3), "path": [Decision(code).name for code in path]}
+            inputs and entry.update(zip(INPUTS, map(_round, inputs)))
+            outputs and entry.update({f"new_{name}": _round(value) for name, value in zip(OUTPUTS, outputs)})
+            lines.append(json.dumps(entry, separators=(",", ":")))
+        return "\n".join(lines)
+
+
+def _round(value):
+    return round(value, 1) if isinstance(value, float) else value
@@ -0,0 +1,68 @@
+import hashlib
+import logging
+import pathlib
+import sys
+import threading
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+class DiscoveryPublisher:
+    """Publishes the Homeassistant MQTT discovery documents rendered from the templates in homeassistant/.
+
+    Templates are compiled once. A document is only rendered again if its inputs (device, firmware version, battery)
+    changed and only published if the rendered content differs from what has been published before.
+    """
+
+    # templates that are rendered once per battery pack
+    PACK_TEMPLATES = ("maxTemp", "totalVol", "soh")
+
+    def __init__(self, client, path: str = "homeassistant/"):
+        # jinja2 is imported with the first publisher, not at startup
+        from jinja2 import DebugUndefined, Environment, FileSystemLoader
+
+        self.client = client
+        environment = Environment(loader=FileSystemLoader(path), undefined=DebugUndefined)
+        self.templates = []
+        for hatemplate in sorted(pathlib.Path(path).glob("*.json")):
+            cfg_type, cfg_name = hatemplate.name.split(".")[:2]
+            self.templates.append((cfg_type, cfg_name, environment.get_template(hatemplate.name)))
+        # topic => (render inputs, content hash) of the published documents
+        self.published = {}
+        self.lock = threading.Lock()
+        log.info(f"Loaded {len(self.templates)} Homeassistant templates.")
+
+    def documents(self, product_id: str, device_id: str, fw_version: str, batteries: list):
+        for cfg_type, cfg_name, template in self.templates:
+            if cfg_name in self.PACK_TEMPLATES:
+                for index, serial in enumerate(batteries):
+                    if serial != "none":
+                        topic = f"homeassistant/{cfg_type}/solarflow-hub-{device_id}-{serial}-{cfg_name}/config"
+                        inputs = dict(
+                            product_id=product_id,
+                            device_id=device_id,
+                            fw_version=fw_version,
+                            battery_serial=serial,
+                            battery_index=index + 1,
+                        )
+                        yield topic, template, inputs
+            else:
+                topic = f"homeassistant/{cfg_type}/solarflow-hub-{device_id}-{cfg_name}/config"
+                yield topic, template, dict(product_id=product_id, device_id=device_id, fw_version=fw_version)
+
+    def publish(self, product_id: str, device_id: str, fw_version: str, batteries: list) -> int:
+        published = 0
+        with self.lock:
+            for topic, template, inputs in self.documents(product_id, device_id, fw_version, batteries):
+                previous = self.published.get(topic)
+                if previous and previous[0] == inputs:
+                    continue
+                hacfg = template.render(**inputs)
+                digest = hashlib.sha1(hacfg.encode()).hexdigest()
+                if previous is None or previous[1] != digest:
+                    self.client.publish(topic, hacfg, retain=True)
+                    published += 1
+                self.published[topic] = (inputs, digest)
+        return published
@@ -3,7 +3,12 @@ from functools import reduce
 from datetime import datetime
 import logging
 import sys
-from utils import TimewindowBuffer
+import clock
+import logs
+import tracing
+from utils import CommandTracker, TimewindowBuffer
+from filters import createFilter
+from snapshot import DTUSnapshot
 
 yellow = "\x1b[33;20m"
 reset = "\x1b[0m"
@@ -16,9 +21,11 @@ TRIGGER_DIFF = 30
 
 
 class DTU:
-    opts = {"base_topic": str, "sf_inverter_channels": list}
+    opts = {"base_topic": str, "sf_inverter_channels": list, "ac_power_filter": str}
     limit_topic = ""
     limit_unit = ""
+    # the site (hub, smartmeter) the inverter belongs to, set when the site is started
+    site = None
 
     def default_calllback(self):
         log.info("default callback")
@@ -29,11 +36,12 @@ class DTU:
         base_topic: str,
         sf_inverter_channels: [] = [],
         ac_limit: int = 800,
+        ac_power_filter: str = None,
         callback=default_calllback,
     ):
         self.client = client
         self.base_topic = base_topic
-        self.acPower = TimewindowBuffer(minutes=1)
+        self.acPower = createFilter(ac_power_filter)
         self.acLimit = ac_limit
         self.dcPower = TimewindowBuffer(minutes=1)
         self.channelsDCPower = []
@@ -51,7 +59,8 @@ class DTU:
         self.last_trigger_value = 0
         self.efficiency = 95.0
         self.acUpdateTS = datetime.min
-        self.lastLimitTimestamp = datetime.min
+        # a new limit is usually reported back by the DTU with its next status update
+        self.commands = CommandTracker(type(self).__name__, self.resendLimit, timeout=20, retries=2, tolerance=5)
 
     def __str__(self):
         chPower = "|".join([f"{v:>3.1f}" for v in self.channelsDCPower][1:])
@@ -62,11 +71,13 @@ class DTU:
                         L:{self.limitAbsolute:>3.0f}W ({self.getChannelLimit():.1f}W/channel) [{self.maxPower:>3.0f}W]{reset}".split()
         )
 
-    def subscribe(self, topics):
-        topics.append(f"solarflow-hub/+/control/dryRun")
+    def subscribe(self, topics, router=None):
+        control = f"solarflow-hub/{self.site.deviceId}/control/dryRun"
+        topics.append(control)
         for t in topics:
             self.client.subscribe(t)
             log.info(f"DTU subscribing: {t}")
+            router and router.add(t, self.handleControl if t == control else self.handleMetric)
 
     def ready(self):
         return len(self.channelsDCPower) > 0
@@ -77,7 +88,7 @@ class DTU:
             self.channelsDCPower.append(value)
         if len(self.channelsDCPower) > channel:
             if channel == 0:
-                self.acUpdateTS = datetime.now()
+                self.acUpdateTS = clock.now()
                 self.acPower.add(value)
             self.channelsDCPower[channel] = value
 
@@ -85,7 +96,7 @@ class DTU:
 
         if abs(previous - self.getCurrentACPower()) >= TRIGGER_DIFF:
             log.info(
-                f"DTU triggers limit function: {previous} -> {self.getCurrentACPower()}: {'executed' if self.trigger_callback(self.client) else 'skipped'}"
+                f"DTU triggers limit function: {previous} -> {self.getCurrentACPower()}: {'queued' if self.trigger_callback(self.client) else 'skipped'}"
             )
             self.last_trigger_value = self.getCurrentACPower()
 
@@ -98,6 +109,7 @@ class DTU:
 
     def updLimitAbsolute(self, value: float):
         self.limitAbsolute = value
+        self.commands.confirm("limit", value)
 
     def updLimitRelative(self, value: float):
         self.limitRelative = value
@@ -123,16 +135,48 @@ class DTU:
         self.reachable = bool(value)
 
     def handleMsg(self, msg):
+        if msg.topic.startswith(self.base_topic) and msg.payload:
+            self.handleMetric(msg)
         if msg.topic.startswith(f"solarflow-hub") and msg.topic and msg.payload:
-            metric = msg.topic.split("/")[-1]
-            value = msg.payload.decode()
-            match metric:
-                case "dryRun":
-                    self.setDryRun(value)
+            self.handleControl(msg)
+
+    def handleMetric(self, msg, metric: str = None):
+        pass
+
+    def handleControl(self, msg, metric: str = None):
+        if not msg.payload:
+            return
+        metric = metric or msg.topic.split("/")[-1]
+        value = msg.payload.decode()
+        match metric:
+            case "dryRun":
+                self.setDryRun(value)
 
     def getLimit(self):
         return self.limitAbsolute
 
+    def checkpoint(self) -> dict:
+        return {"maxPower": self.maxPower, "maxPowerValues": self.maxPowerValues, "acPower": self.acPower.checkpoint()}
+
+    def restore(self, state: dict, age: float):
+        # the inverter's capacity doesn't change, it takes several limit updates to detect it again
+        self.maxPower = state["maxPower"]
+        self.maxPowerValues = state["maxPowerValues"]
+        self.maxPower > 0 and log.info(f"Restored inverter's max capacity: {self.maxPower}")
+        self.acPower.restore(state["acPower"], age)
+
+    def snapshot(self, text: bool = True) -> DTUSnapshot:
+        return DTUSnapshot(
+            text=str(self) if text else "",
+            ready=self.ready(),
+            channelsDCPower=tuple(self.channelsDCPower),
+            sf_inverter_channels=tuple(self.sf_inverter_channels),
+            efficiency=self.efficiency,
+            limitAbsolute=self.limitAbsolute,
+            acLimit=self.acLimit,
+            currentACPower=self.getCurrentACPower(),
+        )
+
     def getEfficiency(self):
         return self.efficiency
 
@@ -217,12 +261,15 @@ class DTU:
             return int((self.acLimit / self.getNrProducingChannels()) * self.getNrTotalChannels())
 
     def hasPendingUpdate(self) -> bool:
-        log.info(
-            f"Pending Update: {self.lastLimitTimestamp > self.acUpdateTS} - Last limit update: {self.lastLimitTimestamp}, AC update: {self.acUpdateTS}"
-        )
-        return self.lastLimitTimestamp > self.acUpdateTS
+        pending = self.commands.isBlocking("limit")
+        log.info(f"Pending Update: {pending} - {self.commands}")
+        return pending
+
+    def resendLimit(self, key: str, limit: int):
+        (not self.dryrun) and self.client.publish(self.limit_nonpersistent_absolute, f"{limit}{self.limit_unit}")
 
     def setLimit(self, limit: int):
+        tracing.requested(self.commands.name, "limit")
         # failsafe, never set the inverter limit to 0, keep a minimum
         # see: https://github.com/lumapu/ahoy/issues/1079
         limit = 10 if limit < 10 else int(limit)
@@ -247,8 +294,7 @@ class DTU:
 
         # acceptable overage on AC power, keep limit where it is
         if self.getCurrentACPower() > self.acLimit and self.isWithin(self.getCurrentACPower(), self.acLimit, 20):
-            smt = self.client._userdata["smartmeter"]
-            # hub = self.client._userdata['hub']
+            smt = self.site.smartmeter
             smt_power = smt.getPower() - smt.zero_offset
             if smt_power > 0:
                 inv_limit = self.limitAbsolute
@@ -279,10 +325,10 @@ class DTU:
 
         # if self.limitAbsolute != inv_limit and self.reachable:
         if not self.isWithin(inv_limit, self.limitAbsolute, withinRange) and self.reachable:
-            self.lastLimitTimestamp = datetime.now()
-            (not self.dryrun) and self.client.publish(
-                self.limit_nonpersistent_absolute, f"{inv_limit}{self.limit_unit}"
-            )
+            if not self.dryrun:
+                # limits above the inverter's capacity are sent, but it reports its capacity as limit
+                self.commands.sent("limit", inv_limit, min(inv_limit, self.maxPower) if self.maxPower > 0 else None)
+                self.client.publish(self.limit_nonpersistent_absolute, f"{inv_limit}{self.limit_unit}")
             # log.info(f'Setting inverter output limit to {inv_limit} W ({limit} x 1 / ({len(self.sf_inverter_channels)}/{len(self.channelsDCPower)-1})')
             log.info(
                 f"{'[DRYRUN] ' if self.dryrun else ''}Setting inverter output limit to {inv_limit}W (1 min moving average of {limit}W x {len(self.channelsDCPower) - 1})"
@@ -291,13 +337,15 @@ class DTU:
             not self.reachable and log.info(
                 f"{'[DRYRUN] ' if self.dryrun else ''}Inverter is not reachable/down. Can't set limit"
             )
-            self.reachable and log.info(f"Not setting inverter output limit as it is identical to current limit!")
+            self.reachable and not logs.SUMMARY and log.info(
+                f"Not setting inverter output limit as it is identical to current limit!"
+            )
 
         return inv_limit
 
 
 class OpenDTU(DTU):
-    opts = {"base_topic": str, "inverter_serial": str, "sf_inverter_channels": list}
+    opts = {"base_topic": str, "inverter_serial": str, "sf_inverter_channels": list, "ac_power_filter": str}
     limit_topic = "cmd/limit_nonpersistent_absolute"
     limit_unit = ""
 
@@ -308,6 +356,7 @@ class OpenDTU(DTU):
         inverter_serial: str,
         sf_inverter_channels: [] = [],
         ac_limit: int = 800,
+        ac_power_filter: str = None,
         callback=DTU.default_calllback,
     ):
         super().__init__(
@@ -315,6 +364,7 @@ class OpenDTU(DTU):
             base_topic=base_topic,
             sf_inverter_channels=sf_inverter_channels,
             ac_limit=ac_limit,
+            ac_power_filter=ac_power_filter,
             callback=callback,
         )
         self.base_topic = f"{base_topic}/{inverter_serial}"
@@ -323,7 +373,7 @@ class OpenDTU(DTU):
             f"Using {type(self).__name__}: Base topic: {self.base_topic}, Limit topic: {self.limit_nonpersistent_absolute}, SF Channels: {self.sf_inverter_channels}, AC Limit: {self.acLimit}"
         )
 
-    def subscribe(self):
+    def subscribe(self, router=None):
         topics = [
             f"{self.base_topic}/0/powerdc",
             f"{self.base_topic}/0/efficiency",
@@ -333,33 +383,32 @@ class OpenDTU(DTU):
             f"{self.base_topic}/status/limit_absolute",
             f"{self.base_topic}/status/limit_relative",
         ]
-        super().subscribe(topics)
-
-    def handleMsg(self, msg):
-        if msg.topic.startswith(self.base_topic) and msg.payload:
-            metric = msg.topic.split("/")[-1]
-            value = float(msg.payload.decode())
-            log.debug(f"DTU received {metric}:{value}")
-            match metric:
-                case "powerdc":
-                    self.updTotalPowerDC(value)
-                case "efficiency":
-                    self.updEfficiency(value)
-                case "limit_absolute":
-                    self.updLimitAbsolute(value)
-                case "limit_relative":
-                    self.updLimitRelative(value)
-                case "producing":
-                    self.updProducing(value)
-                case "reachable":
-                    self.updReachable(value)
-                case "power":
-                    channel = int(msg.topic.split("/")[-2])
-                    self.updChannelPowerDC(channel, value)
-                case _:
-                    log.warning(f"Ignoring inverter metric: {metric}")
-
-        super().handleMsg(msg)
+        super().subscribe(topics, router)
+
+    def handleMetric(self, msg, metric: str = None):
+        if not msg.payload:
+            return
+        metric = metric or msg.topic.split("/")[-1]
+        value = float(msg.payload.decode())
+        log.debug(f"DTU received {metric}:{value}")
+        match metric:
+            case "powerdc":
+                self.updTotalPowerDC(value)
+            case "efficiency":
+                self.updEfficiency(value)
+            case "limit_absolute":
+                self.updLimitAbsolute(value)
+            case "limit_relative":
+                self.updLimitRelative(value)
+            case "producing":
+                self.updProducing(value)
+            case "reachable":
+                self.updReachable(value)
+            case "power":
+                channel = int(msg.topic.split("/")[-2])
+                self.updChannelPowerDC(channel, value)
+            case _:
+                log.warning(f"Ignoring inverter metric: {metric}")
 
 
 class AhoyDTU(DTU):
@@ -369,6 +418,7 @@ class AhoyDTU(DTU):
         "inverter_name": str,
         "inverter_max_power": int,
         "sf_inverter_channels": list,
+        "ac_power_filter": str,
     }
     limit_topic = "ctrl/limit"
     limit_unit = "W"
@@ -382,6 +432,7 @@ class AhoyDTU(DTU):
         inverter_max_power: int,
         sf_inverter_channels: [] = [],
         ac_limit: int = 800,
+        ac_power_filter: str = None,
         callback=DTU.default_calllback,
     ):
         super().__init__(
@@ -389,17 +440,20 @@ class AhoyDTU(DTU):
             base_topic=base_topic,
             sf_inverter_channels=sf_inverter_channels,
             ac_limit=ac_limit,
+            ac_power_filter=ac_power_filter,
             callback=callback,
         )
         self.base_topic = f"{base_topic}"
         self.inverter_name = inverter_name
         self.inverter_max_power = self.maxPower = inverter_max_power
+        # the limit is reported in percent of the max power, so it is confirmed to within 1% of it
+        self.commands.tolerance = max(self.commands.tolerance, inverter_max_power / 100)
         self.limit_nonpersistent_absolute = f"{self.base_topic}/{self.limit_topic}/{inverter_id}"
         log.info(
             f"Using {type(self).__name__}: Base topic: {self.base_topic}, Limit topic: {self.limit_nonpersistent_absolute}, SF Channels: {self.sf_inverter_channels}"
         )
 
-    def subscribe(self):
+    def subscribe(self, router=None):
         topics = [
             f"{self.base_topic}/{self.inverter_name}/+/P_DC",
             f"{self.base_topic}/{self.inverter_name}/ch0/P_AC",
@@ -407,30 +461,29 @@ class AhoyDTU(DTU):
             f"{self.base_topic}/{self.inverter_name}/ch0/Efficiency",
             f"{self.base_topic}/status",
         ]
-        super().subscribe(topics)
-
-    def handleMsg(self, msg):
-        if msg.topic.startswith(self.base_topic) and msg.payload:
-            metric = msg.topic.split("/")[-1]
-            value = float(msg.payload.decode())
-            log.debug(f"DTU received {metric}:{value}")
-            match metric:
-                case "P_AC":
-                    self.updChannelPowerDC(0, value)
-                case "Efficiency":
-                    self.updEfficiency(value)
-                case "status":
-                    self.updProducing(value)
-                case "active_PowerLimit":
-                    self.updLimitRelative(value)
-                    self.updLimitAbsolute(self.inverter_max_power * value / 100)
-                case "P_DC":
-                    channel = int(msg.topic.split("/")[-2][-1])
-                    if channel == 0:
-                        self.updTotalPowerDC(value)
-                    else:
-                        self.updChannelPowerDC(channel, value)
-                case _:
-                    log.warning(f"Ignoring inverter metric: {metric}")
-
-        super().handleMsg(msg)
+        super().subscribe(topics, router)
+
+    def handleMetric(self, msg, metric: str = None):
+        if not msg.payload:
+            return
+        metric = metric or msg.topic.split("/")[-1]
+        value = float(msg.payload.decode())
+        log.debug(f"DTU received {metric}:{value}")
+        match metric:
+            case "P_AC":
+                self.updChannelPowerDC(0, value)
+            case "Efficiency":
+                self.updEfficiency(value)
+            case "status":
+                self.updProducing(value)
+            case "active_PowerLimit":
+                self.updLimitRelative(value)
+                self.updLimitAbsolute(self.inverter_max_power * value / 100)
+            case "P_DC":
+                channel = int(msg.topic.split("/")[-2][-1])
+                if channel == 0:
+                    self.updTotalPowerDC(value)
+                else:
+                    self.updChannelPowerDC(channel, value)
+            case _:
+                log.warning(f"Ignoring inverter metric: {metric}")
@@ -0,0 +1,251 @@
+import inspect
+import logging
+import math
+import sys
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from collections import deque
+
+import clock
+from utils import TimewindowBuffer
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+class SignalFilter(ABC):
+    """Base class for smoothing filters with a cost per sample independent of the sample rate.
+
+    Filters expose the same interface as TimewindowBuffer (add, last, previous, populate, ...), so they can be used
+    for any of the smoothed signals. Subclasses implement update() which gets the raw value and the seconds since
+    the previous sample (None for the first one) and returns the filtered value.
+    """
+
+    name = "filter"
+    # the attributes holding a subclass' state, kept in checkpoints
+    fields = ()
+
+    def __init__(self, clock=clock.monotonic):
+        self.clock = clock
+        self.current = None
+        self.prev = None
+        self.lastTS = None
+
+    def __str__(self):
+        values = [v for v in (self.prev, self.current) if v is not None]
+        return f"{self.name}[ " + ",".join([f"{v:>3.1f}" for v in values]) + " ]"
+
+    @abstractmethod
+    def update(self, value: float, dt: float) -> float:
+        """The filtered value for a raw value, dt seconds after the previous sample (None for the first one)"""
+
+    @abstractmethod
+    def reset(self, value: float):
+        """Sets the filter state to value"""
+
+    def add(self, value):
+        now = self.clock()
+        dt = None if self.lastTS is None else now - self.lastTS
+        self.prev = self.current
+        self.current = self.update(value, dt)
+        self.lastTS = now
+
+    def len(self):
+        return len([v for v in (self.prev, self.current) if v is not None])
+
+    def last(self) -> float:
+        if self.current is None:
+            return 0
+        return round(self.current, 1)
+
+    def previous(self) -> float:
+        if self.prev is None:
+            return 0
+        return round(self.prev, 1)
+
+    # the filter output already is the smoothed value, so all averages are the same
+    def avg(self) -> float:
+        return self.last()
+
+    def wavg(self) -> float:
+        return self.last()
+
+    def qwavg(self) -> float:
+        return self.last()
+
+    def clear(self):
+        self.prev = None
+
+    # reset the filter state to a fixed value, e.g. after a rapid change has been detected
+    def populate(self, duration, value):
+        self.reset(value)
+
+    def checkpoint(self) -> dict:
+        state = {name: getattr(self, name) for name in ("current", "prev") + self.fields}
+        state["filter"] = self.name
+        state["age"] = None if self.lastTS is None else round(self.clock() - self.lastTS, 3)
+        return state
+
+    def restore(self, state: dict, age: float):
+        if state.get("filter") != self.name:
+            return
+        for name in ("current", "prev") + self.fields:
+            setattr(self, name, state[name])
+        self.lastTS = None if state["age"] is None else self.clock() - state["age"] - age
+
+
+class EMAFilter(SignalFilter):
+    """Exponential moving average with a time constant (seconds), independent of the sample rate"""
+
+    name = "ema"
+    fields = ("state",)
+
+    def __init__(self, tau: float = 10, clock=clock.monotonic):
+        super().__init__(clock=clock)
+        self.tau = tau
+        self.state = None
+
+    def update(self, value: float, dt: float) -> float:
+        if self.state is None or dt is None:
+            self.state = value
+        else:
+            alpha = 1 - math.exp(-dt / self.tau) if self.tau > 0 else 1
+            self.state += alpha * (value - self.state)
+        return self.state
+
+    def reset(self, value: float):
+        self.state = value
+
+
+class KalmanFilter(SignalFilter):
+    """Scalar Kalman filter for a random walk signal.
+
+    q is the process noise (variance growth per second, W^2/s), r the measurement noise (variance, W^2). A larger q
+    follows changes faster, a larger r smoothens more.
+    """
+
+    name = "kalman"
+    fields = ("x", "p")
+
+    def __init__(self, q: float = 100, r: float = 400, clock=clock.monotonic):
+        super().__init__(clock=clock)
+        self.q = q
+        self.r = r
+        self.x = None
+        self.p = r
+
+    def update(self, value: float, dt: float) -> float:
+        if self.x is None:
+            self.x = value
+            self.p = self.r
+            return self.x
+
+        self.p += self.q * (dt or 0)
+        gain = self.p / (self.p + self.r)
+        self.x += gain * (value - self.x)
+        self.p *= 1 - gain
+        return self.x
+
+    def reset(self, value: float):
+        self.x = value
+        self.p = self.r
+
+
+class HampelFilter(SignalFilter):
+    """Rolling median spike rejector.
+
+    Samples deviating more than k scaled median absolute deviations (at least floor W) from the median of the last
+    window samples are replaced by the median. Real steps pass once they make up half of the window.
+
+    The window is kept sorted, a sample costs O(window) for the insertion and removal and for the deviations, which
+    are merged outwards from the median instead of being sorted.
+    """
+
+    name = "hampel"
+
+    def __init__(self, window: int = 5, k: float = 3, floor: float = 10, clock=clock.monotonic):
+        super().__init__(clock=clock)
+        self.window = int(window)
+        self.k = k
+        self.floor = floor
+        self.samples = deque()
+        self.sorted = []
+
+    def update(self, value: float, dt: float) -> float:
+        self.samples.append(value)
+        insort(self.sorted, value)
+        if len(self.samples) > self.window:
+            del self.sorted[bisect_left(self.sorted, self.samples.popleft())]
+
+        n = len(self.sorted)
+        median = self.sorted[n // 2] if n % 2 else (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2
+        # the deviations of the samples below and above the median both grow walking away from it, merging the two
+        # walks gives the deviations in order up to the middle one
+        deviations = []
+        upper = bisect_left(self.sorted, median)
+        lower = upper - 1
+        for _ in range(n // 2 + 1):
+            if upper < n and (lower < 0 or self.sorted[upper] - median <= median - self.sorted[lower]):
+                deviations.append(self.sorted[upper] - median)
+                upper += 1
+            else:
+                deviations.append(median - self.sorted[lower])
+                lower -= 1
+        mad = deviations[n // 2] if n % 2 else (deviations[n // 2 - 1] + deviations[n // 2]) / 2
+        threshold = max(self.k * 1.4826 * mad, self.floor)
+        return median if abs(value - median) > threshold else value
+
+    def reset(self, value: float):
+        self.samples = deque([value] * self.window)
+        self.sorted = [value] * self.window
+
+    def checkpoint(self) -> dict:
+        state = super().checkpoint()
+        state["samples"] = list(self.samples)
+        return state
+
+    def restore(self, state: dict, age: float):
+        super().restore(state, age)
+        if state.get("filter") == self.name:
+            self.samples = deque(state["samples"][-self.window :])
+            self.sorted = sorted(self.samples)
+
+
+FILTERS = {
+    "window": TimewindowBuffer,
+    "ema": EMAFilter,
+    "kalman": KalmanFilter,
+    "hampel": HampelFilter,
+}
+
+
+def createFilter(spec: str = None, clock=clock.monotonic):
+    """Create a filter from a config spec like "ema:tau=8" or "hampel:window=7,k=3". Defaults to a 1 minute
+    TimewindowBuffer (spec "window"), which is also used if the spec names an unknown filter or parameter or has a
+    value which isn't a number."""
+    name, _, params = (spec or "window").partition(":")
+    name = name.strip().lower()
+    if name not in FILTERS:
+        log.error(f'Unknown filter "{name}", falling back to a moving window. Available: {", ".join(FILTERS)}')
+        name, params = "window", ""
+
+    allowed = [param for param in inspect.signature(FILTERS[name]).parameters if param != "clock"]
+    kwargs = {"minutes": 1} if name == "window" else {}
+    for param in filter(None, [p.strip() for p in params.split(",")]):
+        key, _, value = param.partition("=")
+        key = key.strip()
+        if key not in allowed:
+            log.error(
+                f'Unknown parameter "{key}" of filter "{name}", falling back to a moving window. Available: {", ".join(allowed)}'
+            )
+            return TimewindowBuffer(minutes=1, clock=clock)
+        try:
+            kwargs[key] = float(value) if name != "window" else int(value)
+        except ValueError:
+            log.error(
+                f'Invalid value "{value}" for parameter "{key}" of filter "{name}", falling back to a moving window'
+            )
+            return TimewindowBuffer(minutes=1, clock=clock)
+
+    return FILTERS[name](clock=clock, **kwargs)
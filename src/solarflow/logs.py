@@ -0,0 +1,185 @@
+import atexit
+import json
+import logging
+import queue
+import re
+import sys
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+import clock
+import metrics
+from snapshot import Snapshot
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+Log pipeline of the control service, set up once by setup() for all modules (they all log to the root logger). The
+threads logging only put records on a bounded queue, a background thread formats and writes them, so a slow stdout
+(e.g. an SD card) doesn't stall the control loop. If the queue is full, records are dropped instead of waiting.
+
+Records are formatted as text (as before), JSON or logfmt. Structured events carry their values as fields (see
+event()), which are only formatted by the writer. Each log statement (its call site) can be rate limited to a number
+of records per minute and sampled to every n-th record, warnings and errors always pass.
+"""
+
+FORMATS = ("text", "json", "logfmt")
+# log a control cycle as one summary event instead of the details of its decisions
+SUMMARY = False
+
+# arguments which can safely be formatted later by the writer
+IMMUTABLE = (str, int, float, bool, type(None), Snapshot)
+ANSI = re.compile(r"\x1b\[[0-9;]*m")
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(FORMAT)
+
+    def format(self, record) -> str:
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        return f"{text} {_logfmt(fields)}" if fields else text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        return json.dumps(_entry(self, record), default=str)
+
+
+class LogfmtFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        return _logfmt(_entry(self, record))
+
+
+def _entry(formatter: logging.Formatter, record) -> dict:
+    entry = {
+        "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+        "level": record.levelname.lower(),
+        "msg": ANSI.sub("", record.getMessage()),
+    }
+    entry.update(getattr(record, "fields", None) or {})
+    if record.exc_info or record.exc_text:
+        entry["exc"] = record.exc_text or formatter.formatException(record.exc_info)
+    return entry
+
+
+def _logfmt(fields: dict) -> str:
+    pairs = []
+    for key, value in fields.items():
+        value = "" if value is None else str(value)
+        if not value or any(c in value for c in ' "=\n'):
+            value = json.dumps(value)
+        pairs.append(f"{key}={value}")
+    return " ".join(pairs)
+
+
+FORMATTERS = {"text": TextFormatter, "json": JsonFormatter, "logfmt": LogfmtFormatter}
+
+
+class Throttle(logging.Filter):
+    """Rate limits (records per minute, 0 for no limit) and samples (every n-th record) each log statement below
+    WARNING. The number of suppressed records is appended to the next record passing."""
+
+    def __init__(self, rate: float = 0, sample: int = 1):
+        super().__init__()
+        self.rate = rate
+        # a statement may log a burst of up to a minute's worth of records
+        self.burst = max(rate, 1)
+        self.sample = sample
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        now = clock.monotonic()
+        with self.lock:
+            site = self.sites.get((record.pathname, record.lineno))
+            if site is None:
+                # tokens, last refill, records seen, records suppressed
+                site = self.sites[(record.pathname, record.lineno)] = [self.burst, now, 0, 0]
+            site[2] += 1
+            keep = (site[2] - 1) % self.sample == 0
+            if keep and self.rate:
+                site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate / 60)
+                site[1] = now
+                keep = site[0] >= 1
+                if keep:
+                    site[0] -= 1
+            if not keep:
+                site[3] += 1
+                metrics.log_suppressed.inc("throttled")
+                return False
+            suppressed, site[3] = site[3], 0
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar suppressed)"
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Puts records on the queue without waiting, they are dropped while it is full"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_suppressed.inc("dropped")
+
+    def prepare(self, record):
+        # formatting is left to the writer, unless the arguments could change until then
+        args = record.args.values() if isinstance(record.args, dict) else record.args or ()
+        if not all(isinstance(arg, IMMUTABLE) for arg in args):
+            record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            # the traceback refers to frames which go on running
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class Writer(QueueListener):
+    def enqueue_sentinel(self):
+        # wait for room, the writer is about to drain the queue
+        self.queue.put(self._sentinel)
+
+
+def setup(
+    format: str = "text",
+    level="INFO",
+    rate: float = 0,
+    sample: int = 1,
+    summary: bool = False,
+    queue_size: int = 10000,
+) -> Writer:
+    """Replaces the handlers of the root logger (e.g. the stdout handler the modules set up when imported) by the
+    queue and a writer thread, which is stopped and drained on exit"""
+    global SUMMARY
+    SUMMARY = summary
+    if format not in FORMATTERS:
+        log.error(f"Unknown log format {format}, use one of: {', '.join(FORMATS)}")
+        format = "text"
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(FORMATTERS[format]())
+    handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    (rate or sample > 1) and handler.addFilter(Throttle(rate, sample))
+
+    root = logging.getLogger("")
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+        previous.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    writer = Writer(handler.queue, stream)
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
+
+
+def event(logger: logging.Logger, msg: str, level: int = logging.INFO, **fields):
+    """Logs msg with the fields as structured values, which are formatted by the writer"""
+    logger.isEnabledFor(level) and logger.log(level, msg, extra={"fields": fields})
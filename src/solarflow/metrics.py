@@ -0,0 +1,288 @@
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+import clock
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+Metrics of the control loop and the message ingestion, served in the Prometheus text format on /metrics when a
+metrics_port is configured. The metrics of the control cycles, triggers and commands are always collected. The ones
+updated for every message (messages, handler_seconds, sample ages) are only collected while serving, the router
+checks enabled before doing any work for them.
+"""
+
+# set by serve(), the per-message metrics are collected only while they are served
+enabled = False
+
+# seconds, from the sub-millisecond message handlers to slow control cycles
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    extra and pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        return self.values.get(labels, 0)
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class LocalCounter:
+    """A counter for the message hot path, incremented without a lock. Every thread counts in a dict of its own, the
+    dicts of all threads are summed when the counter is exposed."""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.local = threading.local()
+        self.counts = []
+        self.lock = threading.Lock()
+
+    def _register(self) -> dict:
+        values = self.local.values = {}
+        with self.lock:
+            self.counts.append(values)
+        return values
+
+    def inc(self, *labels, amount: float = 1):
+        try:
+            values = self.local.values
+        except AttributeError:
+            values = self._register()
+        values[labels] = values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        with self.lock:
+            return sum(values.get(labels, 0) for values in self.counts)
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        totals = {}
+        with self.lock:
+            for values in self.counts:
+                # copying a dict is atomic, the owning thread may be counting meanwhile
+                for labels, value in values.copy().items():
+                    totals[labels] = totals.get(labels, 0) + value
+        for labels, value in sorted(totals.items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # one count per bucket (not cumulative) and one for larger values, then the count and sum of all
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {counts[-2]}")
+                lines.append(f"{self.name}_count{_labels(self.labels, labels)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {counts[-1]}")
+        return lines
+
+
+class Gauge:
+    """A gauge computed when it is scraped, function returns a dict of label values to values"""
+
+    def __init__(self, name: str, help: str, labels: tuple, function):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.function().items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+messages = LocalCounter(
+    "solarflow_messages_total",
+    "MQTT messages received, by the component handling them and their topic class (last topic level)",
+    ("component", "metric"),
+)
+handler_seconds = LocalCounter(
+    "solarflow_handler_seconds_total",
+    "Time spent handling messages, by component, estimated from a sample of the messages",
+    ("component",),
+)
+cycle_seconds = Histogram("solarflow_control_cycle_seconds", "Run time of the control cycles", ("worker",))
+cycle_wait_seconds = Histogram(
+    "solarflow_control_cycle_wait_seconds", "Time from the first trigger until the control cycle ran", ("worker",)
+)
+decisions = Counter("solarflow_control_decisions_total", "Decision paths taken for the hub's contribution", ("path",))
+triggers = Counter(
+    "solarflow_triggers_total",
+    "Triggers of the control cycle by source. queued: started a new cycle, merged: joined a pending cycle, "
+    "blocked: dropped while the inverter hasn't applied the last limit",
+    ("source", "result"),
+)
+commands = Counter("solarflow_commands_total", "Commands published to the devices", ("device", "property"))
+property_writes_requested = Counter(
+    "solarflow_property_writes_requested_total", "Property writes requested from the hub", ("device",)
+)
+property_writes_sent = Counter(
+    "solarflow_property_writes_sent_total",
+    "Messages sent to the hub's properties/write topic, writes requested within a flush window are merged into one",
+    ("device",),
+)
+command_retries = Counter(
+    "solarflow_command_retries_total", "Commands published again as they weren't confirmed", ("device", "property")
+)
+command_failures = Counter(
+    "solarflow_command_failures_total", "Commands given up on after all retries", ("device", "property")
+)
+log_suppressed = Counter(
+    "solarflow_log_records_suppressed_total",
+    "Log records not written, throttled (rate limit, sampling) or dropped as the log queue was full",
+    ("reason",),
+)
+
+_samples = {}
+
+
+def sampled(component: str):
+    _samples[component] = clock.monotonic()
+
+
+sample_age = Gauge(
+    "solarflow_last_sample_age_seconds",
+    "Time since the last message of each component",
+    ("component",),
+    lambda: {(component,): round(clock.monotonic() - t, 3) for component, t in _samples.items()},
+)
+
+_imported = time.monotonic()
+_startup = {}
+
+
+def _uptime() -> float:
+    """Seconds since the process (e.g. the container) was started, since this module was imported without /proc"""
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.monotonic() - _imported
+
+
+def firstCycle():
+    """Records the time to the first control cycle setting limits, once"""
+    if not _startup:
+        _startup[()] = round(_uptime(), 3)
+        log.info(f"First control cycle {_startup[()]:.2f}s after start")
+
+
+startup_seconds = Gauge(
+    "solarflow_startup_seconds",
+    "Time from the process start to the first control cycle setting limits",
+    (),
+    lambda: dict(_startup),
+)
+
+REGISTRY = [
+    startup_seconds,
+    messages,
+    handler_seconds,
+    sample_age,
+    cycle_seconds,
+    cycle_wait_seconds,
+    decisions,
+    triggers,
+    commands,
+    property_writes_requested,
+    property_writes_sent,
+    command_retries,
+    command_failures,
+    log_suppressed,
+]
+
+
+def expose() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+def serve(port: int, host: str = ""):
+    global enabled
+    # imported here, as most setups don't serve metrics
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(f"Metrics request: {format % args}")
+
+    enabled = True
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info(f"Serving metrics on http://{host or '0.0.0.0'}:{port}/metrics")
+    return server
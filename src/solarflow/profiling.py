@@ -0,0 +1,64 @@
+import builtins
+import logging
+import sys
+import threading
+import time
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+Import time profile of the startup (like python -X importtime, but reported through the log), enabled by the
+--profile-startup option. The profiler wraps the import statement, so it has to be installed before the modules to
+be measured are imported. Only imports on the main thread are timed.
+"""
+
+
+class ImportProfiler:
+    def __init__(self):
+        # module => (cumulative seconds, seconds without the imports it made)
+        self.times = {}
+        self.stack = []
+        self.original = None
+        self.installed = None
+
+    def install(self):
+        self.original = builtins.__import__
+        self.installed = time.perf_counter()
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self.original is not None:
+            builtins.__import__ = self.original
+            self.original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules or threading.current_thread() is not threading.main_thread():
+            return self.original(name, globals, locals, fromlist, level)
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            name in self.times or self.times.setdefault(name, (elapsed, elapsed - nested))
+
+    def report(self, top: int = 15) -> str:
+        """The slowest imports (cumulative, including the modules they imported, and their own time)"""
+        total = sum(own for cumulative, own in self.times.values())
+        lines = [
+            f"Startup import profile: {len(self.times)} modules imported in {total * 1000:.0f}ms, "
+            f"{(time.perf_counter() - self.installed) * 1000:.0f}ms since profiling started"
+        ]
+        lines.append(f"  {'cumulative':>10} {'self':>8}  module")
+        slowest = sorted(self.times.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        for name, (cumulative, own) in slowest:
+            lines.append(f"  {cumulative * 1000:>8.1f}ms {own * 1000:>6.1f}ms  {name}")
+        return "\n".join(lines)
+
+
+profiler = ImportProfiler()
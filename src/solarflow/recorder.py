@@ -0,0 +1,133 @@
+import logging
+import struct
+import sys
+import threading
+
+import clock
+from utils import getScheduler
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+Recording format, an append-only sequence of segments (one per recording session):
+
+    segment:  MAGIC <start time: float64 epoch seconds> record*
+    record:   TOPIC <id: varint> <length: varint> <topic>
+              MESSAGE <delta: varint ms since the previous message> <topic id: varint> <length: varint> <payload>
+
+Topics are interned, each one is written once per segment and referenced by its id afterwards.
+"""
+
+MAGIC = b"SFREC1\n"
+TOPIC = 1
+MESSAGE = 2
+
+
+def varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+class Recorder:
+    """Appends inbound MQTT messages with their time of arrival to a recording file"""
+
+    def __init__(self, path: str, flush_interval: int = 5):
+        self.path = path
+        self.file = open(path, "ab")
+        self.topics = {}
+        self.start = clock.time()
+        self.last = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+        self.file.write(MAGIC + struct.pack("<d", self.start))
+        getScheduler().every(flush_interval, self.flush, name="recorder.flush")
+        log.info(f"Recording inbound MQTT messages to {path}")
+
+    def record(self, topic: str, payload: bytes):
+        with self.lock:
+            if self.file is None:
+                return
+            out = bytearray()
+            topic_id = self.topics.get(topic)
+            if topic_id is None:
+                topic_id = self.topics[topic] = len(self.topics)
+                encoded = topic.encode()
+                out += bytes([TOPIC]) + varint(topic_id) + varint(len(encoded)) + encoded
+
+            now = int((clock.time() - self.start) * 1000)
+            delta, self.last = max(now - self.last, 0), max(now, self.last)
+            out += bytes([MESSAGE]) + varint(delta) + varint(topic_id) + varint(len(payload)) + payload
+            self.file.write(out)
+            self.messages += 1
+
+    def flush(self):
+        with self.lock:
+            self.file and self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file and self.file.close()
+            self.file = None
+
+
+def _readVarint(data: bytes, pos: int) -> (int, int):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def readRecording(path: str):
+    """Yields (epoch seconds, topic, payload) for all messages of a recording"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    pos = 0
+    topics = {}
+    start = elapsed = 0
+    while pos < len(data):
+        if data.startswith(MAGIC, pos):
+            (start,) = struct.unpack_from("<d", data, pos + len(MAGIC))
+            pos += len(MAGIC) + 8
+            topics = {}
+            elapsed = 0
+            continue
+        try:
+            kind = data[pos]
+            if kind == TOPIC:
+                topic_id, pos = _readVarint(data, pos + 1)
+                length, pos = _readVarint(data, pos)
+                topics[topic_id] = data[pos : pos + length].decode()
+                pos += length
+            elif kind == MESSAGE:
+                delta, pos = _readVarint(data, pos + 1)
+                topic_id, pos = _readVarint(data, pos)
+                length, pos = _readVarint(data, pos)
+                payload = data[pos : pos + length]
+                if len(payload) < length:
+                    raise IndexError
+                pos += length
+                elapsed += delta
+                yield start + elapsed / 1000, topics[topic_id], payload
+            else:
+                raise ValueError(kind)
+        except (IndexError, KeyError, ValueError):
+            # a record was cut off, e.g. the recording process was killed while writing, continue with the next segment
+            resume = data.find(MAGIC, pos)
+            log.warning(f"Recording {path} has an incomplete record at offset {pos}")
+            if resume < 0:
+                return
+            pos = resume
@@ -0,0 +1,162 @@
+import csv
+import getopt
+import importlib
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from itertools import chain
+from astral import LocationInfo
+from paho.mqtt.client import MQTTMessage
+from clock import SimulatedClock, setClock
+from recorder import readRecording
+from utils import VirtualScheduler, setScheduler
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+# the control module is named like the script, it reads config.ini from the working directory on import
+sfc = importlib.import_module("solarflow-control")
+
+
+"""
+Replays a recording made with "solarflow-control.py --record <file>" into the hub, DTU and smartmeter handlers and
+the control loop, on a simulated clock. Every outbound limit command (hub property writes, inverter limits) is
+recorded, so the decisions of a changed controller can be compared against real data:
+
+    python3 replay.py -f <recording> [-s <speed>] [-o <commands.csv>] [-v]
+
+Without -s the recording is replayed as fast as possible, with -s N at N times real time. Run it in the directory
+with the config.ini of the recorded setup.
+"""
+
+
+class ReplayClient:
+    """Stands in for the paho client: outbound messages are counted and commands to the devices are recorded"""
+
+    def __init__(self, clock: SimulatedClock):
+        self.clock = clock
+        self._userdata = None
+        self.on_message = sfc.on_config_message
+        self.published = 0
+        self.command_topics = set()
+        self.commands = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        if topic in self.command_topics:
+            self.commands.append((self.clock.time(), topic, payload))
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+
+def replay(path: str, speed: float = None) -> dict:
+    records = readRecording(path)
+    first = next(records, None)
+    if first is None:
+        log.error(f"Recording {path} contains no messages")
+        return None
+
+    clock = SimulatedClock(first[0])
+    setClock(clock)
+    scheduler = VirtualScheduler(clock)
+    setScheduler(scheduler)
+    client = ReplayClient(clock)
+    for site in sfc.sites:
+        site.location = LocationInfo(timezone="Europe/Berlin", latitude=site.latitude, longitude=site.longitude)
+
+    started = False
+    messages = 0
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for ts, topic, payload in chain([first], records):
+        if speed:
+            time.sleep(max(wall_start + (ts - first[0]) / speed - time.perf_counter(), 0))
+        # like solarflow-control (see configReceived), start once no messages arrived for CONFIG_QUIET seconds after
+        # the retained ones at the start of the recording, at the latest STARTUP_DELAY seconds after connecting. The
+        # recording has no SUBACKs, the retained messages are the first ones recorded
+        if not started and messages:
+            begin = min(max(sfc.config_last + sfc.CONFIG_QUIET, first[0]), first[0] + sfc.STARTUP_DELAY)
+            if ts >= begin:
+                scheduler.runUntil(begin)
+                log.info(f"Read retained config settings in {begin - first[0]:.2f}s")
+                # the scheduler runs the control cycles inline, on the simulated clock
+                sfc.start(client, scheduler)
+                client.on_message = sfc.on_message
+                for site in sfc.sites:
+                    client.command_topics.update([site.hub.property_topic, site.dtu.limit_nonpersistent_absolute])
+                started = True
+
+        scheduler.runUntil(ts)
+        msg = MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        client.on_message(client, client._userdata, msg)
+        messages += 1
+
+    wall = time.perf_counter() - wall_start
+    duration = clock.time() - first[0]
+    return {
+        "messages": messages,
+        "start": datetime.fromtimestamp(first[0]).isoformat(),
+        "duration_s": duration,
+        "wall_s": wall,
+        "cpu_s": time.process_time() - cpu_start,
+        "replay_days_per_minute": (duration / 86400) / (wall / 60) if wall > 0 else 0,
+        "control_cycles": sum(worker.cycles for worker in scheduler.workers),
+        "published": client.published,
+        "commands": client.commands,
+    }
+
+
+def main(argv):
+    path = None
+    speed = None
+    output = None
+    verbose = False
+    opts, args = getopt.getopt(argv, "hf:s:o:v", ["file=", "speed=", "output=", "verbose"])
+    for opt, arg in opts:
+        if opt == "-h":
+            log.info("replay.py -f <recording> -s <speed> -o <commands.csv> -v")
+            sys.exit()
+        elif opt in ("-f", "--file"):
+            path = arg
+        elif opt in ("-s", "--speed"):
+            speed = float(arg)
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-v", "--verbose"):
+            verbose = True
+
+    if path is None:
+        log.error("You need to provide a recording (option -f)!")
+        sys.exit(1)
+
+    # the control loop logs every decision, which would dominate the replay time
+    verbose or log.setLevel(logging.WARNING)
+    result = replay(os.path.abspath(path), speed)
+    log.setLevel(logging.INFO)
+    if result is None:
+        sys.exit(1)
+
+    log.info(
+        f"Replayed {result['messages']} messages ({result['duration_s'] / 3600:.1f}h from {result['start']}) in {result['wall_s']:.1f}s "
+        f"({result['cpu_s']:.1f}s CPU): {result['replay_days_per_minute']:.1f} replay-days/minute, "
+        f"{result['control_cycles']} control cycles, {len(result['commands'])} commands"
+    )
+    if output:
+        with open(output, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time", "topic", "payload"])
+            for ts, topic, payload in result["commands"]:
+                writer.writerow([datetime.fromtimestamp(ts).isoformat(), topic, payload])
+        log.info(f"Wrote commands to {output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
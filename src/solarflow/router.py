@@ -0,0 +1,116 @@
+import logging
+import sys
+import threading
+import time
+
+import metrics
+import tracing
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+# with metrics, the time spent in the handlers is measured on every n-th message and scaled up
+TIMING_SAMPLE = 16
+
+
+class TopicRouter:
+    """Dispatches MQTT messages to the handlers registered for the subscriptions they match.
+
+    Subscriptions without wildcards are kept in a dict, the ones with + or # wildcards in a topic trie. The handlers
+    of a concrete topic are resolved only once and cached together with the topic's metric (last topic level), so
+    every further message is one dict lookup. Handlers are called as handler(msg, metric).
+
+    When metrics are served, messages are counted per component, the class of a handler's instance (e.g. Solarflow,
+    OpenDTU, Smartmeter) or the name of a plain function, and the time spent in the handlers is estimated from a
+    sample of the messages. Without metrics and tracing a message costs the route lookup and the lock.
+
+    Messages are dispatched while holding lock, so taking the lock gives a consistent view of the state the handlers
+    update.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self.exact = {}
+        self.trie = {}
+        self.cache = {}
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.untimed = 0
+
+    def add(self, pattern: str, handler):
+        if "+" in pattern or "#" in pattern:
+            node = self.trie
+            for level in pattern.split("/"):
+                node = node.setdefault(level, {})
+            node.setdefault(None, []).append(handler)
+        else:
+            self.exact.setdefault(pattern, []).append(handler)
+        self.cache.clear()
+
+    def _match(self, node: dict, levels: list, i: int, handlers: list):
+        if "#" in node:
+            handlers.extend(node["#"].get(None, []))
+        if i == len(levels):
+            handlers.extend(node.get(None, []))
+            return
+        if levels[i] in node:
+            self._match(node[levels[i]], levels, i + 1, handlers)
+        if "+" in node:
+            self._match(node["+"], levels, i + 1, handlers)
+
+    def resolve(self, topic: str) -> tuple:
+        route = self.cache.get(topic)
+        if route is None:
+            handlers = list(self.exact.get(topic, []))
+            # wildcards don't match topics starting with $ (e.g. $SYS)
+            if not topic.startswith("$"):
+                self._match(self.trie, topic.split("/"), 0, handlers)
+            handlers = tuple((handler, component(handler)) for handler in dict.fromkeys(handlers))
+            route = (handlers, topic.rsplit("/", 1)[-1])
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[topic] = route
+        return route
+
+    def dispatch(self, msg) -> int:
+        route = self.cache.get(msg.topic) or self.resolve(msg.topic)
+        if metrics.enabled or tracing.getTracer().enabled:
+            return self.dispatchInstrumented(msg, *route)
+        handlers, metric = route
+        with self.lock:
+            for handler, _ in handlers:
+                handler(msg, metric)
+        return len(handlers)
+
+    def dispatchInstrumented(self, msg, handlers: tuple, metric: str) -> int:
+        tracer = tracing.getTracer()
+        trace = tracer.enabled
+        count = metrics.enabled
+        # the handlers are timed on every TIMING_SAMPLE-th message only
+        self.untimed = (self.untimed + 1) % TIMING_SAMPLE
+        timed = count and not self.untimed
+        with self.lock:
+            for handler, name in handlers:
+                trace and tracer.arrived(name, msg.topic)
+                if timed:
+                    start = time.perf_counter()
+                    handler(msg, metric)
+                    metrics.handler_seconds.inc(name, amount=(time.perf_counter() - start) * TIMING_SAMPLE)
+                else:
+                    handler(msg, metric)
+                if count:
+                    metrics.messages.inc(name, metric)
+                    metrics.sampled(name)
+            trace and tracer.handled()
+        if not handlers and count:
+            metrics.messages.inc("unrouted", metric)
+        return len(handlers)
+
+
+def component(handler) -> str:
+    instance = getattr(handler, "__self__", None)
+    if instance is not None:
+        return type(instance).__name__
+    # e.g. functools.partial
+    handler = getattr(handler, "func", handler)
+    return getattr(handler, "__name__", type(handler).__name__)
@@ -0,0 +1,243 @@
+import getopt
+import json
+import logging
+import sys
+import time
+from datetime import date, datetime
+from datetime import time as daytime
+from simulator import Simulation, constant, daylight, siteLocation, steps
+from utils import getScheduler
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+"""
+Control quality benchmarks: runs solarflow-control against the simulated plant (see simulator.py) through a library of
+scripted scenarios and reports for each one:
+
+    grid_import_wh, feed_in_wh      energy from and to the grid while measuring
+    settle_s                        for each load or PV step: seconds until the grid power stays within SETTLE_BAND of
+                                    the value it settles at, null if it didn't settle before the next step or never
+                                    left the band (nothing to correct)
+    hub_commands, inverter_commands property writes to the hub and limits sent to the inverter
+    cycles, cpu_per_cycle_ms        control cycles run and their average CPU time
+
+    python3 scenarios.py [-s <scenario>[,<scenario>...]] [-o <results.json>] [-v]
+
+Results are written as JSON (to stdout without -o), so they can be compared across commits. Run it in a directory with
+a config.ini, which configures the controller. The control parameters a scenario depends on (e.g. the maximum discharge
+power, which would otherwise cap every step) are set by the scenario.
+"""
+
+# all scenarios run on the same day, so their sunrise and sunset are comparable
+DAY = date(2025, 6, 21)
+# the controller runs this long with the scenario's initial state before measuring
+WARMUP = 1800
+SETTLE_BAND = 30
+# the value the grid power settles at is the average of this last part of a step
+SETTLE_TAIL = 60
+# control parameters of all scenarios, the controller must not be saturated by the discharge power to follow the load
+CONTROL = {"maxDischargePower": 800, "minChargePower": 125, "batteryDischargeStart": 10}
+
+
+class Scenario:
+    """A scripted scenario, measured for duration seconds from start (local time on DAY).
+
+    load, solar and direct are functions of the start time of the measurement (epoch seconds) and the location,
+    returning the power profiles for the house load and the PV on the hub and the inverter's direct channels. steps are
+    the offsets from the start at which the load or PV changes in a step. control overrides control parameters of the
+    site (see CONTROL).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        start: daytime,
+        duration: float,
+        load,
+        solar=None,
+        direct=None,
+        soc: float = 50,
+        steps: list | None = None,
+        control: dict | None = None,
+    ):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.load = load
+        self.solar = solar or clear_sky(800)
+        self.direct = direct or (lambda t0, location: constant(0))
+        self.soc = soc
+        self.steps = steps or []
+        self.control = {**CONTROL, **(control or {})}
+
+
+def load_step(base: float, changes: list):
+    """House load of base watts, with (offset from the start, watts) changes"""
+    return lambda t0, location: steps(t0, [(-WARMUP, base)] + changes)
+
+
+def clear_sky(peak: float):
+    """PV of peak watts at noon"""
+    return lambda t0, location: daylight(location, peak)
+
+
+def passing_cloud(peak: float):
+    """PV of peak watts at noon, shaded to 20% from 60s to 660s after the start"""
+
+    def profile(t0: float, location):
+        sunny = daylight(location, peak)
+        return lambda t: sunny(t) * (0.2 if t0 + 60 <= t < t0 + 660 else 1)
+
+    return profile
+
+
+# each scenario has to make the controller change limits (the inverter's at night, also the hub's during the day with
+# panels connected directly to the inverter), otherwise its settle times and command counts can't show a regression
+SCENARIOS = [
+    Scenario("kettle", daytime(23, 0), 600, load_step(150, [(60, 600), (240, 150)]), soc=80, steps=[60, 240]),
+    Scenario("boiler", daytime(23, 0), 2700, load_step(150, [(60, 2150), (1860, 150)]), soc=80, steps=[60, 1860]),
+    Scenario(
+        "cloud",
+        daytime(12, 0),
+        1200,
+        load_step(400, []),
+        solar=passing_cloud(800),
+        direct=passing_cloud(400),
+        soc=60,
+        steps=[60, 660],
+    ),
+    Scenario(
+        "oven",
+        daytime(13, 0),
+        1200,
+        load_step(300, [(60, 1200), (660, 300)]),
+        direct=clear_sky(400),
+        soc=50,
+        steps=[60, 660],
+        control={"dischargeDuringDaytime": True},
+    ),
+    Scenario("sunrise", daytime(4, 30), 5 * 3600, load_step(200, []), soc=30),
+    Scenario(
+        "night",
+        daytime(1, 0),
+        2 * 3600,
+        load_step(150, [(1200, 350), (2400, 150), (4800, 250), (6000, 150)]),
+        soc=70,
+        steps=[1200, 2400, 4800, 6000],
+    ),
+    # starts just above the SoC discharging stops at (battery low + discharge start)
+    Scenario("battery_low", daytime(23, 0), 3 * 3600, load_step(300, []), soc=14),
+]
+
+
+def settle_time(samples: list, start: float, end: float) -> float | None:
+    window = [(t, power) for t, power in samples if start <= t < end]
+    tail = [power for t, power in window if t >= end - SETTLE_TAIL]
+    if not tail:
+        return None
+    final = sum(tail) / len(tail)
+    outside = [t for t, power in window if abs(power - final) > SETTLE_BAND]
+    if not outside:
+        # the grid power never left the band, nothing was corrected
+        return None
+    if outside[-1] >= end - SETTLE_TAIL:
+        return None
+    return outside[-1] + 1 - start
+
+
+def run(scenario: Scenario) -> dict:
+    location = siteLocation()
+    t0 = datetime.combine(DAY, scenario.start, location.tzinfo).timestamp()
+    sim = Simulation(
+        t0 - WARMUP,
+        load=scenario.load(t0, location),
+        solar=scenario.solar(t0, location),
+        direct=scenario.direct(t0, location),
+        location=location,
+        soc=scenario.soc,
+    )
+    # the simulations of all scenarios control the same site, its parameters are restored for the next one
+    configured = {name: getattr(sim.site, name) for name in scenario.control}
+    for name, value in scenario.control.items():
+        setattr(sim.site, name, value)
+    try:
+        return measure(scenario, sim, t0)
+    finally:
+        for name, value in configured.items():
+            setattr(sim.site, name, value)
+
+
+def measure(scenario: Scenario, sim: Simulation, t0: float) -> dict:
+    sim.runUntil(t0)
+
+    samples = []
+    getScheduler().every(1, lambda: samples.append((sim.now(), sim.house.gridPower)), name="scenario.sample")
+    grid_import, feed_in = sim.house.gridImportWh, sim.house.gridExportWh
+    hub_commands, inverter_commands = sim.hub.commands, sim.inverter.commands
+    cycles, cpu = sim.control.cycles, sim.control.totalCpu
+    wall = time.perf_counter()
+    sim.runUntil(t0 + scenario.duration)
+
+    bounds = [t0 + offset for offset in scenario.steps] + [t0 + scenario.duration]
+    cycles = sim.control.cycles - cycles
+    return {
+        "grid_import_wh": round(sim.house.gridImportWh - grid_import, 1),
+        "feed_in_wh": round(sim.house.gridExportWh - feed_in, 1),
+        "settle_s": [settle_time(samples, start, end) for start, end in zip(bounds, bounds[1:])],
+        "hub_commands": sim.hub.commands - hub_commands,
+        "inverter_commands": sim.inverter.commands - inverter_commands,
+        "cycles": cycles,
+        "cpu_per_cycle_ms": round((sim.control.totalCpu - cpu) / cycles * 1000, 3) if cycles else None,
+        "final_soc": sim.hub.electricLevel(),
+        "wall_s": round(time.perf_counter() - wall, 2),
+    }
+
+
+def main(argv):
+    names = [scenario.name for scenario in SCENARIOS]
+    output = None
+    verbose = False
+    opts, args = getopt.getopt(argv, "hs:o:v", ["scenarios=", "output=", "verbose"])
+    for opt, arg in opts:
+        if opt == "-h":
+            log.info(f"scenarios.py -s <scenario>[,<scenario>...] -o <results.json> -v, scenarios: {', '.join(names)}")
+            sys.exit()
+        elif opt in ("-s", "--scenarios"):
+            names = arg.split(",")
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-v", "--verbose"):
+            verbose = True
+
+    unknown = set(names) - set(scenario.name for scenario in SCENARIOS)
+    if unknown:
+        log.error(f"Unknown scenarios: {', '.join(unknown)}")
+        sys.exit(1)
+
+    results = {}
+    for scenario in SCENARIOS:
+        if scenario.name not in names:
+            continue
+        # the control loop logs every decision, which would dominate the run time
+        verbose or log.setLevel(logging.WARNING)
+        results[scenario.name] = result = run(scenario)
+        log.setLevel(logging.INFO)
+        log.info(
+            f"{scenario.name}: import {result['grid_import_wh']}Wh, feed-in {result['feed_in_wh']}Wh, "
+            f"settle {result['settle_s']}s, commands hub/inverter {result['hub_commands']}/{result['inverter_commands']}, "
+            f"{result['cycles']} cycles at {result['cpu_per_cycle_ms']}ms CPU"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        log.info(f"Wrote results to {output}")
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
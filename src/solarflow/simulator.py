@@ -0,0 +1,523 @@
+import getopt
+import importlib
+import json
+import logging
+import math
+import sys
+import time
+from datetime import datetime
+from astral import LocationInfo
+from astral.sun import sun
+from paho.mqtt.client import MQTTMessage
+
+import clock
+import tracing
+from clock import SimulatedClock, setClock
+from utils import VirtualScheduler, getScheduler, setScheduler
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+# the control module is named like the script, it reads config.ini from the working directory on import
+sfc = importlib.import_module("solarflow-control")
+
+
+"""
+Closed-loop simulation of the devices solarflow-control talks to: a Solarflow hub with its battery packs, an inverter
+behind OpenDTU or AhoyDTU and a house with a smartmeter. The device models speak the same MQTT topics and payloads as
+the real devices, over an in-process transport, so the unchanged Solarflow, DTU and Smartmeter classes and the
+limitHomeInput loop run against them. Everything runs on a simulated clock, a day takes a few seconds.
+
+    python3 simulator.py [-d <hours>] [-t <start, e.g. 2024-06-01T00:00>] [-l <house load W>] [-p <PV peak W>]
+                         [-o <trace file>] [-v]
+
+With -o the latency of every command is traced to a file (see tracing.py), on the simulated clock. Run it in a directory with a config.ini, which configures the controller and the device topics.
+"""
+
+
+# power profiles are functions of the (simulated) epoch time returning watts
+def constant(watts: float):
+    return lambda t: watts
+
+
+def steps(start: float, changes: list):
+    """Piecewise constant power, changes are (seconds after start, watts) pairs in ascending order"""
+
+    def profile(t):
+        watts = 0
+        for offset, value in changes:
+            if t < start + offset:
+                break
+            watts = value
+        return watts
+
+    return profile
+
+
+def daylight(location: LocationInfo, peak: float):
+    """Clear sky PV output: half a sine wave between sunrise and sunset, peaking at noon"""
+    days = {}
+
+    def profile(t):
+        date = datetime.fromtimestamp(t, location.tzinfo).date()
+        if date not in days:
+            s = sun(location.observer, date=date, tzinfo=location.tzinfo)
+            days[date] = (s["sunrise"].timestamp(), s["sunset"].timestamp())
+        sunrise, sunset = days[date]
+        if not sunrise < t < sunset:
+            return 0
+        return peak * math.sin(math.pi * (t - sunrise) / (sunset - sunrise))
+
+    return profile
+
+
+class LocalTransport:
+    """In-process MQTT stand-in, handed to the controller's components as their client.
+
+    Messages published by the controller go to the device models, messages of the device models (deliver()) to the
+    client's on_message. Messages the controller publishes before the devices are attached are kept until then.
+    """
+
+    def __init__(self):
+        self._userdata = None
+        self.on_message = None
+        self.plant = None
+        self.backlog = []
+        self.published = 0
+        self.delivered = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+        if self.plant:
+            self.plant.handleCommand(topic, payload)
+        else:
+            self.backlog.append((topic, payload))
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def attach(self, plant):
+        self.plant = plant
+        for topic, payload in self.backlog:
+            plant.handleCommand(topic, payload)
+        self.backlog = []
+
+    def deliver(self, topic: str, payload):
+        if self.on_message is None:
+            return
+        self.delivered += 1
+        msg = MQTTMessage(topic=topic.encode())
+        msg.payload = payload if isinstance(payload, bytes) else str(payload).encode()
+        self.on_message(self, self._userdata, msg)
+
+
+class HubModel:
+    """A Solarflow hub with battery packs.
+
+    The battery is charged from the solar input surplus and discharged to meet the output limit. A new output limit is
+    reported back after confirm_delay seconds, the actual output follows it within about limit_lag seconds. Below 100W
+    the hub only supports 30W steps. With the bypass on (passMode 2, or passMode 0 with a full battery) the solar input
+    is passed through to the inverter and the battery is idle.
+    """
+
+    def __init__(
+        self,
+        transport,
+        product_id: str,
+        device_id: str,
+        solar=constant(0),
+        packs: int = 1,
+        pack_capacity: float = 960,
+        soc: float = 50,
+        max_charge_power: int = 1200,
+        max_discharge_power: int = 1200,
+        inverse_max_power: int = 800,
+        limit_lag: float = 60,
+        confirm_delay: float = 15,
+        report_interval: float = 5,
+    ):
+        self.transport = transport
+        self.report_topic = f"/{product_id}/{device_id}/properties/report"
+        self.write_topic = f"iot/{product_id}/{device_id}/properties/write"
+        self.read_topic = f"iot/{product_id}/{device_id}/properties/read"
+        self.solar = solar
+        self.packs = {f"SIMPACK{i:08d}": float(soc) for i in range(packs)}
+        self.pack_capacity = pack_capacity
+        self.max_charge_power = max_charge_power
+        self.max_discharge_power = max_discharge_power
+        self.limit_lag = limit_lag
+        self.confirm_delay = confirm_delay
+        self.commands = 0
+
+        self.outputLimit = 0  # limit the hub is working with
+        self.reportedLimit = 0  # limit reported back to the controller
+        self.output = 0.0  # output power following the limit
+        self.inverseMaxPower = inverse_max_power
+        self.socSet = 1000
+        self.minSoc = 100
+        self.passMode = 1
+        self.bypass = False
+        self.solarInputPower = 0
+        self.outputPackPower = 0
+        self.packInputPower = 0
+        self.outputHomePower = 0
+        self.reported = {}
+        getScheduler().every(report_interval, self.report, name="sim.hub.report")
+
+    def electricLevel(self) -> int:
+        return int(sum(self.packs.values()) / len(self.packs))
+
+    def handleCommand(self, topic: str, payload):
+        if topic == self.read_topic:
+            self.report(full=True)
+        if topic != self.write_topic:
+            return
+
+        self.commands += 1
+        for prop, value in json.loads(payload)["properties"].items():
+            match prop:
+                case "outputLimit":
+                    limit = int(value)
+                    # the hub only supports 30W steps below 100W
+                    self.outputLimit = limit if limit >= 100 else 30 * (limit // 30)
+                    getScheduler().after(self.confirm_delay, self.confirmLimit, self.outputLimit, name="sim.hub.limit")
+                case "inverseMaxPower":
+                    self.inverseMaxPower = int(value)
+                case "socSet":
+                    self.socSet = int(value)
+                case "minSoc":
+                    self.minSoc = int(value)
+                case "passMode":
+                    self.passMode = int(value)
+
+    def confirmLimit(self, limit: int):
+        # a later write overrides an earlier one still waiting to be reported
+        if limit == self.outputLimit:
+            self.reportedLimit = limit
+
+    def step(self, dt: float, max_output: float) -> float:
+        """Advance the hub by dt seconds, max_output is what the inverter draws at most. Returns the output power"""
+        soc = self.electricLevel()
+        full = soc >= self.socSet / 10
+        empty = soc <= self.minSoc / 10
+        solar = self.solarInputPower = self.solar(clock.time())
+        self.bypass = self.passMode == 2 or (self.passMode == 0 and full and solar > 0)
+
+        # the output follows a new limit with a lag, 95% after limit_lag seconds
+        target = min(self.outputLimit, self.inverseMaxPower)
+        self.output += (target - self.output) * min(3 * dt / self.limit_lag, 1)
+
+        if self.bypass:
+            home = min(solar, self.inverseMaxPower, max_output)
+            battery = 0
+        else:
+            home = min(self.output, max_output)
+            battery = solar - home
+            if battery > 0:
+                # the hub curtails the panels if the battery can't take the surplus
+                battery = 0 if full else min(battery, self.max_charge_power)
+            else:
+                battery = 0 if empty else max(battery, -self.max_discharge_power)
+                home = solar - battery
+
+        self.outputHomePower = int(home)
+        self.outputPackPower = int(max(battery, 0))
+        self.packInputPower = int(max(-battery, 0))
+        for sn in self.packs:
+            change = battery / len(self.packs) * dt / 3600 / self.pack_capacity * 100
+            self.packs[sn] = min(max(self.packs[sn] + change, 0), 100)
+        return home
+
+    def report(self, full: bool = False):
+        props = {
+            "electricLevel": self.electricLevel(),
+            "solarInputPower": int(self.solarInputPower),
+            "outputPackPower": self.outputPackPower,
+            "packInputPower": self.packInputPower,
+            "outputHomePower": self.outputHomePower,
+            "outputLimit": self.reportedLimit,
+            "inverseMaxPower": self.inverseMaxPower,
+            "pass": int(self.bypass),
+            "passMode": self.passMode,
+            "socSet": self.socSet,
+            "minSoc": self.minSoc,
+        }
+        packs = [{"sn": sn, "socLevel": int(soc), "totalVol": int(4600 + soc * 6)} for sn, soc in self.packs.items()]
+        # like the hub, only report what changed, except when asked for all properties
+        changed = {k: v for k, v in props.items() if full or self.reported.get(k) != v}
+        packs_changed = full or self.reported.get("packData") != packs
+        self.reported.update(props, packData=packs)
+        if changed or packs_changed:
+            payload = {"properties": changed}
+            packs_changed and payload.update(packData=packs)
+            self.transport.deliver(self.report_topic, json.dumps(payload))
+
+
+class InverterModel:
+    """A micro inverter behind OpenDTU or AhoyDTU.
+
+    The limit applies to all channels equally. Channels listed in hub_channels draw from the hub, the others from
+    directly connected panels (direct). A new limit is applied and reported after limit_latency seconds.
+    """
+
+    def __init__(
+        self,
+        transport,
+        dtu,
+        channels: int = 4,
+        direct=constant(0),
+        max_power: int = 800,
+        efficiency: float = 95.5,
+        limit_latency: float = 10,
+        report_interval: float = 5,
+    ):
+        self.transport = transport
+        self.dtu = dtu
+        self.dialect = type(dtu).__name__
+        self.limit_topic = dtu.limit_nonpersistent_absolute
+        self.channels = channels
+        self.hub_channels = [ch for ch in dtu.sf_inverter_channels if ch <= channels]
+        self.direct_channels = [ch for ch in range(1, channels + 1) if ch not in self.hub_channels]
+        self.direct = direct
+        self.max_power = max_power
+        self.efficiency = efficiency
+        self.limit_latency = limit_latency
+        self.commands = 0
+        self.limit = max_power
+        self.dcPower = [0.0] * (channels + 1)
+        self.acPower = 0.0
+        getScheduler().every(report_interval, self.report, name="sim.inverter.report")
+
+    def handleCommand(self, topic: str, payload):
+        if topic != self.limit_topic:
+            return
+        self.commands += 1
+        limit = int(float(str(payload).rstrip("W")))
+        getScheduler().after(self.limit_latency, self.applyLimit, limit, name="sim.inverter.limit")
+
+    def applyLimit(self, limit: int):
+        # limits above the inverter's capacity are accepted (and reported), but don't raise the output any further
+        self.limit = max(limit, 0)
+
+    def channelLimit(self) -> float:
+        return min(self.limit, self.max_power) / self.channels
+
+    def hubDraw(self) -> float:
+        # the most the hub channels take from the hub
+        return self.channelLimit() * len(self.hub_channels)
+
+    def step(self, dt: float, hub_output: float) -> float:
+        """Advance the inverter by dt seconds with the hub's output. Returns the AC output power"""
+        cap = self.channelLimit()
+        direct = self.direct(clock.time())
+        for ch in self.direct_channels:
+            self.dcPower[ch] = min(direct / len(self.direct_channels), cap)
+        for ch in self.hub_channels:
+            self.dcPower[ch] = min(hub_output / len(self.hub_channels), cap)
+        self.dcPower[0] = sum(self.dcPower[1:])
+        self.acPower = self.dcPower[0] * self.efficiency / 100
+        return self.acPower
+
+    def report(self):
+        deliver = self.transport.deliver
+        base = self.dtu.base_topic
+        if self.dialect == "AhoyDTU":
+            name = f"{base}/{self.dtu.inverter_name}"
+            deliver(f"{name}/ch0/P_AC", f"{self.acPower:.1f}")
+            for ch, power in enumerate(self.dcPower):
+                deliver(f"{name}/ch{ch}/P_DC", f"{power:.1f}")
+            deliver(f"{name}/ch0/Efficiency", f"{self.efficiency:.1f}")
+            deliver(
+                f"{name}/ch0/active_PowerLimit",
+                f"{self.limit / (self.dtu.inverter_max_power or self.max_power) * 100:.1f}",
+            )
+            deliver(f"{base}/status", "1" if self.acPower > 0 else "0")
+        else:
+            deliver(f"{base}/0/power", f"{self.acPower:.1f}")
+            for ch in range(1, self.channels + 1):
+                deliver(f"{base}/{ch}/power", f"{self.dcPower[ch]:.1f}")
+            deliver(f"{base}/0/powerdc", f"{self.dcPower[0]:.1f}")
+            deliver(f"{base}/0/efficiency", f"{self.efficiency:.1f}")
+            deliver(f"{base}/status/producing", "1" if self.acPower > 0 else "0")
+            deliver(f"{base}/status/reachable", "1")
+            deliver(f"{base}/status/limit_absolute", f"{self.limit:.1f}")
+            deliver(f"{base}/status/limit_relative", f"{self.limit / self.max_power * 100:.1f}")
+
+
+class HouseModel:
+    """The house load and the grid meter. Grid power is the load minus the inverter's AC output, negative values are
+    fed into the grid. Readings are published in the format of the configured smartmeter type."""
+
+    def __init__(self, transport, smt, load=constant(250), report_interval: float = 5):
+        self.transport = transport
+        self.smt = smt
+        self.load = load
+        self.gridPower = 0.0
+        self.gridImportWh = 0.0
+        self.gridExportWh = 0.0
+        if type(smt).__name__ == "Poweropti":
+            log.error("The Poweropti is polled over HTTP, it can't be simulated. The house won't report any readings!")
+        else:
+            getScheduler().every(report_interval, self.report, name="sim.smartmeter.report")
+
+    def step(self, dt: float, ac_power: float):
+        self.gridPower = self.load(clock.time()) - ac_power
+        energy = self.gridPower * dt / 3600
+        if energy > 0:
+            self.gridImportWh += energy
+        else:
+            self.gridExportWh -= energy
+
+    def report(self):
+        power = round(self.gridPower, 1)
+        match type(self.smt).__name__:
+            case "ShellyEM3":
+                for phase in range(3):
+                    self.transport.deliver(f"{self.smt.base_topic}/emeter/{phase}/power", f"{power / 3:.1f}")
+            case "VZLogger":
+                self.transport.deliver(self.smt.base_topic, f"{power}")
+            case _:
+                # nest the reading like the configured accessor expects it, e.g. Power.Power_curr
+                payload = power / self.smt.scaling_factor
+                for key in reversed(self.smt.cur_accessor.split(".")):
+                    payload = {key: payload}
+                self.transport.deliver(self.smt.base_topic, json.dumps(payload))
+
+
+class Plant:
+    """The hub, inverter and house of one site, stepped together every step seconds"""
+
+    def __init__(self, hub: HubModel, inverter: InverterModel, house: HouseModel, step: float = 1):
+        self.hub = hub
+        self.inverter = inverter
+        self.house = house
+        self.dt = step
+        getScheduler().every(step, self.step, name="sim.plant.step")
+
+    def handleCommand(self, topic: str, payload):
+        self.hub.handleCommand(topic, payload)
+        self.inverter.handleCommand(topic, payload)
+
+    def step(self):
+        output = self.hub.step(self.dt, self.inverter.hubDraw())
+        ac_power = self.inverter.step(self.dt, output)
+        self.house.step(self.dt, ac_power)
+
+
+def siteLocation() -> LocationInfo:
+    """The configured location, or Munich if none is configured, for sunrise/sunset of the controller and the PV"""
+    site = sfc.sites[0]
+    return LocationInfo(timezone="Europe/Berlin", latitude=site.latitude or 48.1, longitude=site.longitude or 11.6)
+
+
+class Simulation:
+    """Runs solarflow-control, configured by config.ini, against a simulated plant on a simulated clock.
+
+    The profiles (house load, PV on the hub and on the inverter's direct channels) can be replaced at any time, e.g. by
+    scripted scenarios. Keyword arguments are passed to the HubModel.
+    """
+
+    def __init__(
+        self,
+        start: float,
+        load=constant(250),
+        solar=None,
+        direct=constant(0),
+        channels: int = 4,
+        location: LocationInfo = None,
+        **hub_args,
+    ):
+        self.clock = SimulatedClock(start)
+        setClock(self.clock)
+        self.scheduler = VirtualScheduler(self.clock)
+        setScheduler(self.scheduler)
+        self.start = start
+        self.location = location or siteLocation()
+        # the plant is simulated for the first site configured
+        self.site = sfc.sites[0]
+        self.site.location = self.location
+
+        self.transport = LocalTransport()
+        # the scheduler runs the control cycles inline, on the simulated clock
+        sfc.start(self.transport, self.scheduler)
+        self.control = self.site.control
+
+        hub = self.site.hub
+        self.hub = HubModel(
+            self.transport,
+            hub.productId,
+            hub.deviceId,
+            solar=solar or daylight(self.location, 800),
+            **hub_args,
+        )
+        self.inverter = InverterModel(
+            self.transport, self.site.dtu, channels=channels, direct=direct, max_power=self.site.maxInverterLimit
+        )
+        self.house = HouseModel(self.transport, self.site.smartmeter, load=load)
+        self.plant = Plant(self.hub, self.inverter, self.house)
+        self.transport.attach(self.plant)
+
+    def now(self) -> float:
+        return self.clock.time()
+
+    def run(self, seconds: float):
+        self.scheduler.runUntil(self.clock.time() + seconds)
+
+    def runUntil(self, t: float):
+        self.scheduler.runUntil(t)
+
+
+def main(argv):
+    hours = 24
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    load = 250
+    peak = 800
+    trace = None
+    verbose = False
+    opts, args = getopt.getopt(argv, "hd:t:l:p:o:v", ["duration=", "start=", "load=", "peak=", "trace=", "verbose"])
+    for opt, arg in opts:
+        if opt == "-h":
+            log.info("simulator.py -d <hours> -t <start> -l <house load W> -p <PV peak W> -o <trace file> -v")
+            sys.exit()
+        elif opt in ("-d", "--duration"):
+            hours = float(arg)
+        elif opt in ("-t", "--start"):
+            start = datetime.fromisoformat(arg)
+        elif opt in ("-l", "--load"):
+            load = int(arg)
+        elif opt in ("-p", "--peak"):
+            peak = int(arg)
+        elif opt in ("-o", "--trace"):
+            trace = arg
+        elif opt in ("-v", "--verbose"):
+            verbose = True
+
+    trace and tracing.setTracer(tracing.Tracer(tracing.FileSink(trace)))
+    # the control loop logs every decision, which would dominate the simulation time
+    verbose or log.setLevel(logging.WARNING)
+    wall = time.perf_counter()
+    sim = Simulation(start.timestamp(), load=constant(load))
+    sim.hub.solar = daylight(sim.location, peak)
+    for hour in range(math.ceil(hours)):
+        sim.run(min(hours - hour, 1) * 3600)
+        log.setLevel(logging.INFO)
+        log.info(
+            f"{sim.clock.now():%Y-%m-%d %H:%M}: SoC {sim.hub.electricLevel()}%, hub limit {sim.hub.outputLimit}W, "
+            f"output {sim.hub.outputHomePower}W, inverter {sim.inverter.acPower:.0f}W (limit {sim.inverter.limit}W), "
+            f"grid {sim.house.gridPower:.0f}W"
+        )
+        verbose or log.setLevel(logging.WARNING)
+    log.setLevel(logging.INFO)
+    log.info(
+        f"Simulated {hours}h in {time.perf_counter() - wall:.1f}s: grid import {sim.house.gridImportWh:.0f}Wh, "
+        f"feed-in {sim.house.gridExportWh:.0f}Wh, {sim.control.cycles} control cycles, "
+        f"{sim.hub.commands} hub and {sim.inverter.commands} inverter commands"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,8 +2,9 @@ from paho.mqtt import client as mqtt_client
 import logging
 import json
 import sys
-from utils import TimewindowBuffer, RepeatedTimer, deep_get
-import requests
+from utils import getScheduler, deep_get
+from filters import createFilter
+from snapshot import SmartmeterSnapshot
 
 TRIGGER_DIFF = 10
 
@@ -22,7 +23,10 @@ class Smartmeter:
         "rapid_change_diff": int,
         "zero_offset": int,
         "scaling_factor": int,
+        "power_filter": str,
     }
+    # the site (hub, inverter) the smartmeter belongs to, set when the site is started
+    site = None
 
     def default_calllback(self):
         log.info("default callback")
@@ -36,11 +40,12 @@ class Smartmeter:
         rapid_change_diff: int = 500,
         zero_offset: int = 0,
         scaling_factor: int = 1,
+        power_filter: str = None,
         callback=default_calllback,
     ):
         self.client = client
         self.base_topic = base_topic
-        self.power = TimewindowBuffer(minutes=1)
+        self.power = createFilter(power_filter)
         self.phase_values = {}
         self.cur_accessor = cur_accessor
         self.total_accessor = total_accessor
@@ -50,7 +55,7 @@ class Smartmeter:
         self.trigger_callback = callback
         self.scaling_factor = scaling_factor
         log.info(
-            f"Using {type(self).__name__}: Base topic: {self.base_topic}, Current power accessor: {self.cur_accessor}, Total power accessor: {self.total_accessor}, Rapid change diff: {self.rapid_change_diff}W, Zero offset: {self.zero_offset}W, Scaling factor: {self.scaling_factor}"
+            f"Using {type(self).__name__}: Base topic: {self.base_topic}, Current power accessor: {self.cur_accessor}, Total power accessor: {self.total_accessor}, Rapid change diff: {self.rapid_change_diff}W, Zero offset: {self.zero_offset}W, Scaling factor: {self.scaling_factor}, Filter: {self.power.__class__.__name__}"
         )
 
     def __str__(self):
@@ -60,15 +65,22 @@ class Smartmeter:
                         P:{sum(self.phase_values.values()):>3.1f}W {self.power}{reset}".split()
         )
 
-    def subscribe(self):
+    def subscribe(self, router=None):
         topics = [f"{self.base_topic}"]
         for t in topics:
             self.client.subscribe(t)
             log.info(f"Smartmeter subscribing: {t}")
+            router and router.add(t, self.handlePower)
 
     def ready(self):
         return len(self.phase_values) > 0
 
+    def usageTopic(self) -> str:
+        # a single site keeps publishing to solarflow-hub/smartmeter, with several sites each under its hub
+        if self.site and self.site.name:
+            return f"solarflow-hub/{self.site.deviceId}/smartmeter"
+        return "solarflow-hub/smartmeter"
+
     def updPower(self):
         force_trigger = False
         phase_sum = sum(self.phase_values.values())
@@ -86,13 +98,11 @@ class Smartmeter:
             self.power.populate(20, phase_sum)
             force_trigger = True
 
-        # by recording smartmeter usage only up to a certain max power we can ensure that
-        # demand drops from short high-consumption spikes are faster settled
-        # self.power.add(phase_sum if phase_sum < 1000 else 1000)
+        # short high-consumption spikes can be rejected by configuring a spike filter (power_filter = hampel)
         self.power.add(phase_sum)
-        self.client.publish("solarflow-hub/smartmeter/homeUsage", int(round(phase_sum)))
+        self.client.publish(f"{self.usageTopic()}/homeUsage", int(round(phase_sum)))
         self.client.publish(
-            "solarflow-hub/smartmeter/homeUsageSmoothened",
+            f"{self.usageTopic()}/homeUsageSmoothened",
             int(round(self.power.last())),
         )
 
@@ -100,32 +110,37 @@ class Smartmeter:
         previous = self.getPreviousPower()
         if abs(previous - self.getPower()) >= TRIGGER_DIFF or force_trigger:
             log.info(
-                f"SMT triggers limit function: {previous} -> {self.getPower()}: {'executed' if self.trigger_callback(self.client, force=force_trigger) else 'skipped'}"
+                f"SMT triggers limit function: {previous} -> {self.getPower()}: {'queued' if self.trigger_callback(self.client, force=force_trigger) else 'skipped'}"
             )
             self.last_trigger_value = self.getPower()
 
         # agressively try to avoid feed-in (below 0 W) if it comes from hub - but also honor the zero offset
         if (self.getPower() - self.zero_offset) < 0 and self.getPreviousPower() < 0:
-            hub = self.client._userdata["hub"]
+            hub = self.site.hub
             if hub.getDischargePower() > 0:
                 self.trigger_callback(self.client)
 
     def handleMsg(self, msg):
         if msg.topic.startswith(self.base_topic) and msg.payload:
-            payload = json.loads(msg.payload.decode())
+            self.handlePower(msg)
 
-            if type(payload) is float or type(payload) is int:
-                self.phase_values.update({msg.topic: payload * self.scaling_factor})
-                self.updPower()
-            if type(payload) is dict:
-                try:
-                    value = deep_get(payload, self.cur_accessor)
-                except:
-                    log.error(f"Could not get value from topic payload: {sys.exc_info()}")
+    def handlePower(self, msg, metric: str = None):
+        if not msg.payload:
+            return
+        payload = json.loads(msg.payload.decode())
 
-                if value:
-                    self.phase_values.update({msg.topic: value * self.scaling_factor})
-                    self.updPower()
+        if type(payload) is float or type(payload) is int:
+            self.phase_values.update({msg.topic: payload * self.scaling_factor})
+            self.updPower()
+        if type(payload) is dict:
+            try:
+                value = deep_get(payload, self.cur_accessor)
+            except:
+                log.error(f"Could not get value from topic payload: {sys.exc_info()}")
+
+            if value:
+                self.phase_values.update({msg.topic: value * self.scaling_factor})
+                self.updPower()
 
     def getPower(self):
         return self.power.last()
@@ -133,6 +148,17 @@ class Smartmeter:
     def getPreviousPower(self):
         return self.power.previous()
 
+    def snapshot(self, text: bool = True) -> SmartmeterSnapshot:
+        return SmartmeterSnapshot(
+            text=str(self) if text else "", ready=self.ready(), power=self.getPower(), zero_offset=self.zero_offset
+        )
+
+    def checkpoint(self) -> dict:
+        return {"power": self.power.checkpoint()}
+
+    def restore(self, state: dict, age: float):
+        self.power.restore(state["power"], age)
+
 
 class Poweropti(Smartmeter):
     POWEROPTI_API = "https://backend.powerfox.energy/api/2.0/my/main/current"
@@ -141,6 +167,7 @@ class Poweropti(Smartmeter):
         "poweropti_password": str,
         "rapid_change_diff": int,
         "zero_offset": int,
+        "power_filter": str,
     }
 
     def __init__(
@@ -150,12 +177,13 @@ class Poweropti(Smartmeter):
         poweropti_password: str,
         rapid_change_diff: int = 500,
         zero_offset: int = 0,
+        power_filter: str = None,
         callback=Smartmeter.default_calllback,
     ):
         self.client = client
         self.user = poweropti_user
         self.password = poweropti_password
-        self.power = TimewindowBuffer(minutes=1)
+        self.power = createFilter(power_filter)
         self.phase_values = {}
         self.rapid_change_diff = rapid_change_diff
         self.zero_offset = zero_offset
@@ -165,7 +193,11 @@ class Poweropti(Smartmeter):
         self.session = None
 
     def pollPowerfoxAPI(self):
+        # runs in a thread, only the request blocks, the reading is applied like a message
         if self.session == None:
+            # requests is only needed by this smartmeter, it's imported on first use
+            import requests
+
             self.session = requests.Session()
             self.session.auth = (self.user, self.password)
 
@@ -175,21 +207,28 @@ class Poweropti(Smartmeter):
                 current = resp.json()
                 watt = int(current["Watt"])
                 outdated = bool(current["Outdated"])
-                self.phase_values.update({"poweropti": watt})
-                self.updPower()
-                # self.client.publish(f'poweropti/power',watt)
             except:
-                log.exception()
+                log.exception("Reading the Powerfox API failed")
+                return
+        getScheduler().callSoon(self.applyPower, watt)
+
+    def applyPower(self, watt: int):
+        # serialized with the message handlers and the snapshots of the control cycles
+        with self.site.router.lock:
+            self.phase_values.update({"poweropti": watt})
+            self.updPower()
+            # self.client.publish(f'poweropti/power',watt)
 
-    def subscribe(self):
-        updater = RepeatedTimer(5, self.pollPowerfoxAPI)
+    def subscribe(self, router=None):
+        # fixed delay, a slow API response must not make polls pile up
+        getScheduler().every(5, self.pollPowerfoxAPI, fixed_rate=False, name="poweropti.poll", blocking=True)
 
     def handleMsg(self, msg):
         pass
 
 
 class ShellyEM3(Smartmeter):
-    opts = {"base_topic": str, "rapid_change_diff": int, "zero_offset": int}
+    opts = {"base_topic": str, "rapid_change_diff": int, "zero_offset": int, "power_filter": str}
 
     def __init__(
         self,
@@ -197,11 +236,12 @@ class ShellyEM3(Smartmeter):
         base_topic: str,
         rapid_change_diff: int = 500,
         zero_offset: int = 0,
+        power_filter: str = None,
         callback=Smartmeter.default_calllback,
     ):
         self.client = client
         self.base_topic = base_topic
-        self.power = TimewindowBuffer(minutes=1)
+        self.power = createFilter(power_filter)
         self.phase_values = {}
         self.rapid_change_diff = rapid_change_diff
         self.zero_offset = zero_offset
@@ -210,7 +250,7 @@ class ShellyEM3(Smartmeter):
         self.scaling_factor = 1
         log.info(f"Using {type(self).__name__}: Base topic: {self.base_topic}")
 
-    def subscribe(self):
+    def subscribe(self, router=None):
         topics = [
             f"{self.base_topic}/emeter/0/power",
             f"{self.base_topic}/emeter/1/power",
@@ -219,10 +259,11 @@ class ShellyEM3(Smartmeter):
         for t in topics:
             self.client.subscribe(t)
             log.info(f"Shelly3EM subscribing: {t}")
+            router and router.add(t, self.handlePower)
 
 
 class VZLogger(Smartmeter):
-    opts = {"cur_usage_topic": str, "rapid_change_diff": int, "zero_offset": int}
+    opts = {"cur_usage_topic": str, "rapid_change_diff": int, "zero_offset": int, "power_filter": str}
 
     def __init__(
         self,
@@ -230,11 +271,12 @@ class VZLogger(Smartmeter):
         cur_usage_topic: str,
         rapid_change_diff: int = 500,
         zero_offset: int = 0,
+        power_filter: str = None,
         callback=Smartmeter.default_calllback,
     ):
         self.client = client
         self.base_topic = cur_usage_topic
-        self.power = TimewindowBuffer(minutes=1)
+        self.power = createFilter(power_filter)
         self.phase_values = {}
         self.rapid_change_diff = rapid_change_diff
         self.zero_offset = zero_offset
@@ -243,10 +285,11 @@ class VZLogger(Smartmeter):
         self.scaling_factor = 1
         log.info(f"Using {type(self).__name__}: Current Usage Topic: {self.base_topic}")
 
-    def subscribe(self):
+    def subscribe(self, router=None):
         topics = [
             f"{self.base_topic}",
         ]
         for t in topics:
             self.client.subscribe(t)
             log.info(f"VZLogger subscribing: {t}")
+            router and router.add(t, self.handlePower)
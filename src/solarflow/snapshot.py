@@ -0,0 +1,138 @@
+import logging
+import sys
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+class Snapshot:
+    """Frozen copy of a component's state, attributes can only be set on construction"""
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is frozen, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is frozen")
+
+    def __str__(self):
+        return self.text
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return type(self)(**values)
+
+
+class HubSnapshot(Snapshot):
+    __slots__ = (
+        "text",
+        "ready",
+        "electricLevel",
+        "solarInputPower",
+        "outputLimit",
+        "inverseMaxPower",
+        "bypass",
+        "dischargePower",
+        "batteryLow",
+        "batteryTarget",
+        "sunriseSoC",
+        "daySoCIncrease",
+        "control_bypass",
+        "force_drain",
+    )
+
+
+class DTUSnapshot(Snapshot):
+    __slots__ = (
+        "text",
+        "ready",
+        "channelsDCPower",
+        "sf_inverter_channels",
+        "efficiency",
+        "limitAbsolute",
+        "acLimit",
+        "currentACPower",
+    )
+
+
+class SmartmeterSnapshot(Snapshot):
+    __slots__ = ("text", "ready", "power", "zero_offset")
+
+
+class ControlSnapshot(Snapshot):
+    """State of hub, inverter and smartmeter for one control cycle.
+
+    The values derived from the inverter channels and the smartmeter are computed once when the snapshot is taken,
+    so a control decision works on one consistent set of values while new telemetry keeps arriving.
+    """
+
+    __slots__ = (
+        "hub",
+        "dtu",
+        "smt",
+        "efficiency",
+        "directDCPowerValues",
+        "hubDCPowerValues",
+        "directDCPower",
+        "hubDCPower",
+        "directACPower",
+        "hubACPower",
+        "maxDirectACPower",
+        "nrTotalChannels",
+        "nrDirectChannels",
+        "nrHubChannels",
+        "nrProducingChannels",
+        "channelLimit",
+        "gridPower",
+    )
+
+    def __init__(self, hub: HubSnapshot, dtu: DTUSnapshot, smt: SmartmeterSnapshot):
+        channels = dtu.channelsDCPower
+        direct = tuple(v for idx, v in enumerate(channels) if idx > 0 and idx not in dtu.sf_inverter_channels)
+        # in case the inverter is not reachable or not producing, direct panels deliver 0
+        direct = direct or (0,)
+        hubdc = tuple(v for idx, v in enumerate(channels) if idx > 0 and idx in dtu.sf_inverter_channels)
+        efficiency = dtu.efficiency / 100
+        total = len(channels) - 1
+
+        super().__init__(
+            hub=hub,
+            dtu=dtu,
+            smt=smt,
+            efficiency=efficiency,
+            directDCPowerValues=direct,
+            hubDCPowerValues=hubdc,
+            directDCPower=sum(direct),
+            hubDCPower=sum(hubdc),
+            directACPower=sum(direct) * efficiency,
+            hubACPower=sum(hubdc) * efficiency,
+            maxDirectACPower=max(direct) * efficiency,
+            nrTotalChannels=total,
+            nrDirectChannels=total - len(dtu.sf_inverter_channels),
+            nrHubChannels=len(dtu.sf_inverter_channels),
+            nrProducingChannels=len([v for v in channels if v > 0]) - 1,
+            channelLimit=dtu.limitAbsolute / total if total > 0 else 0,
+            gridPower=smt.power - smt.zero_offset,
+        )
+
+    def __str__(self):
+        return f"{self.hub}\n{self.dtu}\n{self.smt}"
+
+    def replace(self, **changes):
+        values = {"hub": self.hub, "dtu": self.dtu, "smt": self.smt}
+        values.update(changes)
+        return ControlSnapshot(**values)
+
+    def ready(self) -> bool:
+        return self.hub.ready and self.dtu.ready and self.smt.ready
+
+    @staticmethod
+    def isWithin(a, b, range: int):
+        return b - range < a < b + range
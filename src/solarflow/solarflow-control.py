@@ -1,20 +1,43 @@
+import sys
+
+# the import profiler has to be installed before the modules it measures are imported
+if "--profile-startup" in sys.argv:
+    from profiling import profiler
+
+    profiler.install()
+else:
+    profiler = None
+
 import random
 import time
 import logging
-import sys
 import getopt
 import os
 from datetime import datetime, timedelta
 from paho.mqtt import client as mqtt_client
 from astral import LocationInfo
 from astral.sun import sun
-import requests
 import configparser
 import math
+import clock
+import logs
+import metrics
+import tracing
+from decisions import Decision, DecisionLog, pathString
 import solarflow
-import dtus
-import smartmeters
-from utils import RepeatedTimer, str2bool
+import backends
+from functools import partial
+from router import TopicRouter
+from snapshot import ControlSnapshot
+from worker import ControlWorker
+from utils import getScheduler, setScheduler, str2bool
+from recorder import Recorder
+from checkpoint import Checkpointer
+from typing import TYPE_CHECKING
+
+# asyncio and the runtime built on it are imported only when the asyncio runtime is configured
+if TYPE_CHECKING:
+    from aioruntime import AsyncRuntime
 
 blue = "\x1b[34;20m"
 reset = "\x1b[0m"
@@ -38,13 +61,13 @@ def stroption(option):
     return option
 
 
-def load_config():
+def load_config(path: str = "config.ini"):
     config = configparser.ConfigParser(converters={"str": stroption, "list": listoption})
     try:
-        with open("config.ini", "r") as cf:
+        with open(path, "r") as cf:
             config.read_file(cf)
     except:
-        log.error("No configuration file (config.ini) found in execution directory! Using environment variables.")
+        log.error(f"No configuration file ({path}) found in execution directory! Using environment variables.")
     return config
 
 
@@ -54,82 +77,210 @@ config = load_config()
 """
 Configuration Options
 """
-sf_device_id = config.get("solarflow", "device_id", fallback=None) or os.environ.get("SF_DEVICE_ID", None)
-sf_product_id = config.get("solarflow", "product_id", fallback="73bkTV") or os.environ.get("SF_PRODUCT_ID", "73bkTV")
 mqtt_user = config.get("mqtt", "mqtt_user", fallback=None) or os.environ.get("MQTT_USER", None)
 mqtt_pwd = config.get("mqtt", "mqtt_pwd", fallback=None) or os.environ.get("MQTT_PWD", None)
 mqtt_host = config.get("mqtt", "mqtt_host", fallback=None) or os.environ.get("MQTT_HOST", None)
 mqtt_port = config.getint("mqtt", "mqtt_port", fallback=None) or os.environ.get("MQTT_PORT", 1883)
 
 
-DTU_TYPE = config.get("global", "dtu_type", fallback=None) or os.environ.get("DTU_TYPE", "OpenDTU")
-SMT_TYPE = config.get("global", "smartmeter_type", fallback=None) or os.environ.get("SMARTMETER_TYPE", "Smartmeter")
+# further config files (in the format of config.ini), each configuring a site (hub, inverter, smartmeter and their
+# control parameters) controlled by this process over the one MQTT connection. Without, config.ini is the only site
+SITES = config.get("global", "sites", fallback=None) or os.environ.get("SITES", None)
+# threads (paho network thread, scheduler and control worker threads) or asyncio (everything on one event loop)
+RUNTIME = config.get("global", "runtime", fallback=None) or os.environ.get("RUNTIME", "threads")
+# serve Prometheus metrics on this port (http://<host>:<port>/metrics), disabled if not set
+METRICS_PORT = config.getint("global", "metrics_port", fallback=None) or int(os.environ.get("METRICS_PORT", 0))
+# write the latency of every limit sent to the devices (message to confirmation, by stage) as JSON lines to this file
+TRACE_FILE = config.get("global", "trace_file", fallback=None) or os.environ.get("TRACE_FILE", None)
+# log format (text, json or logfmt), one line per control cycle instead of the decision details, and per log statement
+# at most log_rate records per minute (0 for no limit) and only every log_sample-th record
+LOG_FORMAT = config.get("global", "log_format", fallback=None) or os.environ.get("LOG_FORMAT", "text")
+LOG_SUMMARY = config.getboolean("global", "log_summary", fallback=None) or str2bool(
+    os.environ.get("LOG_SUMMARY", False)
+)
+LOG_RATE = config.getfloat("global", "log_rate", fallback=None) or float(os.environ.get("LOG_RATE", 0))
+LOG_SAMPLE = config.getint("global", "log_sample", fallback=None) or int(os.environ.get("LOG_SAMPLE", 1))
+# checkpoint the controller state to this file every checkpoint_interval seconds and restore it on startup
+CHECKPOINT_FILE = config.get("global", "checkpoint_file", fallback=None) or os.environ.get("CHECKPOINT_FILE", None)
+CHECKPOINT_INTERVAL = config.getint("global", "checkpoint_interval", fallback=None) or int(
+    os.environ.get("CHECKPOINT_INTERVAL", 60)
+)
 
-# The amount of power that should be always reserved for charging, if available. Nothing will be fed to the house if less is produced
-# MQTT config topic: solarflow-hub/control/minChargePower
-# config.ini [control] min_charge_power
-MIN_CHARGE_POWER = None
+# this controls the internal calculation of limited growth for setting inverter limits
+INVERTER_START_LIMIT = 5
 
-# The maximum discharge level of the packSoc. Even if there is more demand it will not go beyond that
-# MQTT config topic: solarflow-hub/control/maxDischargePower
-# config.ini [control] max_discharge_power
-MAX_DISCHARGE_POWER = None
 
-# battery SoC levels for normal operation cycles (when not in charge through mode)
-# MQTT config topic: solarflow-hub/control/batteryTargetSoCMin
-# config.ini [control] battery_low
-BATTERY_LOW = None
-# MQTT config topic: solarflow-hub/control/batteryTargetSoCMax
-# config.ini [control] battery_high
-BATTERY_HIGH = None
+class Site:
+    """A hub, the inverter it feeds and the smartmeter of the house, controlled together. Holds the site's
+    configuration, its control parameters and, once started, its components. All sites of a process share the MQTT
+    connection, the message router and the scheduler."""
 
-# the SoC that is required before discharging of the battery would start. To allow a bit of charging first in the morning.
-BATTERY_DISCHARGE_START = config.getint("control", "battery_discharge_start", fallback=None) or int(
-    os.environ.get("BATTERY_DISCHARGE_START", 10)
-)
+    def __init__(self, config: configparser.ConfigParser, name: str = ""):
+        # the name of the site's config file, empty if config.ini is the only site
+        self.name = name
+        self.config = config
+        self.deviceId = config.get("solarflow", "device_id", fallback=None) or os.environ.get("SF_DEVICE_ID", None)
+        self.productId = config.get("solarflow", "product_id", fallback="73bkTV") or os.environ.get(
+            "SF_PRODUCT_ID", "73bkTV"
+        )
+        self.dtuType = config.get("global", "dtu_type", fallback=None) or os.environ.get("DTU_TYPE", "OpenDTU")
+        self.smtType = config.get("global", "smartmeter_type", fallback=None) or os.environ.get(
+            "SMARTMETER_TYPE", "Smartmeter"
+        )
 
-# the maximum allowed inverter output
-MAX_INVERTER_LIMIT = config.getint("control", "max_inverter_limit", fallback=None) or int(
-    os.environ.get("MAX_INVERTER_LIMIT", 800)
-)
-MAX_INVERTER_INPUT = config.getint("control", "max_inverter_input", fallback=None) or int(
-    os.environ.get("MAX_INVERTER_INPUT", 400)
-)
+        # The amount of power that should be always reserved for charging, if available. Nothing will be fed to the house if less is produced
+        # MQTT config topic: solarflow-hub/<device>/control/minChargePower
+        # config.ini [control] min_charge_power
+        self.minChargePower = None
+
+        # The maximum discharge level of the packSoc. Even if there is more demand it will not go beyond that
+        # MQTT config topic: solarflow-hub/<device>/control/maxDischargePower
+        # config.ini [control] max_discharge_power
+        self.maxDischargePower = None
+
+        # battery SoC levels for normal operation cycles (when not in charge through mode)
+        # MQTT config topic: solarflow-hub/<device>/control/batteryTargetSoCMin
+        # config.ini [control] battery_low
+        self.batteryLow = None
+        # MQTT config topic: solarflow-hub/<device>/control/batteryTargetSoCMax
+        # config.ini [control] battery_high
+        self.batteryHigh = None
+
+        # the SoC that is required before discharging of the battery would start. To allow a bit of charging first in the morning.
+        self.batteryDischargeStart = config.getint("control", "battery_discharge_start", fallback=None) or int(
+            os.environ.get("BATTERY_DISCHARGE_START", 10)
+        )
 
-# this controls the internal calculation of limited growth for setting inverter limits
-INVERTER_START_LIMIT = 5
+        # the maximum allowed inverter output
+        self.maxInverterLimit = config.getint("control", "max_inverter_limit", fallback=None) or int(
+            os.environ.get("MAX_INVERTER_LIMIT", 800)
+        )
+        self.maxInverterInput = config.getint("control", "max_inverter_input", fallback=None) or int(
+            os.environ.get("MAX_INVERTER_INPUT", 400)
+        )
+
+        # interval/rate limit for performing control steps
+        self.steeringInterval = config.getint("control", "steering_interval", fallback=None) or int(
+            os.environ.get("STEERING_INTERVAL", 15)
+        )
+
+        # number of control cycles kept in the decision log, which is dumped on request to solarflow-hub/<device>/decisions
+        self.decisionLog = DecisionLog(
+            config.getint("control", "decision_log_size", fallback=None)
+            or int(os.environ.get("DECISION_LOG_SIZE", 2880))
+        )
+
+        # flag, which can be set to allow discharging the battery during daytime
+        # MQTT config topic: solarflow-hub/<device>/control/dischargeDuringDaytime
+        # config.ini [control] discharge_during_daytime
+        self.dischargeDuringDaytime = None
+
+        # Adjustments possible to sunrise and sunset offset
+        # MQTT config topic: solarflow-hub/<device>/control/sunriseOffset
+        # config.ini [control] sunrise_offset
+        self.sunriseOffset = None
+        # MQTT config topic: solarflow-hub/<device>/control/sunsetOffset
+        # config.ini [control] sunset_offset
+        self.sunsetOffset = None
+
+        # Location Info
+        self.latitude = config.getfloat("global", "latitude", fallback=None) or float(os.environ.get("LATITUDE", 0))
+        self.longitude = config.getfloat("global", "longitude", fallback=None) or float(os.environ.get("LONGITUDE", 0))
+        self.location: LocationInfo = None
+
+        # set up by start()
+        self.client: mqtt_client = None
+        self.router: TopicRouter = None
+        self.hub = None
+        self.dtu = None
+        self.smartmeter = None
+        self.control: ControlWorker = None
+
+    def __str__(self):
+        return self.name or self.deviceId
+
+    def components(self) -> tuple:
+        return (self.hub, self.dtu, self.smartmeter)
+
+    def checkpointSection(self, name: str) -> str:
+        # sections of a single site keep their names, so its checkpoints stay valid when adding sites
+        return f"{self.name}.{name}" if self.name else name
+
+    def controlCheckpoint(self) -> dict:
+        return {
+            "sunriseOffset": self.sunriseOffset,
+            "sunsetOffset": self.sunsetOffset,
+            "minChargePower": self.minChargePower,
+            "maxDischargePower": self.maxDischargePower,
+            "dischargeDuringDaytime": self.dischargeDuringDaytime,
+            "batteryTargetSoCMin": self.batteryLow,
+            "batteryTargetSoCMax": self.batteryHigh,
+        }
+
+    def restoreControl(self, state: dict, age: float):
+        """Restores the control parameters as last used, the retained ones in MQTT still take precedence"""
+        self.sunriseOffset = state["sunriseOffset"]
+        self.sunsetOffset = state["sunsetOffset"]
+        self.minChargePower = state["minChargePower"]
+        self.maxDischargePower = state["maxDischargePower"]
+        self.dischargeDuringDaytime = state["dischargeDuringDaytime"]
+        self.batteryLow = state["batteryTargetSoCMin"]
+        self.batteryHigh = state["batteryTargetSoCMax"]
+
+    def locationCheckpoint(self) -> dict:
+        # only a detected location is worth caching
+        if self.location and (self.location.latitude or self.location.longitude):
+            return {"latitude": self.location.latitude, "longitude": self.location.longitude}
+
+    def restoreLocation(self, state: dict, age: float):
+        """Uses the location detected on a previous start, unless coordinates are configured"""
+        if self.location is None:
+            self.location = LocationInfo(
+                timezone="Europe/Berlin", latitude=state["latitude"], longitude=state["longitude"]
+            )
+            log.info(f"Using cached location of {self}: {self.location.latitude}, {self.location.longitude}")
+
+
+def loadSites() -> list:
+    if not SITES:
+        return [Site(config)]
+    paths = [path.strip() for path in SITES.split(",") if path.strip()]
+    return [Site(load_config(path), os.path.splitext(os.path.basename(path))[0]) for path in paths]
 
-# interval/rate limit for performing control steps
-steering_interval = config.getint("control", "steering_interval", fallback=None) or int(
-    os.environ.get("STEERING_INTERVAL", 15)
-)
 
-# flag, which can be set to allow discharging the battery during daytime
-# MQTT config topic: solarflow-hub/control/dischargeDuringDaytime
-# config.ini [control] discharge_during_daytime
-DISCHARGE_DURING_DAYTIME = None
+sites = loadSites()
 
-# Adjustments possible to sunrise and sunset offset
-# MQTT config topic: solarflow-hub/control/sunriseOffset
-# config.ini [control] sunrise_offset
-SUNRISE_OFFSET = None
-# MQTT config topic: solarflow-hub/control/sunsetOffset
-# config.ini [control] sunset_offset
-SUNSET_OFFSET = None
 
-# Location Info
-LAT = config.getfloat("global", "latitude", fallback=None) or float(os.environ.get("LATITUDE", 0))
-LNG = config.getfloat("global", "longitude", fallback=None) or float(os.environ.get("LONGITUDE", 0))
-location: LocationInfo
+def siteOf(device_id: str) -> Site:
+    return next((site for site in sites if site.deviceId == device_id), None)
 
-lastTriggerTS: datetime = None
+
+# triggers arriving within this time (seconds) are merged into one control cycle
+TRIGGER_DEBOUNCE = 0.5
+
+# file to record all inbound MQTT messages to (for replay.py), option --record
+RECORD = None
+recorder: Recorder = None
+
+checkpointer: Checkpointer = None
+# the retained control parameters are complete once none arrived for CONFIG_QUIET seconds after the subscription was
+# acknowledged, waiting at most STARTUP_DELAY seconds
+STARTUP_DELAY = 10
+CONFIG_QUIET = 0.3
+config_pending = set()
+config_last = 0.0
+# seconds to wait for the IP based geolocation
+LOCATION_TIMEOUT = 2
 
 
 class MyLocation:
     def getCoordinates(self) -> tuple:
         lat = lon = 0.0
         try:
-            result = requests.get("http://ip-api.com/json/")  # call without IP uses my IP
+            # only needed here, when the location isn't configured or cached
+            import requests
+
+            result = requests.get("http://ip-api.com/json/", timeout=LOCATION_TIMEOUT)  # call without IP uses my IP
             response = result.json()
             log.info(f"IP Address: {response['query']}")
             log.info(f"Location: {response['city']}, {response['regionName']}, {response['country']}")
@@ -138,8 +289,7 @@ class MyLocation:
             lon = response["lon"]
         except Exception as e:
             log.error(
-                f"Can't determine location from my IP. Location detection failed, no accurate sunrise/sunset detection possible",
-                e.args,
+                f"Can't determine location from my IP ({e}). Location detection failed, no accurate sunrise/sunset detection possible"
             )
 
         return (lat, lon)
@@ -147,83 +297,71 @@ class MyLocation:
 
 def on_config_message(client, userdata, msg):
     """The MQTT client callback function for intial connects - mainly retained messages, where we are not yet fully up and running but still read potential config parameters from MQTT"""
-
-    global \
-        SUNRISE_OFFSET, \
-        SUNSET_OFFSET, \
-        MIN_CHARGE_POWER, \
-        MAX_DISCHARGE_POWER, \
-        DISCHARGE_DURING_DAYTIME, \
-        BATTERY_LOW, \
-        BATTERY_HIGH
-    # handle own messages (control parameters)
-    if msg.topic.startswith("solarflow-hub") and "control" in msg.topic and msg.payload:
-        parameter = msg.topic.split("/")[-1]
+    global config_last
+    config_last = clock.monotonic()
+    recorder and recorder.record(msg.topic, msg.payload)
+    # handle own messages (control parameters), solarflow-hub/<device>/control/<parameter>
+    levels = msg.topic.split("/")
+    site = siteOf(levels[1]) if len(levels) > 3 and levels[0] == "solarflow-hub" and levels[2] == "control" else None
+    if site and msg.payload:
+        parameter = levels[-1]
         value = msg.payload.decode()
         match parameter:
             case "sunriseOffset":
-                SUNRISE_OFFSET = int(value)
-                log.info(f"Found control/sunriseOffset, set SUNRISE_OFFSET to {SUNRISE_OFFSET} minutes")
+                site.sunriseOffset = int(value)
+                log.info(f"Found control/sunriseOffset, set SUNRISE_OFFSET to {site.sunriseOffset} minutes")
             case "sunsetOffset":
-                SUNSET_OFFSET = int(value)
-                log.info(f"Found control/sunsetOffset, set SUNSET_OFFSET to {SUNSET_OFFSET} minutes")
+                site.sunsetOffset = int(value)
+                log.info(f"Found control/sunsetOffset, set SUNSET_OFFSET to {site.sunsetOffset} minutes")
             case "minChargePower":
-                MIN_CHARGE_POWER = int(value)
-                log.info(f"Found control/minChargePower, set MIN_CHARGE_POWER to {MIN_CHARGE_POWER}W")
+                site.minChargePower = int(value)
+                log.info(f"Found control/minChargePower, set MIN_CHARGE_POWER to {site.minChargePower}W")
             case "maxDischargePower":
-                MAX_DISCHARGE_POWER = int(value)
-                log.info(f"Found control/maxDiscahrgePiwer, set MAX_DISCHARGE_POWER to {MAX_DISCHARGE_POWER}W")
+                site.maxDischargePower = int(value)
+                log.info(f"Found control/maxDiscahrgePiwer, set MAX_DISCHARGE_POWER to {site.maxDischargePower}W")
             case "dischargeDuringDaytime":
-                DISCHARGE_DURING_DAYTIME = str2bool(value)
+                site.dischargeDuringDaytime = str2bool(value)
                 log.info(
-                    f"Found control/dischargeDuringDaytime, set DISCHARGE_DURING_DAYTIME to {DISCHARGE_DURING_DAYTIME}"
+                    f"Found control/dischargeDuringDaytime, set DISCHARGE_DURING_DAYTIME to {site.dischargeDuringDaytime}"
                 )
             case "batteryTargetSoCMin":
-                BATTERY_LOW = int(value)
-                log.info(f"Found control/batteryTargetSoCMin, set BATTERY_LOW to {BATTERY_LOW}%")
+                site.batteryLow = int(value)
+                log.info(f"Found control/batteryTargetSoCMin, set BATTERY_LOW to {site.batteryLow}%")
             case "batteryTargetSoCMax":
-                BATTERY_HIGH = int(value)
-                log.info(f"Found control/batteryTargetSoCMax, set BATTERY_HIGH to {BATTERY_HIGH}%")
+                site.batteryHigh = int(value)
+                log.info(f"Found control/batteryTargetSoCMax, set BATTERY_HIGH to {site.batteryHigh}%")
 
 
 def on_message(client, userdata, msg):
-    """The MQTT client callback function for continous oepration, messages are delegated to hub, dtu and smartmeter handlers as well as own control parameter updates"""
-    global \
-        SUNRISE_OFFSET, \
-        SUNSET_OFFSET, \
-        MIN_CHARGE_POWER, \
-        MAX_DISCHARGE_POWER, \
-        DISCHARGE_DURING_DAYTIME, \
-        BATTERY_LOW, \
-        BATTERY_HIGH, \
-        BATTERY_DISCHARGE_START
-    # delegate message handling to hub,smartmeter, dtu
-    smartmeter = userdata["smartmeter"]
-    smartmeter.handleMsg(msg)
-    hub = userdata["hub"]
-    hub.handleMsg(msg)
-    dtu = userdata["dtu"]
-    dtu.handleMsg(msg)
+    """The MQTT client callback function for continous oepration, messages are routed to the hub, dtu and smartmeter handlers of all sites as well as own control parameter updates"""
+    recorder and recorder.record(msg.topic, msg.payload)
+    userdata["router"].dispatch(msg)
+
+
+def on_control_message(site: Site, msg, metric):
+    """Handles updates of our own control parameters during continous operation"""
+    hub = site.hub
 
     # handle own messages (control parameters)
-    if msg.topic.startswith("solarflow-hub") and "control" in msg.topic and msg.payload:
-        parameter = msg.topic.split("/")[-1]
+    if msg.payload:
         value = msg.payload.decode()
-        match parameter:
+        match metric:
             case "sunriseOffset":
-                log.info(f"Updating SUNRISE_OFFSET to {int(value)} minutes") if SUNRISE_OFFSET != int(value) else None
-                SUNRISE_OFFSET = int(value)
+                log.info(f"Updating SUNRISE_OFFSET to {int(value)} minutes") if site.sunriseOffset != int(
+                    value
+                ) else None
+                site.sunriseOffset = int(value)
             case "sunsetOffset":
-                log.info(f"Updating SUNSET_OFFSET to {int(value)} minutes") if SUNSET_OFFSET != int(value) else None
-                SUNSET_OFFSET = int(value)
+                log.info(f"Updating SUNSET_OFFSET to {int(value)} minutes") if site.sunsetOffset != int(value) else None
+                site.sunsetOffset = int(value)
             case "minChargePower":
-                log.info(f"Updating MIN_CHARGE_POWER to {int(value)}W") if MIN_CHARGE_POWER != int(value) else None
-                MIN_CHARGE_POWER = int(value)
+                log.info(f"Updating MIN_CHARGE_POWER to {int(value)}W") if site.minChargePower != int(value) else None
+                site.minChargePower = int(value)
             case "maxDischargePower":
-                log.info(f"Updating MAX_DISCHARGE_POWER to {int(value)}W") if MAX_DISCHARGE_POWER != int(
+                log.info(f"Updating MAX_DISCHARGE_POWER to {int(value)}W") if site.maxDischargePower != int(
                     value
                 ) else None
-                MAX_DISCHARGE_POWER = int(value)
+                site.maxDischargePower = int(value)
             case "controlBypass":
                 log.info(f"Updating control bypass to {value}")
                 hub.setControlBypass(value)
@@ -233,21 +371,27 @@ def on_message(client, userdata, msg):
             case "dischargeDuringDaytime":
                 log.info(
                     f"Updating DISCHARGE_DURING_DAYTIME to {str2bool(value)}"
-                ) if DISCHARGE_DURING_DAYTIME != str2bool(value) else None
-                DISCHARGE_DURING_DAYTIME = str2bool(value)
+                ) if site.dischargeDuringDaytime != str2bool(value) else None
+                site.dischargeDuringDaytime = str2bool(value)
             case "batteryDischargeStart":
-                log.info(f"Updating BATTERY_DISCHARGE_START to {int(value)}W") if BATTERY_DISCHARGE_START != int(
+                log.info(f"Updating BATTERY_DISCHARGE_START to {int(value)}W") if site.batteryDischargeStart != int(
                     value
                 ) else None
-                BATTERY_DISCHARGE_START = int(value)
+                site.batteryDischargeStart = int(value)
             case "batteryTargetSoCMin":
-                log.info(f"Updating BATTERY_LOW to {int(value)}%") if BATTERY_LOW != int(value) else None
-                BATTERY_LOW = int(value)
-                hub.updBatteryTargetSoCMin(BATTERY_LOW)
+                log.info(f"Updating BATTERY_LOW to {int(value)}%") if site.batteryLow != int(value) else None
+                site.batteryLow = int(value)
+                hub.updBatteryTargetSoCMin(site.batteryLow)
             case "batteryTargetSoCMax":
-                log.info(f"Updating BATTERY_HIGH to {int(value)}%") if BATTERY_HIGH != int(value) else None
-                BATTERY_HIGH = int(value)
-                hub.updBatteryTargetSoCMax(BATTERY_HIGH)
+                log.info(f"Updating BATTERY_HIGH to {int(value)}%") if site.batteryHigh != int(value) else None
+                site.batteryHigh = int(value)
+                hub.updBatteryTargetSoCMax(site.batteryHigh)
+            case "dumpDecisions":
+                # the payload is the number of seconds to dump, 0 for the whole decision log
+                seconds = int(value)
+                dump = site.decisionLog.dump(clock.time() - seconds if seconds > 0 else None)
+                site.client.publish(f"solarflow-hub/{hub.deviceId}/decisions", dump)
+                log.info(f"Published {len(dump.splitlines())} decision log records")
 
 
 def on_connect(client, userdata, flags, rc):
@@ -257,6 +401,13 @@ def on_connect(client, userdata, flags, rc):
         log.error("Failed to connect, return code %d\n", rc)
 
 
+def on_subscribe(client, userdata, mid, granted_qos):
+    global config_last
+    # the broker sends the retained messages of a subscription right after acknowledging it
+    config_pending.discard(mid)
+    config_last = clock.monotonic()
+
+
 def on_disconnect(client, userdata, rc):
     if rc == 0:
         log.info("Disconnected from MQTT Broker on purpose!")
@@ -264,118 +415,127 @@ def on_disconnect(client, userdata, rc):
         log.error("Disconnected from MQTT broker!")
 
 
-def connect_mqtt() -> mqtt_client:
+def connect_mqtt(runtime: "AsyncRuntime | None" = None) -> mqtt_client:
     client_id = f"solarflow-ctrl-{random.randint(0, 100)}"
     client = mqtt_client.Client(client_id=client_id, clean_session=False)
     if mqtt_user is not None and mqtt_pwd is not None:
         client.username_pw_set(mqtt_user, mqtt_pwd)
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
+    client.on_subscribe = on_subscribe
     client.on_message = on_config_message
+    # with the asyncio runtime the event loop drives the client's socket
+    runtime and runtime.attach(client)
     client.connect(mqtt_host, mqtt_port)
     return client
 
 
 def subscribe(client: mqtt_client):
-    topics = [f"solarflow-hub/{sf_device_id}/control/#"]
+    topics = [f"solarflow-hub/{site.deviceId}/control/#" for site in sites]
     for t in topics:
-        client.subscribe(t)
+        rc, mid = client.subscribe(t)
+        config_pending.add(mid)
         log.info(f"SF Control subscribing: {t}")
 
 
-def limitedRise(x) -> int:
-    rise = MAX_INVERTER_LIMIT - (MAX_INVERTER_LIMIT - INVERTER_START_LIMIT) * math.exp(-MAX_INVERTER_LIMIT / 100000 * x)
-    log.info(f"Adjusting inverter limit from {x:.1f}W to {rise:.1f}W")
+def limitedRise(site: Site, x) -> int:
+    limit = site.maxInverterLimit
+    rise = limit - (limit - INVERTER_START_LIMIT) * math.exp(-limit / 100000 * x)
+    logs.SUMMARY or log.info(f"Adjusting inverter limit from {x:.1f}W to {rise:.1f}W")
     return int(rise)
 
 
 # calculate the safe inverter limit for direct panels, to avoid output over legal limits
-def getDirectPanelLimit(inv, hub, smt) -> int:
+def getDirectPanelLimit(site: Site, snap: ControlSnapshot) -> int:
     # if hub is in bypass mode we can treat it just like a direct panel
-    direct_panel_power = inv.getDirectACPower() + (inv.getHubACPower() if hub.getBypass() else 0)
-    if direct_panel_power < MAX_INVERTER_LIMIT:
-        dc_values = (
-            (inv.getDirectDCPowerValues() + inv.getHubDCPowerValues())
-            if hub.getBypass()
-            else inv.getDirectDCPowerValues()
-        )
+    direct_panel_power = snap.directACPower + (snap.hubACPower if snap.hub.bypass else 0)
+    if direct_panel_power < site.maxInverterLimit:
+        dc_values = (snap.directDCPowerValues + snap.hubDCPowerValues) if snap.hub.bypass else snap.directDCPowerValues
         return (
-            math.ceil(max(dc_values) * (inv.getEfficiency() / 100))
-            if smt.getPower() - smt.zero_offset < 0
-            else limitedRise(max(dc_values) * (inv.getEfficiency() / 100))
+            math.ceil(max(dc_values) * snap.efficiency)
+            if snap.gridPower < 0
+            else limitedRise(site, max(dc_values) * snap.efficiency)
         )
     else:
-        return int(MAX_INVERTER_LIMIT * (inv.getNrHubChannels() / inv.getNrProducingChannels()))
+        return int(site.maxInverterLimit * (snap.nrHubChannels / snap.nrProducingChannels))
 
 
-def getSFPowerLimit(hub, demand) -> int:
-    hub_electricLevel = hub.getElectricLevel()
-    hub_solarpower = hub.getSolarInputPower()
-    now = datetime.now(tz=location.tzinfo)
+def getSFPowerLimit(site: Site, snap: ControlSnapshot, demand, path: list) -> (int, ControlSnapshot):
+    """What the site's hub could contribute to the demand, decided on the snapshot. Returns the limit and the
+    snapshot, which reflects it if the bypass has been turned off. The decisions taken are appended to path"""
+    hub = site.hub
+    location = site.location
+    hub_electricLevel = snap.hub.electricLevel
+    hub_solarpower = snap.hub.solarInputPower
+    now = clock.now(tz=location.tzinfo)
     s = sun(location.observer, date=now, tzinfo=location.timezone)
     sunrise = s["sunrise"]
     sunset = s["sunset"]
-    path = ""
 
-    sunrise_off = timedelta(minutes=SUNRISE_OFFSET)
-    sunset_off = timedelta(minutes=SUNSET_OFFSET)
+    sunrise_off = timedelta(minutes=site.sunriseOffset)
+    sunset_off = timedelta(minutes=site.sunsetOffset)
 
     # fallback in case byPass is not yet identifieable after a change (HUB2k)
-    limit = hub.getLimit()
+    limit = snap.hub.outputLimit
 
     # if the hub is currently in bypass mode we don't really worry about any limit
-    if hub.getBypass():
-        path += "0."
+    if snap.hub.bypass:
+        path.append(Decision.BYPASS)
         # leave bypass after sunset/offset
         if (
             (now < (sunrise + sunrise_off) or now > sunset - sunset_off)
-            and hub.control_bypass
+            and snap.hub.control_bypass
             and demand > hub_solarpower
         ):
             hub.allowBypass(False)
             hub.setBypass(False)
-            path += "1."
+            # we don't wait for the hub to confirm turning bypass off, continue as if it was off
+            snap = snap.replace(hub=snap.hub.replace(bypass=False))
+            path.append(Decision.BYPASS_LEAVE)
         else:
-            path += "2."
-            limit = hub.getInverseMaxPower()
-
-    if not hub.getBypass():
-        path += "1."
-        limit = min(demand, MAX_DISCHARGE_POWER)
-        if hub_solarpower - demand > MIN_CHARGE_POWER:
-            if hub_solarpower - MIN_CHARGE_POWER < MAX_DISCHARGE_POWER:
-                path += "1. (enough power to cover demand and minimum charge power)"
+            path.append(Decision.BYPASS_KEEP)
+            limit = snap.hub.inverseMaxPower
+
+    if not snap.hub.bypass:
+        path.append(Decision.HUB)
+        limit = min(demand, site.maxDischargePower)
+        if hub_solarpower - demand > site.minChargePower:
+            if hub_solarpower - site.minChargePower < site.maxDischargePower:
+                path.append(Decision.SURPLUS)
                 # limit = min(demand,MAX_DISCHARGE_POWER)
             else:
-                path += "2."
-                limit = min(demand, hub_solarpower - MIN_CHARGE_POWER)
-        if hub_solarpower - demand <= MIN_CHARGE_POWER:
-            path += "3."
+                path.append(Decision.SURPLUS_CAPPED)
+                limit = min(demand, hub_solarpower - site.minChargePower)
+        if hub_solarpower - demand <= site.minChargePower:
+            path.append(Decision.DEFICIT)
             if (
-                (now < (sunrise + sunrise_off) or now > (sunset - sunset_off)) or DISCHARGE_DURING_DAYTIME
+                (now < (sunrise + sunrise_off) or now > (sunset - sunset_off)) or site.dischargeDuringDaytime
             ) and (  # before sunrise window end or after sunset window begin
-                hub.daySoCIncrease > BATTERY_DISCHARGE_START  # battery has charged enough (during previous day)
+                snap.hub.daySoCIncrease > site.batteryDischargeStart  # battery has charged enough (during previous day)
                 or hub_electricLevel
-                > hub.batteryLow + BATTERY_DISCHARGE_START  # battery is still higher than min+discharge start level
+                > snap.hub.batteryLow
+                + site.batteryDischargeStart  # battery is still higher than min+discharge start level
             ):
-                path += "1. (not enough power to cover demand and minimum charge power during night/dusk/dawn)"
+                path.append(Decision.DISCHARGE_NIGHT)
             elif (sunrise < now < sunrise + sunrise_off) and (  # after sunrise, during sunrise window
-                hub.sunriseSoC > hub.batteryLow  # battery hasn't reached minimum
-                or hub.daySoCIncrease
-                > BATTERY_DISCHARGE_START  # battery has already charged more than necessary since sunrise
+                snap.hub.sunriseSoC > snap.hub.batteryLow  # battery hasn't reached minimum
+                or snap.hub.daySoCIncrease
+                > site.batteryDischargeStart  # battery has already charged more than necessary since sunrise
                 or hub_electricLevel
-                > hub.batteryLow + BATTERY_DISCHARGE_START  # battery is still higher than min+discharge start level
+                > snap.hub.batteryLow
+                + site.batteryDischargeStart  # battery is still higher than min+discharge start level
             ):
-                path += "2. (enough battery after sunrise to continue discharge)"
-                if hub.force_drain:
+                path.append(Decision.DISCHARGE_SUNRISE)
+                if snap.hub.force_drain:
                     log.info(
                         f"We are trying to reach a full-cycle discharge due to charge-through, we should force draining the battery of the remaining {hub_electricLevel}"
                     )
             else:
-                path += "3. (not enough power to cover demand and minimum charge power during day)"
+                path.append(Decision.NO_DISCHARGE)
                 limit = 0
 
         if demand < 0:
+            path.append(Decision.NO_DEMAND)
             limit = 0
 
     # get battery Soc at sunset/sunrise
@@ -385,22 +545,25 @@ def getSFPowerLimit(hub, demand) -> int:
     if now > sunrise and now < sunrise + td:
         hub.setSunriseSoC(hub_electricLevel)
         log.info(f"Good morning! We have consumed {hub.getNightConsumption()}% of the battery tonight!")
-        ts = int(time.time())
+        ts = int(clock.time())
         log.info(f"Syncing time of solarflow hub (UTC): {datetime.fromtimestamp(ts).strftime('%Y-%m-%d, %H:%M:%S')}")
         hub.timesync(ts)
         hub.publishBatteryTarget(solarflow.BATTERY_TARGET_CHARGING)
 
         # sometimes bypass resets to default (auto)
-        if hub.control_bypass:
+        if snap.hub.control_bypass:
             hub.allowBypass(True)
             hub.setBypass(False)
             hub.setAutorecover(False)
+            snap = snap.replace(hub=snap.hub.replace(bypass=False))
 
         # reset the dayly SoC increase
         hub.resetSocIncrease()
 
-    log.info(
-        f"Based on time, solarpower ({hub_solarpower:4.1f}W) minimum charge power ({MIN_CHARGE_POWER}W) and bypass state ({hub.getBypass()}), hub could contribute {limit:4.1f}W - Decision path: {path}"
+    steps = pathString(path)
+    metrics.decisions.inc(steps.split(" (")[0])
+    logs.SUMMARY or log.info(
+        f"Based on time, solarpower ({hub_solarpower:4.1f}W) minimum charge power ({site.minChargePower}W) and bypass state ({snap.hub.bypass}), hub could contribute {limit:4.1f}W - Decision path: {steps}"
     )
 
     if now > sunrise + sunrise_off and now < sunrise + sunrise_off + td:
@@ -410,58 +573,85 @@ def getSFPowerLimit(hub, demand) -> int:
         # check if we should run a full charge cycle today
         hub.checkChargeThrough(daylight)
 
-    return int(limit)
+    return int(limit), snap
+
 
+def takeSnapshot(site: Site) -> ControlSnapshot:
+    # no message is applied while the snapshot is taken
+    with site.router.lock:
+        return ControlSnapshot(
+            site.hub.snapshot(text=not logs.SUMMARY),
+            site.dtu.snapshot(text=not logs.SUMMARY),
+            site.smartmeter.snapshot(text=not logs.SUMMARY),
+        )
 
-def limitHomeInput(client: mqtt_client):
-    global location
 
-    hub = client._userdata["hub"]
-    log.info(f"{hub}")
-    inv = client._userdata["dtu"]
-    log.info(f"{inv}")
-    smt = client._userdata["smartmeter"]
-    log.info(f"{smt}")
-    log.info(
-        f"{blue}SFC: BatteryTarget: {hub.batteryTarget}, SoC at sunrise: {hub.sunriseSoC}, SoC increase: {hub.daySoCIncrease}{reset}"
+def limitHomeInput(site: Site):
+    hub = site.hub
+    inv = site.dtu
+    location = site.location
+    # all decisions of this cycle are made on one consistent snapshot, the components are only used to set limits
+    snap = takeSnapshot(site)
+    logs.SUMMARY or log.info(f"{snap.hub}")
+    logs.SUMMARY or log.info(f"{snap.dtu}")
+    logs.SUMMARY or log.info(f"{snap.smt}")
+    logs.SUMMARY or log.info(
+        f"{blue}SFC: BatteryTarget: {snap.hub.batteryTarget}, SoC at sunrise: {snap.hub.sunriseSoC}, SoC increase: {snap.hub.daySoCIncrease}{reset}"
     )
 
     # ensure we have data to work on
-    if not (hub.ready() and inv.ready() and smt.ready()):
+    if not snap.ready():
+        site.decisionLog.record(None, [Decision.NOT_READY], None)
+        logs.SUMMARY and logs.event(log, "Control cycle", **siteField(site), path=Decision.NOT_READY.name)
         return
 
-    inv_limit = inv.getLimit()
-    hub_limit = hub.getLimit()
+    inv_limit = snap.dtu.limitAbsolute
+    hub_limit = snap.hub.outputLimit
     direct_limit = None
+    sf_contribution = None
+    path = []
 
     # convert DC Power into AC power by applying current efficiency for more precise calculations
-    direct_panel_power = inv.getDirectDCPower() * (inv.getEfficiency() / 100)
+    direct_panel_power = snap.directACPower
     # consider DC power of panels below 10W as 0 to avoid fluctuation in very low light.
     direct_panel_power = 0 if direct_panel_power < 10 else direct_panel_power
 
-    hub_power = inv.getHubDCPower() * (inv.getEfficiency() / 100)
+    hub_power = snap.hubACPower
 
-    grid_power = smt.getPower() - smt.zero_offset
-    inv_acpower = inv.getCurrentACPower()
+    grid_power = snap.gridPower
 
     demand = grid_power + direct_panel_power + hub_power
 
     remainder = demand - direct_panel_power - hub_power  # eq grid_power
     hub_contribution_ask = hub_power + remainder  # the power we need from hub
     hub_contribution_ask = 0 if hub_contribution_ask < 0 else hub_contribution_ask
+    inputs = (
+        grid_power,
+        direct_panel_power,
+        hub_power,
+        demand,
+        snap.hub.solarInputPower,
+        snap.hub.electricLevel,
+        snap.hub.bypass,
+        hub_limit,
+        inv_limit,
+    )
 
     # sunny, producing
     if direct_panel_power > 0:
         if demand < direct_panel_power:
             # we can conver demand with direct panel power, just use all of it
-            log.info(f"Direct connected panels ({direct_panel_power:.1f}W) can cover demand ({demand:.1f}W)")
+            logs.SUMMARY or log.info(
+                f"Direct connected panels ({direct_panel_power:.1f}W) can cover demand ({demand:.1f}W)"
+            )
             # direct_limit = getDirectPanelLimit(inv,hub,smt)
             # keep inverter limit where it is, no need to change
-            direct_limit = getDirectPanelLimit(inv, hub, smt)
+            path.append(Decision.DIRECT_COVERS)
+            direct_limit = getDirectPanelLimit(site, snap)
             hub_limit = hub.setOutputLimit(0)
         else:
             # we need contribution from hub, if possible and/or try to get more from direct panels
-            log.info(
+            logs.SUMMARY or log.info(
                 f"Direct connected panels ({direct_panel_power:.1f}W) can't cover demand ({demand:.1f}W), trying to get {hub_contribution_ask:.1f}W from hub."
             )
             if hub_contribution_ask > 5:
@@ -469,62 +659,63 @@ def limitHomeInput(client: mqtt_client):
                 # if the direct channel power is below what is theoretically possible, it is worth trying to increase the limit
 
                 # if the max of direct channel power is close to the channel limit we should increase the limit first to eventually get more from direct panels
-                if inv.isWithin(
-                    max(inv.getDirectDCPowerValues()) * (inv.getEfficiency() / 100),
-                    inv.getChannelLimit(),
-                    10 * inv.getNrTotalChannels(),
-                ):
-                    log.info(
-                        f"The current max direct channel power {(max(inv.getDirectDCPowerValues()) * (inv.getEfficiency() / 100)):.1f}W is close to the current channel limit {inv.getChannelLimit():.1f}W, trying to get more from direct panels."
+                if snap.isWithin(snap.maxDirectACPower, snap.channelLimit, 10 * snap.nrTotalChannels):
+                    logs.SUMMARY or log.info(
+                        f"The current max direct channel power {snap.maxDirectACPower:.1f}W is close to the current channel limit {snap.channelLimit:.1f}W, trying to get more from direct panels."
                     )
+                    path.append(Decision.DIRECT_NEAR_LIMIT)
 
-                    sf_contribution = getSFPowerLimit(hub, hub_contribution_ask)
-                    hub_limit = hub.getLimit()
+                    sf_contribution, snap = getSFPowerLimit(site, snap, hub_contribution_ask, path)
+                    hub_limit = snap.hub.outputLimit
                     # in case of hub contribution ask has changed to lower than current value, we should lower it
                     if sf_contribution < hub_limit:
                         hub.setOutputLimit(sf_contribution)
-                    direct_limit = getDirectPanelLimit(inv, hub, smt)
+                    direct_limit = getDirectPanelLimit(site, snap)
                 else:
                     # check what hub is currently  willing to contribute
-                    sf_contribution = getSFPowerLimit(hub, hub_contribution_ask)
+                    sf_contribution, snap = getSFPowerLimit(site, snap, hub_contribution_ask, path)
 
                     # would the hub's contribution plus direct panel power cross the AC limit? If yes only contribute up to the limit
-                    if sf_contribution * (inv.getEfficiency() / 100) + direct_panel_power > inv.acLimit:
-                        log.info(
-                            f"Hub could contribute {sf_contribution:.1f}W, but this would exceed the configured AC limit ({inv.acLimit}W), so only asking for {inv.acLimit - direct_panel_power:.1f}W"
+                    if sf_contribution * snap.efficiency + direct_panel_power > snap.dtu.acLimit:
+                        logs.SUMMARY or log.info(
+                            f"Hub could contribute {sf_contribution:.1f}W, but this would exceed the configured AC limit ({snap.dtu.acLimit}W), so only asking for {snap.dtu.acLimit - direct_panel_power:.1f}W"
                         )
-                        sf_contribution = inv.acLimit - direct_panel_power
+                        sf_contribution = snap.dtu.acLimit - direct_panel_power
+                        path.append(Decision.AC_LIMIT)
 
                     # if the hub's contribution (per channel) is larger than what the direct panels max is delivering (night, low light)
                     # then we can open the hub to max limit and use the inverter to limit it's output (more precise)
-                    if sf_contribution / inv.getNrHubChannels() >= max(inv.getDirectDCPowerValues()) * (
-                        inv.getEfficiency() / 100
-                    ):
-                        log.info(
-                            f"Hub should contribute more ({sf_contribution:.1f}W) than what we currently get max from panels ({max(inv.getDirectDCPowerValues()) * (inv.getEfficiency() / 100):.1f}W), we will use the inverter for fast/precise limiting!"
+                    if sf_contribution / snap.nrHubChannels >= snap.maxDirectACPower:
+                        logs.SUMMARY or log.info(
+                            f"Hub should contribute more ({sf_contribution:.1f}W) than what we currently get max from panels ({snap.maxDirectACPower:.1f}W), we will use the inverter for fast/precise limiting!"
                         )
+                        path.append(Decision.INVERTER_LIMITS)
                         hub_limit = (
-                            hub.setOutputLimit(0) if hub.getBypass() else hub.setOutputLimit(hub.getInverseMaxPower())
+                            hub.setOutputLimit(0) if snap.hub.bypass else hub.setOutputLimit(snap.hub.inverseMaxPower)
                         )
-                        direct_limit = sf_contribution / inv.getNrHubChannels()
+                        direct_limit = sf_contribution / snap.nrHubChannels
                     else:
-                        hub_limit = hub.setOutputLimit(0) if hub.getBypass() else hub.setOutputLimit(sf_contribution)
-                        log.info(
+                        path.append(Decision.HUB_LIMITS)
+                        hub_limit = hub.setOutputLimit(0) if snap.hub.bypass else hub.setOutputLimit(sf_contribution)
+                        logs.SUMMARY or log.info(
                             f"Hub is willing to contribute {min(hub_limit, hub_contribution_ask):.1f}W of the requested {hub_contribution_ask:.1f}!"
                         )
-                        direct_limit = getDirectPanelLimit(inv, hub, smt)
-                        log.info(f"Direct connected panel limit is {direct_limit}W.")
+                        direct_limit = getDirectPanelLimit(site, snap)
+                        logs.SUMMARY or log.info(f"Direct connected panel limit is {direct_limit}W.")
+            else:
+                path.append(Decision.ASK_TOO_SMALL)
 
     # likely no sun, not producing, eveything comes from hub
     else:
-        log.info(
+        logs.SUMMARY or log.info(
             f"Direct connected panel are producing {direct_panel_power:.1f}W, trying to get {hub_contribution_ask:.1f}W from hub."
         )
         # check what hub is currently  willing to contribute
-        sf_contribution = getSFPowerLimit(hub, hub_contribution_ask)
-        hub_limit = hub.setOutputLimit(hub.getInverseMaxPower())
-        direct_limit = sf_contribution / inv.getNrHubChannels()
-        log.info(
+        path.append(Decision.NO_DIRECT)
+        sf_contribution, snap = getSFPowerLimit(site, snap, hub_contribution_ask, path)
+        hub_limit = hub.setOutputLimit(snap.hub.inverseMaxPower)
+        direct_limit = sf_contribution / snap.nrHubChannels
+        logs.SUMMARY or log.info(
             f"Solarflow is willing to contribute {min(hub_limit, direct_limit):.1f}W (per channel) of the requested {hub_contribution_ask:.1f}!"
         )
 
@@ -533,34 +724,51 @@ def limitHomeInput(client: mqtt_client):
 
         if hub_limit > direct_limit > hub_limit - 10:
             limit = hub_limit - 10
-        if direct_limit < hub_limit - 10 and hub_limit < hub.getInverseMaxPower():
+        if direct_limit < hub_limit - 10 and hub_limit < snap.hub.inverseMaxPower:
             limit = hub_limit - 10
 
         inv_limit = inv.setLimit(limit)
 
+    site.decisionLog.record(inputs, path, (hub_contribution_ask, sf_contribution, hub_limit, direct_limit, inv_limit))
+    metrics.firstCycle()
+
+    # in summary mode a cycle is logged as one event
+    if logs.SUMMARY:
+        logs.event(
+            log,
+            "Control cycle",
+            **siteField(site),
+            grid=round(grid_power, 1),
+            direct=round(direct_panel_power, 1),
+            hub=round(hub_power, 1),
+            demand=round(demand, 1),
+            soc=snap.hub.electricLevel,
+            path=",".join(code.name for code in path),
+            hub_limit=hub_limit,
+            inverter_limit=inv_limit,
+        )
+        return
+
     if remainder < 0:
         source = f"unknown: {-remainder:.1f}"
-        if direct_panel_power == 0 and hub_power > 0 and hub.getDischargePower() > 0:
+        if direct_panel_power == 0 and hub_power > 0 and snap.hub.dischargePower > 0:
             source = f"battery: {-grid_power:.1f}W"
         # since we usually set the inverter limit not to zero there is always a little bit drawn from the hub (10-15W)
-        if direct_panel_power == 0 and hub_power > 15 and hub.getDischargePower() == 0 and not hub.getBypass():
+        if direct_panel_power == 0 and hub_power > 15 and snap.hub.dischargePower == 0 and not snap.hub.bypass:
             source = f"hub solarpower: {-grid_power:.1f}W"
-        if direct_panel_power > 0 and hub_power > 15 and hub.getDischargePower() == 0 and hub.getBypass():
+        if direct_panel_power > 0 and hub_power > 15 and snap.hub.dischargePower == 0 and snap.hub.bypass:
             source = f"hub bypass: {-grid_power:.1f}W"
         if direct_panel_power > 0 and hub_power < 15:
             source = f"panels connected directly to inverter: {-remainder:.1f}"
 
-        log.info(f"Grid feed in from {source}!")
+        logs.SUMMARY or log.info(f"Grid feed in from {source}!")
 
-    panels_dc = "|".join([f"{v:>2}" for v in inv.getDirectDCPowerValues()])
-    hub_dc = "|".join([f"{v:>2}" for v in inv.getHubDCPowerValues()])
-
-    now = datetime.now(tz=location.tzinfo)
+    now = clock.now(tz=location.tzinfo)
     s = sun(location.observer, date=now, tzinfo=location.timezone)
     sunrise = s["sunrise"]
     sunset = s["sunset"]
 
-    log.info(
+    logs.SUMMARY or log.info(
         " ".join(
             f"Sun: {sunrise.strftime('%H:%M')} - {sunset.strftime('%H:%M')} \
              Demand: {demand:.1f}W, \
@@ -572,9 +780,8 @@ def limitHomeInput(client: mqtt_client):
     )
 
 
-def getOpts(configtype) -> dict:
-    """Get the configuration options for a specific section from the global config.ini"""
-    global config
+def getOpts(config: configparser.ConfigParser, configtype) -> dict:
+    """Get the configuration options for a specific section from a site's config file"""
     opts = {}
     for opt, opt_type in configtype.opts.items():
         t = opt_type.__name__
@@ -588,131 +795,123 @@ def getOpts(configtype) -> dict:
     return opts
 
 
-def limit_callback(client: mqtt_client, force=False):
-    global lastTriggerTS
-    dtu = client._userdata["dtu"]
-    # log.info("Smartmeter Callback!")
-    now = datetime.now()
-    if lastTriggerTS:
-        elapsed = now - lastTriggerTS
-        # ensure the limit function is not called too often (avoid flooding DTUs)
-        if elapsed.total_seconds() >= steering_interval or force:
-            if force and dtu.hasPendingUpdate():
-                log.info(f"Force update blocked due to pending DTU update!")
-                return False
+def limit_callback(site: Site, client: mqtt_client, force=False, source: str = None):
+    dtu = site.dtu
+    # forced triggers skip the steering interval, but must not flood the DTU while it hasn't applied the last limit
+    if force and dtu.hasPendingUpdate():
+        log.info(f"Force update blocked due to pending DTU update!")
+        metrics.triggers.inc(source, "blocked")
+        return False
 
-            lastTriggerTS = now
-            limitHomeInput(client)
-            return True
+    # the cycle runs in the control worker, which also ensures the limit function is not called too often
+    queued = site.control.trigger(force=force, origin=tracing.triggered(source, force))
+    metrics.triggers.inc(source, "queued" if queued else "merged")
+    return queued
 
-        else:
-            return False
-    else:
-        lastTriggerTS = now
-        limitHomeInput(client)
-        return True
 
+def siteField(site: Site) -> dict:
+    # the site of summary events, if there are several
+    return {"site": site.name} if site.name else {}
 
-def deviceInfo(client: mqtt_client):
-    limitHomeInput(client)
 
+def deviceInfo():
+    log.info(f"Scheduled jobs: {' | '.join(str(job) for job in getScheduler().jobs if job.repeat)}")
+    for site in sites:
+        log.info(f"Hub property writes: {site.hub.writer}")
+        log.info(f"{site.hub.commands}")
+        log.info(f"{site.dtu.commands}")
+        log.info(f"{site.control}")
+        queued = site.control.trigger(force=True, origin=tracing.triggered("timer", True))
+        metrics.triggers.inc("timer", "queued" if queued else "merged")
 
-def updateConfigParams(client):
-    global \
-        config, \
-        DISCHARGE_DURING_DAYTIME, \
-        SUNRISE_OFFSET, \
-        SUNSET_OFFSET, \
-        MIN_CHARGE_POWER, \
-        MAX_DISCHARGE_POWER, \
-        BATTERY_HIGH, \
-        BATTERY_LOW
+
+def updateConfigParams(site: Site):
+    config = site.config
+    client = site.client
 
     # only update if configparameters haven't been updated/read from MQTT
-    if DISCHARGE_DURING_DAYTIME == None:
-        DISCHARGE_DURING_DAYTIME = config.getboolean("control", "discharge_during_daytime", fallback=None) or bool(
+    if site.dischargeDuringDaytime == None:
+        site.dischargeDuringDaytime = config.getboolean("control", "discharge_during_daytime", fallback=None) or bool(
             os.environ.get("DISCHARGE_DURING_DAYTIME", False)
         )
-        log.info(f"Updating DISCHARGE_DURING_DAYTIME from config file to {DISCHARGE_DURING_DAYTIME}")
+        log.info(f"Updating DISCHARGE_DURING_DAYTIME from config file to {site.dischargeDuringDaytime}")
         client.publish(
-            f"solarflow-hub/{sf_device_id}/control/dischargeDuringDaytime",
-            str(DISCHARGE_DURING_DAYTIME),
+            f"solarflow-hub/{site.deviceId}/control/dischargeDuringDaytime",
+            str(site.dischargeDuringDaytime),
             retain=True,
         )
 
-    if SUNRISE_OFFSET == None:
-        SUNRISE_OFFSET = config.getint("control", "sunrise_offset", fallback=60) or int(
+    if site.sunriseOffset == None:
+        site.sunriseOffset = config.getint("control", "sunrise_offset", fallback=60) or int(
             os.environ.get("SUNRISE_OFFSET", 60)
         )
-        log.info(f"Updating SUNRISE_OFFSET from config file to {SUNRISE_OFFSET} minutes")
+        log.info(f"Updating SUNRISE_OFFSET from config file to {site.sunriseOffset} minutes")
         client.publish(
-            f"solarflow-hub/{sf_device_id}/control/sunriseOffset",
-            SUNRISE_OFFSET,
+            f"solarflow-hub/{site.deviceId}/control/sunriseOffset",
+            site.sunriseOffset,
             retain=True,
         )
 
-    if SUNSET_OFFSET == None:
-        SUNSET_OFFSET = config.getint("control", "sunset_offset", fallback=60) or int(
+    if site.sunsetOffset == None:
+        site.sunsetOffset = config.getint("control", "sunset_offset", fallback=60) or int(
             os.environ.get("SUNSET_OFFSET", 60)
         )
-        log.info(f"Updating SUNSET_OFFSET from config file to {SUNSET_OFFSET} minutes")
+        log.info(f"Updating SUNSET_OFFSET from config file to {site.sunsetOffset} minutes")
         client.publish(
-            f"solarflow-hub/{sf_device_id}/control/sunsetOffset",
-            SUNSET_OFFSET,
+            f"solarflow-hub/{site.deviceId}/control/sunsetOffset",
+            site.sunsetOffset,
             retain=True,
         )
 
-    if MIN_CHARGE_POWER == None:
-        MIN_CHARGE_POWER = config.getint("control", "min_charge_power", fallback=None) or int(
+    if site.minChargePower == None:
+        site.minChargePower = config.getint("control", "min_charge_power", fallback=None) or int(
             os.environ.get("MIN_CHARGE_POWER", 0)
         )
-        log.info(f"Updating MIN_CHARGE_POWER from config file to {MIN_CHARGE_POWER}W")
+        log.info(f"Updating MIN_CHARGE_POWER from config file to {site.minChargePower}W")
         client.publish(
-            f"solarflow-hub/{sf_device_id}/control/minChargePower",
-            MIN_CHARGE_POWER,
+            f"solarflow-hub/{site.deviceId}/control/minChargePower",
+            site.minChargePower,
             retain=True,
         )
 
-    if MAX_DISCHARGE_POWER == None:
-        MAX_DISCHARGE_POWER = config.getint("control", "max_discharge_power", fallback=None) or int(
+    if site.maxDischargePower == None:
+        site.maxDischargePower = config.getint("control", "max_discharge_power", fallback=None) or int(
             os.environ.get("MAX_DISCHARGE_POWER", 145)
         )
-        log.info(f"Updating MAX_DISCHARGE_POWER from config file to {MAX_DISCHARGE_POWER}W")
+        log.info(f"Updating MAX_DISCHARGE_POWER from config file to {site.maxDischargePower}W")
         client.publish(
-            f"solarflow-hub/{sf_device_id}/control/maxDischargePower",
-            MAX_DISCHARGE_POWER,
+            f"solarflow-hub/{site.deviceId}/control/maxDischargePower",
+            site.maxDischargePower,
             retain=True,
         )
 
-    if BATTERY_LOW == None:
-        BATTERY_LOW = config.getint("control", "battery_low", fallback=None) or int(os.environ.get("BATTERY_LOW", 2))
-        log.info(f"Updating BATTERY_LOW from config file to {BATTERY_LOW}%")
+    if site.batteryLow == None:
+        site.batteryLow = config.getint("control", "battery_low", fallback=None) or int(
+            os.environ.get("BATTERY_LOW", 2)
+        )
+        log.info(f"Updating BATTERY_LOW from config file to {site.batteryLow}%")
         client.publish(
-            f"solarflow-hub/{sf_device_id}/control/batteryTargetSoCMin",
-            BATTERY_LOW,
+            f"solarflow-hub/{site.deviceId}/control/batteryTargetSoCMin",
+            site.batteryLow,
             retain=True,
         )
 
-    if BATTERY_HIGH == None:
-        BATTERY_HIGH = config.getint("control", "battery_high", fallback=None) or int(
+    if site.batteryHigh == None:
+        site.batteryHigh = config.getint("control", "battery_high", fallback=None) or int(
             os.environ.get("BATTERY_HIGH", 98)
         )
-        log.info(f"Updating BATTERY_HIGH from config file to {BATTERY_HIGH}%")
+        log.info(f"Updating BATTERY_HIGH from config file to {site.batteryHigh}%")
         client.publish(
-            f"solarflow-hub/{sf_device_id}/control/batteryTargetSoCMax",
-            BATTERY_HIGH,
+            f"solarflow-hub/{site.deviceId}/control/batteryTargetSoCMax",
+            site.batteryHigh,
             retain=True,
         )
 
 
-def run():
-    hub_opts = getOpts(solarflow.Solarflow)
-    dtuType = getattr(dtus, DTU_TYPE)
-    dtu_opts = getOpts(dtuType)
-    smtType = getattr(smartmeters, SMT_TYPE)
-    smt_opts = getOpts(smtType)
-
-    client = connect_mqtt()
+def connect(runtime: "AsyncRuntime | None" = None) -> mqtt_client:
+    global recorder
+    recorder = RECORD and Recorder(RECORD)
+    client = connect_mqtt(runtime)
     subscribe(client=client)
 
     log.info("Reading retained config settings from MQTT...")
@@ -722,48 +921,125 @@ def run():
     log.info(
         "If you want to override these values from your config.ini you need to clear those retained topics in your broker first!"
     )
+    return client
+
+
+def configReceived(started: float) -> bool:
+    """Whether the retained control parameters are complete (or restored from a checkpoint), parameters arriving
+    later are still applied by on_control_message"""
+    if checkpointer and all(site.checkpointSection("control") in checkpointer.restored for site in sites):
+        return True
+    waited = clock.monotonic() - started
+    if waited >= STARTUP_DELAY:
+        log.warning(f"Retained config settings not complete after {waited:.1f}s, continuing")
+        return True
+    if config_pending or clock.monotonic() - config_last < CONFIG_QUIET:
+        return False
+    log.info(f"Read retained config settings in {waited:.2f}s")
+    return True
+
+
+def run():
+    client = connect()
     client.loop_start()
-    time.sleep(10)
+    started = clock.monotonic()
+    while not configReceived(started):
+        time.sleep(0.05)
+    start(client)
+
+
+async def runAsync():
+    import asyncio
+    from aioruntime import AsyncRuntime
+
+    runtime = AsyncRuntime(asyncio.get_running_loop())
+    setScheduler(runtime.scheduler)
+    client = connect(runtime)
+    started = clock.monotonic()
+    while not configReceived(started):
+        await asyncio.sleep(0.05)
+    start(client, runtime)
+    await runtime.run()
+
+
+def startupCycle(site: Site, attempts: int = 60):
+    """Runs the site's first control cycle as soon as all its devices have reported, instead of waiting for a change
+    large enough to trigger it (e.g. with filters restored from a checkpoint)"""
+    if all(component.ready() for component in site.components()):
+        limit_callback(site, site.client, force=True, source="startup")
+    elif attempts > 1:
+        getScheduler().after(1, startupCycle, site, attempts - 1, name="startupCycle")
+
+
+def startSite(site: Site, client: mqtt_client, router: TopicRouter, runtime: "AsyncRuntime | None" = None):
+    hub_opts = getOpts(site.config, solarflow.Solarflow)
+    dtuType = backends.resolve("dtu", site.dtuType)
+    dtu_opts = getOpts(site.config, dtuType)
+    smtType = backends.resolve("smartmeter", site.smtType)
+    smt_opts = getOpts(site.config, smtType)
+    site.client = client
+    site.router = router
 
     # if no config setting were found in MQTT (retained) then update config from config file
-    updateConfigParams(client)
-
-    log.info("Control Parameters:")
-    log.info(f"  MIN_CHARGE_POWER = {MIN_CHARGE_POWER}")
-    log.info(f"  MAX_DISCHARGE_LEVEL = {MAX_DISCHARGE_POWER}")
-    log.info(f"  MAX_INVERTER_LIMIT = {MAX_INVERTER_LIMIT}")
-    log.info(f"  MAX_INVERTER_INPUT = {MAX_INVERTER_INPUT}")
-    log.info(f"  SUNRISE_OFFSET = {SUNRISE_OFFSET}")
-    log.info(f"  SUNSET_OFFSET = {SUNSET_OFFSET}")
-    log.info(f"  BATTERY_LOW = {BATTERY_LOW}")
-    log.info(f"  BATTERY_HIGH = {BATTERY_HIGH}")
-    log.info(f"  BATTERY_DISCHARGE_START = {BATTERY_DISCHARGE_START}")
-    log.info(f"  DISCHARGE_DURING_DAYTIME = {DISCHARGE_DURING_DAYTIME}")
-
-    hub = solarflow.Solarflow(client=client, callback=limit_callback, **hub_opts)
-    dtu = dtuType(client=client, ac_limit=MAX_INVERTER_LIMIT, callback=limit_callback, **dtu_opts)
-    smt = smtType(client=client, callback=limit_callback, **smt_opts)
-
-    client.user_data_set({"hub": hub, "dtu": dtu, "smartmeter": smt})
-
-    # switch the callback function for received MQTT messages to the delegating function
-    client.on_message = on_message
+    updateConfigParams(site)
+
+    log.info(f"Control Parameters{f' of {site.name}' if site.name else ''}:")
+    log.info(f"  MIN_CHARGE_POWER = {site.minChargePower}")
+    log.info(f"  MAX_DISCHARGE_LEVEL = {site.maxDischargePower}")
+    log.info(f"  MAX_INVERTER_LIMIT = {site.maxInverterLimit}")
+    log.info(f"  MAX_INVERTER_INPUT = {site.maxInverterInput}")
+    log.info(f"  SUNRISE_OFFSET = {site.sunriseOffset}")
+    log.info(f"  SUNSET_OFFSET = {site.sunsetOffset}")
+    log.info(f"  BATTERY_LOW = {site.batteryLow}")
+    log.info(f"  BATTERY_HIGH = {site.batteryHigh}")
+    log.info(f"  BATTERY_DISCHARGE_START = {site.batteryDischargeStart}")
+    log.info(f"  DISCHARGE_DURING_DAYTIME = {site.dischargeDuringDaytime}")
+
+    hub = solarflow.Solarflow(client=client, callback=partial(limit_callback, site, source="hub"), **hub_opts)
+    dtu = dtuType(
+        client=client,
+        ac_limit=site.maxInverterLimit,
+        callback=partial(limit_callback, site, source="dtu"),
+        **dtu_opts,
+    )
+    smt = smtType(client=client, callback=partial(limit_callback, site, source="smartmeter"), **smt_opts)
+    site.hub, site.dtu, site.smartmeter = hub, dtu, smt
+    # the devices reach their peers (e.g. the smartmeter the hub's discharge power) through their site
+    hub.site = dtu.site = smt.site = site
+
+    router.add(f"solarflow-hub/{site.deviceId}/control/#", partial(on_control_message, site))
+    site.control = ControlWorker(
+        limitHomeInput,
+        site,
+        interval=site.steeringInterval,
+        debounce=TRIGGER_DEBOUNCE,
+        inline=runtime is not None,
+        name=f"control.{site.name}" if site.name else "control",
+    )
+    # on the asyncio runtime control cycles run on the event loop, serialized with message processing. Replays and
+    # simulations pass their VirtualScheduler, which runs them on the simulated clock
+    runtime and runtime.drive(site.control)
+
+    if checkpointer:
+        checkpointer.register(site.checkpointSection("hub"), hub.checkpoint, hub.restore)
+        checkpointer.register(site.checkpointSection("dtu"), dtu.checkpoint, dtu.restore)
+        checkpointer.register(site.checkpointSection("smartmeter"), smt.checkpoint, smt.restore)
 
-    infotimer = RepeatedTimer(120, deviceInfo, client)
+    getScheduler().after(1, startupCycle, site, name="startupCycle")
 
     # subscribe Hub, DTU and Smartmeter so that they can react on received messages
-    hub.subscribe()
-    dtu.subscribe()
-    smt.subscribe()
+    hub.subscribe(router)
+    dtu.subscribe(router)
+    smt.subscribe(router)
 
     # ensure that the hubs min/max battery levels are set upon startup according to configuration, adjustments will be done if required by CT mode
-    hub.setBatteryHighSoC(BATTERY_HIGH)
-    hub.setBatteryLowSoC(BATTERY_LOW)
+    hub.setBatteryHighSoC(site.batteryHigh)
+    hub.setBatteryLowSoC(site.batteryLow)
 
     # turn off the hub's buzzer (audio feedback for config settings change)
     hub.setBuzzer(False)
     # ensure hub's maximum inverter feed power is set according to configuration
-    hub.setInverseMaxPower(MAX_INVERTER_INPUT)
+    hub.setInverseMaxPower(site.maxInverterInput)
     # ensure hub is in AC output mode
     hub.setACMode()
     # initially turn off bypass and disable auto-recover from bypass
@@ -772,11 +1048,35 @@ def run():
         hub.setAutorecover(False)
 
 
+def start(client: mqtt_client, runtime: "AsyncRuntime | None" = None):
+    # one router for all sites, the topics of their devices are distinct
+    router = TopicRouter()
+    client.user_data_set({"router": router, "sites": sites})
+    for site in sites:
+        startSite(site, client, router, runtime)
+
+    checkpointer and checkpointer.start(lock=router.lock)
+
+    # switch the callback function for received MQTT messages to the routing function
+    client.on_message = on_message
+
+    getScheduler().every(120, deviceInfo, name="deviceInfo")
+
+    if profiler:
+        log.info(profiler.report())
+        profiler.uninstall()
+
+
 def main(argv):
     global mqtt_host, mqtt_port, mqtt_user, mqtt_pwd
-    global sf_device_id
-    global location
-    opts, args = getopt.getopt(argv, "hb:p:u:s:d:", ["broker=", "port=", "user=", "password="])
+    global RUNTIME, RECORD
+    global checkpointer
+    logs.setup(LOG_FORMAT, rate=LOG_RATE, sample=LOG_SAMPLE, summary=LOG_SUMMARY)
+    opts, args = getopt.getopt(
+        argv,
+        "hb:p:u:s:d:r:",
+        ["broker=", "port=", "user=", "password=", "runtime=", "record=", "profile-startup"],
+    )
     for opt, arg in opts:
         if opt == "-h":
             log.info("solarflow-control.py -b <MQTT Broker Host> -p <MQTT Broker Port>")
@@ -790,7 +1090,11 @@ def main(argv):
         elif opt in ("-s", "--password"):
             mqtt_pwd = arg
         elif opt in ("-d", "--device"):
-            sf_device_id = arg
+            sites[0].deviceId = arg
+        elif opt in ("-r", "--runtime"):
+            RUNTIME = arg
+        elif opt == "--record":
+            RECORD = arg
 
     if mqtt_host is None:
         log.error("You need to provide a local MQTT broker (environment variable MQTT_HOST or option --broker)!")
@@ -804,25 +1108,45 @@ def main(argv):
         log.info(f"MQTT User: {mqtt_user}/{mqtt_pwd}")
         log.info(f"MQTT User: {mqtt_user}/{mqtt_pwd}")
 
-    if sf_device_id is None:
-        log.error(f"You need to provide a SF_DEVICE_ID (environment variable SF_DEVICE_ID or option --device)!")
-        sys.exit()
-    else:
-        log.info(f"Solarflow Hub: {sf_product_id}/{sf_device_id}")
-
-    loc = MyLocation()
-    if not LNG and not LAT:
-        coordinates = loc.getCoordinates()
-        if loc is None:
-            coordinates = (LAT, LNG)
-            log.info(f"Geocoordinates: {coordinates}")
+    for site in sites:
+        if site.deviceId is None:
+            log.error(f"You need to provide a SF_DEVICE_ID (environment variable SF_DEVICE_ID or option --device)!")
+            sys.exit()
+        elif sum(other.deviceId == site.deviceId for other in sites) > 1:
+            log.error(f"Solarflow Hub {site.deviceId} is configured for more than one site!")
+            sys.exit()
+        else:
+            log.info(f"Solarflow Hub{f' of {site.name}' if site.name else ''}: {site.productId}/{site.deviceId}")
+
+        # location info for determining sunrise/sunset, configured, cached in the checkpoint or detected from my IP
+        if site.longitude or site.latitude:
+            site.location = LocationInfo(timezone="Europe/Berlin", latitude=site.latitude, longitude=site.longitude)
+
+    METRICS_PORT and metrics.serve(METRICS_PORT)
+    if CHECKPOINT_FILE:
+        checkpointer = Checkpointer(CHECKPOINT_FILE, CHECKPOINT_INTERVAL)
+        checkpointer.load()
+        for site in sites:
+            checkpointer.register(site.checkpointSection("control"), site.controlCheckpoint, site.restoreControl)
+            checkpointer.register(site.checkpointSection("location"), site.locationCheckpoint, site.restoreLocation)
+
+    coordinates = None
+    for site in sites:
+        if site.location is None:
+            # the sites are served by this host, so they share the location detected from its IP
+            coordinates = coordinates or MyLocation().getCoordinates()
+            site.location = LocationInfo(timezone="Europe/Berlin", latitude=coordinates[0], longitude=coordinates[1])
+    if TRACE_FILE:
+        tracing.setTracer(tracing.Tracer(tracing.FileSink(TRACE_FILE)))
+        log.info(f"Writing command latency traces to {TRACE_FILE}")
+
+    if RUNTIME == "asyncio":
+        import asyncio
+
+        log.info("Using asyncio runtime")
+        asyncio.run(runAsync())
     else:
-        coordinates = (LAT, LNG)
-
-    # location info for determining sunrise/sunset
-    location = LocationInfo(timezone="Europe/Berlin", latitude=coordinates[0], longitude=coordinates[1])
-
-    run()
+        run()
 
 
 if __name__ == "__main__":
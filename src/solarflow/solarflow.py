@@ -3,9 +3,15 @@ from datetime import datetime
 import logging
 import json
 import sys
-import pathlib
-from jinja2 import Environment, FileSystemLoader, DebugUndefined
-from utils import TimewindowBuffer, RepeatedTimer, str2bool
+import threading
+import clock
+import logs
+import metrics
+import tracing
+from utils import CommandTracker, TelemetryPublisher, TimewindowBuffer, getScheduler, str2bool
+from filters import createFilter
+from discovery import DiscoveryPublisher
+from snapshot import HubSnapshot
 
 red = "\x1b[31;20m"
 reset = "\x1b[0m"
@@ -14,6 +20,8 @@ logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
 log = logging.getLogger("")
 
 TRIGGER_DIFF = 30
+# the day's SoC statistics are restored from checkpoints up to this age (seconds)
+DAY_STATE_MAX_AGE = 3600
 
 HUB1200 = "73bkTV"
 HUB2000 = "A8yh63"
@@ -36,6 +44,54 @@ INVERTER_BRAND = {
 }
 
 
+class PropertyWriter:
+    """Coalesces property writes to the hub.
+
+    Properties requested within a flush window are merged (the latest value per property wins) and sent as a single
+    properties/write message. Consecutive messages are at least spacing seconds apart, as the hub is slow to apply
+    writes and tends to drop some if they arrive back to back.
+    """
+
+    def __init__(self, client: mqtt_client, topic: str, device: str, window: float = 0.2, spacing: float = 1.0):
+        self.client = client
+        self.topic = topic
+        self.device = device
+        self.window = window
+        self.spacing = spacing
+        self.pending = {}
+        self.scheduled = False
+        self.lastWrite = None
+        self.requested = 0  # number of property writes requested
+        self.sent = 0  # number of properties/write messages sent
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f"sent {self.sent} writes for {self.requested} requested"
+
+    def write(self, properties: dict):
+        with self.lock:
+            self.pending.update(properties)
+            self.requested += 1
+            metrics.property_writes_requested.inc(self.device)
+            if not self.scheduled:
+                self.scheduled = True
+                delay = self.window
+                if self.lastWrite is not None:
+                    delay = max(delay, self.lastWrite + self.spacing - clock.monotonic())
+                getScheduler().after(delay, self.flush, name="hub.write")
+
+    def flush(self):
+        with self.lock:
+            properties, self.pending = self.pending, {}
+            self.scheduled = False
+            self.lastWrite = clock.monotonic()
+        if properties:
+            self.client.publish(self.topic, json.dumps({"properties": properties}))
+            self.sent += 1
+            metrics.property_writes_sent.inc(self.device)
+            log.debug(f"Hub properties written: {properties}")
+
+
 class Solarflow:
     opts = {
         "product_id": str,
@@ -44,7 +100,11 @@ class Solarflow:
         "control_bypass": bool,
         "control_soc": bool,
         "disable_full_discharge": bool,
+        "solar_input_filter": str,
+        "property_write_spacing": float,
     }
+    # the site (inverter, smartmeter) the hub belongs to, set when the site is started
+    site = None
 
     def default_calllback(self):
         log.info("default callback")
@@ -58,6 +118,8 @@ class Solarflow:
         control_bypass: bool = False,
         control_soc: bool = False,
         disable_full_discharge: bool = False,
+        solar_input_filter: str = None,
+        property_write_spacing: float = 1.0,
         callback=default_calllback,
     ):
         self.client = client
@@ -65,7 +127,7 @@ class Solarflow:
         self.deviceId = device_id
         self.fullChargeInterval = full_charge_interval
         self.fwVersion = "unknown"
-        self.solarInputValues = TimewindowBuffer(minutes=1)
+        self.solarInputValues = createFilter(solar_input_filter)
         self.solarInputPower = -1  # solar input power of connected panels
         self.outputPackPower = 0  # charging power of battery pack
         self.packInputPower = 0  # discharging power of battery pack
@@ -94,6 +156,12 @@ class Solarflow:
         self.chargeThroughRequested = False
 
         self.property_topic = f"iot/{self.productId}/{self.deviceId}/properties/write"
+        self.writer = PropertyWriter(client, self.property_topic, device_id, spacing=property_write_spacing)
+        # the hub is slow in adopting writes, it takes up to 30s until a new limit is reported back
+        self.commands = CommandTracker("hub", self.resendProperty, timeout=30, on_settled=self.commandSettled)
+        self.pendingLimit = None  # latest limit requested while the hub was still adopting the previous one
+        self.pendingLimitJob = None
+        self.limitLock = threading.RLock()
         self.chargeThrough = False
         self.chargeThroughStage = BATTERY_TARGET_IDLE
         self.force_drain = False
@@ -104,16 +172,18 @@ class Solarflow:
         self.nightConsumption = 100
         self.trigger_callback = callback
 
-        self.lastLimitTS = None
+        self.telemetry = TelemetryPublisher(client)
+        # created when the discovery documents are published first
+        self.discovery = None
+        self.discoveryPending = False
 
         client.publish(f"solarflow-hub/{self.deviceId}/control/controlBypass", str(self.control_bypass), retain=True)
         client.publish(
             f"solarflow-hub/{self.deviceId}/control/fullChargeInterval", self.fullChargeInterval, retain=True
         )
 
-        updater = RepeatedTimer(60, self.update)
-        haconfig = RepeatedTimer(600, self.pushHomeassistantConfig)
-        self.pushHomeassistantConfig()
+        getScheduler().every(60, self.update, name="hub.update")
+        self.requestHomeassistantConfig()
         self.update()
 
     def __str__(self):
@@ -137,28 +207,17 @@ class Solarflow:
         log.info(f"Triggering telemetry update: iot/{self.productId}/{self.deviceId}/properties/read")
         self.client.publish(f"iot/{self.productId}/{self.deviceId}/properties/read", '{"properties": ["getAll"]}')
 
-    def subscribe(self):
+    def subscribe(self, router=None):
+        # telemetry is applied directly from the hub's report, the solarflow-hub/<device>/telemetry topics are only
+        # published for others (e.g. Homeassistant), so we don't need to subscribe to them
         topics = [
             f"/{self.productId}/{self.deviceId}/properties/report",
-            f"solarflow-hub/{self.deviceId}/telemetry/solarInputPower",
-            f"solarflow-hub/{self.deviceId}/telemetry/electricLevel",
-            f"solarflow-hub/{self.deviceId}/telemetry/outputPackPower",
-            f"solarflow-hub/{self.deviceId}/telemetry/packInputPower",
-            f"solarflow-hub/{self.deviceId}/telemetry/outputHomePower",
-            f"solarflow-hub/{self.deviceId}/telemetry/outputLimit",
-            f"solarflow-hub/{self.deviceId}/telemetry/inverseMaxPower",
-            f"solarflow-hub/{self.deviceId}/telemetry/masterSoftVersion",
-            f"solarflow-hub/{self.deviceId}/telemetry/pass",
-            f"solarflow-hub/{self.deviceId}/telemetry/passMode",
-            f"solarflow-hub/{self.deviceId}/telemetry/socSet",
-            f"solarflow-hub/{self.deviceId}/telemetry/minSoc",
-            f"solarflow-hub/{self.deviceId}/telemetry/batteries/+/socLevel",
-            f"solarflow-hub/{self.deviceId}/telemetry/batteries/+/totalVol",
             f"solarflow-hub/{self.deviceId}/control/#",
         ]
         for t in topics:
             self.client.subscribe(t)
             log.info(f"Hub subscribing: {t}")
+            router and router.add(t, self.handleReport if t.endswith("/properties/report") else self.handleTelemetry)
 
     def ready(self):
         return self.electricLevel > -1 and self.solarInputPower > -1
@@ -168,47 +227,32 @@ class Solarflow:
         self.client.publish(f"iot/{self.productId}/{self.deviceId}/time-sync/reply", json.dumps(payload))
 
     def pushHomeassistantConfig(self):
-        log.info("Publishing Homeassistant templates...")
-        hatemplates = [f for f in pathlib.Path().glob("homeassistant/*.json")]
-        environment = Environment(loader=FileSystemLoader("homeassistant/"), undefined=DebugUndefined)
-
-        for hatemplate in hatemplates:
-            template = environment.get_template(hatemplate.name)
-            cfg_type = hatemplate.name.split(".")[0]
-            cfg_name = hatemplate.name.split(".")[1]
-            if cfg_name == "maxTemp" or cfg_name == "totalVol" or cfg_name == "soh":
-                for index, (serial, v) in enumerate(self.batteriesVol.items()):
-                    hacfg = template.render(
-                        product_id=self.productId,
-                        device_id=self.deviceId,
-                        fw_version=self.fwVersion,
-                        battery_serial=serial,
-                        battery_index=index + 1,
-                    )
-                    if serial != "none":
-                        self.client.publish(
-                            f"homeassistant/{cfg_type}/solarflow-hub-{self.deviceId}-{serial}-{cfg_name}/config",
-                            hacfg,
-                            retain=True,
-                        )
-            else:
-                hacfg = template.render(product_id=self.productId, device_id=self.deviceId, fw_version=self.fwVersion)
-                self.client.publish(
-                    f"homeassistant/{cfg_type}/solarflow-hub-{self.deviceId}-{cfg_name}/config", hacfg, retain=True
-                )
-            # log.info(hacfg)
-        log.info(f"Published {len(hatemplates)} Homeassistant templates.")
+        self.discoveryPending = False
+        self.discovery = self.discovery or DiscoveryPublisher(self.client)
+        published = self.discovery.publish(
+            product_id=self.productId,
+            device_id=self.deviceId,
+            fw_version=self.fwVersion,
+            batteries=list(self.batteriesVol.keys()),
+        )
+        published and log.info(f"Published {published} changed Homeassistant templates.")
+
+    # (re)publish discovery documents from the scheduler, e.g. when a new battery pack or firmware version shows up
+    def requestHomeassistantConfig(self):
+        if not self.discoveryPending:
+            self.discoveryPending = True
+            getScheduler().after(0, self.pushHomeassistantConfig, name="hub.homeassistant")
 
     def updSolarInput(self, value: int):
         self.solarInputValues.add(value)
         self.solarInputPower = self.getSolarInputPower()
-        self.lastSolarInputTS = datetime.now()
+        self.lastSolarInputTS = clock.now()
 
         # TODO: experimental, trigger limit calculation only on significant changes of smartmeter
         previous = self.solarInputValues.previous()
         if abs(previous - self.getSolarInputPower()) >= TRIGGER_DIFF:
             log.info(
-                f"HUB triggers limit function: {previous} -> {self.getSolarInputPower()}: {'executed' if self.trigger_callback(self.client) else 'skipped'}"
+                f"HUB triggers limit function: {previous} -> {self.getSolarInputPower()}: {'queued' if self.trigger_callback(self.client) else 'skipped'}"
             )
             self.last_trigger_value = self.getSolarInputPower()
 
@@ -230,7 +274,7 @@ class Solarflow:
                 else:
                     self.setChargeThrough(False)
 
-            self.lastFullTS = datetime.now()
+            self.lastFullTS = clock.now()
             self.client.publish(
                 f"solarflow-hub/{self.deviceId}/control/lastFullTimestamp",
                 int(datetime.timestamp(self.lastFullTS)),
@@ -253,7 +297,7 @@ class Solarflow:
             if self.chargeThrough:
                 self.setChargeThrough(False)
 
-            self.lastEmptyTS = datetime.now()
+            self.lastEmptyTS = clock.now()
             self.client.publish(
                 f"solarflow-hub/{self.deviceId}/control/lastEmptyTimestamp",
                 int(datetime.timestamp(self.lastEmptyTS)),
@@ -310,6 +354,7 @@ class Solarflow:
 
     def updOutputLimit(self, value: int):
         self.outputLimit = value
+        self.commands.confirm("outputLimit", value)
 
     def updInverseMaxPower(self, value: int):
         self.inverseMaxPower = value
@@ -320,26 +365,35 @@ class Solarflow:
 
     def updMinSoC(self, value: int):
         self.batteryLow = int(value / 10)
+        self.commands.confirm("minSoc", value)
         self.processRequestedChargeThrough()
 
     def updSocSet(self, value: int):
         self.batteryHigh = int(value / 10)
+        self.commands.confirm("socSet", value)
         self.processRequestedChargeThrough()
 
     def updBatteryVol(self, sn: str, value: int):
         self.batteriesVol.pop("none", None)
+        if sn not in self.batteriesVol:
+            log.info(f"Found battery pack {sn}")
+            self.requestHomeassistantConfig()
         self.batteriesVol.update({sn: value / 100})
 
     def updMasterSoftVersion(self, value: int):
         major = (value & 0xF000) >> 12
         minor = (value & 0x0F00) >> 8
         build = value & 0x00FF
-        self.fwVersion = f"{major}.{minor}.{build}"
+        fwVersion = f"{major}.{minor}.{build}"
+        if fwVersion != self.fwVersion:
+            self.fwVersion = fwVersion
+            self.requestHomeassistantConfig()
 
     def updByPass(self, value: int):
         self.bypass = bool(value)
 
     def updByPassMode(self, value: int):
+        self.commands.confirm("passMode", value)
         # it seems when the battery is completely depleted SF resets the bypass to auto, so we enforce it manual off when this happens
         if self.control_bypass and value == 0 and not self.bypass:
             self.setBypass(False)
@@ -389,7 +443,7 @@ class Solarflow:
                 self.setBatteryLowSoC(0, True)
 
         # in case of setups with no direct panels connected to inverter it is necessary to turn on the inverter as it is likely offline now
-        inv = self.client._userdata["dtu"]
+        inv = self.site.dtu
         if (not inv.ready()) and self.getOutputHomePower() == 0:
             # this will power on the inverter so that control can resume from an interrupted charge-through
             self.setOutputLimit(30)
@@ -454,95 +508,117 @@ class Solarflow:
 
     # handle content of mqtt message and update properties accordingly
     def handleMsg(self, msg):
-        # transform the original messages sent by the SF hub into a better readable format
         if self.productId in msg.topic:
-            device_id = msg.topic.split("/")[2]
-            payload = json.loads(msg.payload.decode())
-            if "properties" in payload:
-                props = payload["properties"]
-                for prop, val in props.items():
-                    self.client.publish(f"solarflow-hub/{device_id}/telemetry/{prop}", val)
-
-            if "packData" in payload:
-                packdata = payload["packData"]
-                if len(packdata) > 0:
-                    for pack in packdata:
-                        sn = pack.pop("sn")
-                        for prop, val in pack.items():
-                            self.client.publish(f"solarflow-hub/{device_id}/telemetry/batteries/{sn}/{prop}", val)
-
+            self.handleReport(msg)
         if msg.topic.startswith("solarflow-hub") and msg.payload:
-            # check if we got regular updates on solarInputPower
-            # if we haven't received any update on solarInputPower for 120s
-            # we assume it's not producing and inject 0
-            now = datetime.now()
-            if self.lastSolarInputTS:
-                diff = now - self.lastSolarInputTS
-                seconds = diff.total_seconds()
-                if seconds > 120:
-                    self.updSolarInput(0)
-
-            metric = msg.topic.split("/")[-1]
-            value = msg.payload.decode()
-            match metric:
-                case "electricLevel":
-                    self.updElectricLevel(int(value))
-                case "solarInputPower":
-                    self.updSolarInput(int(value))
-                case "outputPackPower":
-                    self.updOutputPack(int(value))
-                case "packInputPower":
-                    self.updPackInput(int(value))
-                case "outputHomePower":
-                    self.updOutputHome(int(value))
-                case "outputLimit":
-                    self.updOutputLimit(int(value))
-                case "inverseMaxPower":
-                    self.updInverseMaxPower(int(value))
-                case "socLevel":
-                    sn = msg.topic.split("/")[-2]
-                    self.updBatterySoC(sn=sn, value=int(value))
-                case "minSoc":
-                    self.updMinSoC(int(value))
-                case "socSet":
-                    self.updSocSet(int(value))
-                case "totalVol":
-                    sn = msg.topic.split("/")[-2]
-                    self.updBatteryVol(sn=sn, value=int(value))
-                case "masterSoftVersion":
-                    self.updMasterSoftVersion(value=int(value))
-                case "chargeThrough":
-                    self.setChargeThrough(value)
-                case "dryRun":
-                    self.setDryRun(value)
-                case "lastFullTimestamp":
-                    self.setLastFullTimestamp(float(value))
-                case "lastEmptyTimestamp":
-                    self.setLastEmptyTimestamp(float(value))
-                case "batteryTarget":
-                    self.setBatteryTarget(value)
-                case "pass":
-                    self.updByPass(int(value))
-                case "passMode":
-                    self.updByPassMode(int(value))
-                case "chargeThroughState":
-                    pass
-                case _:
-                    if "control" not in msg.topic:
-                        log.warning(f"Ignoring solarflow-hub metric: {metric}")
+            self.handleTelemetry(msg)
+
+    def handleReport(self, msg, metric: str = None):
+        # apply the hub's report directly and mirror it into a better readable format (solarflow-hub/<device>/telemetry)
+        device_id = msg.topic.split("/")[2]
+        payload = json.loads(msg.payload.decode())
+        self.checkSolarInput()
+
+        if "properties" in payload:
+            props = payload["properties"]
+            for prop, val in props.items():
+                self.telemetry.publish(f"solarflow-hub/{device_id}/telemetry/{prop}", val)
+                self.updMetric(prop, val)
+
+        if "packData" in payload:
+            packdata = payload["packData"]
+            if len(packdata) > 0:
+                for pack in packdata:
+                    sn = pack.pop("sn")
+                    for prop, val in pack.items():
+                        self.telemetry.publish(f"solarflow-hub/{device_id}/telemetry/batteries/{sn}/{prop}", val)
+                        self.updMetric(prop, val, sn)
+
+    def handleTelemetry(self, msg, metric: str = None):
+        if not msg.payload:
+            return
+
+        self.checkSolarInput()
+        metric = metric or msg.topic.split("/")[-1]
+        sn = msg.topic.split("/")[-2]
+        if not self.updMetric(metric, msg.payload.decode(), sn) and "control" not in msg.topic:
+            log.warning(f"Ignoring solarflow-hub metric: {metric}")
+
+    def checkSolarInput(self):
+        # check if we got regular updates on solarInputPower
+        # if we haven't received any update on solarInputPower for 120s
+        # we assume it's not producing and inject 0
+        now = clock.now()
+        if self.lastSolarInputTS:
+            diff = now - self.lastSolarInputTS
+            seconds = diff.total_seconds()
+            if seconds > 120:
+                self.updSolarInput(0)
+
+    # update properties from a telemetry value or control parameter, returns False for unknown metrics
+    def updMetric(self, metric: str, value, sn: str = None) -> bool:
+        match metric:
+            case "electricLevel":
+                self.updElectricLevel(int(value))
+            case "solarInputPower":
+                self.updSolarInput(int(value))
+            case "outputPackPower":
+                self.updOutputPack(int(value))
+            case "packInputPower":
+                self.updPackInput(int(value))
+            case "outputHomePower":
+                self.updOutputHome(int(value))
+            case "outputLimit":
+                self.updOutputLimit(int(value))
+            case "inverseMaxPower":
+                self.updInverseMaxPower(int(value))
+            case "socLevel":
+                self.updBatterySoC(sn=sn, value=int(value))
+            case "minSoc":
+                self.updMinSoC(int(value))
+            case "socSet":
+                self.updSocSet(int(value))
+            case "totalVol":
+                self.updBatteryVol(sn=sn, value=int(value))
+            case "masterSoftVersion":
+                self.updMasterSoftVersion(value=int(value))
+            case "chargeThrough":
+                self.setChargeThrough(value)
+            case "dryRun":
+                self.setDryRun(value)
+            case "lastFullTimestamp":
+                self.setLastFullTimestamp(float(value))
+            case "lastEmptyTimestamp":
+                self.setLastEmptyTimestamp(float(value))
+            case "batteryTarget":
+                self.setBatteryTarget(value)
+            case "pass":
+                self.updByPass(int(value))
+            case "passMode":
+                self.updByPassMode(int(value))
+            case "chargeThroughState":
+                pass
+            case _:
+                return False
+        return True
 
     def setOutputLimit(self, limit: int):
-        # since the hub is slow in adoption we should not try to set the limit too frequently
-        # 30-45s seems ok
-        now = datetime.now()
-        if self.lastLimitTS:
-            elapsed = now - self.lastLimitTS
-            if elapsed.total_seconds() < 30:
+        tracing.requested(self.commands.name, "outputLimit")
+        # since the hub is slow in adoption we should not set a new limit before it confirmed the last one
+        # the latest requested limit is kept and applied as soon as the hub confirmed or the lockout expired
+        with self.limitLock:
+            if self.commands.isBlocking("outputLimit"):
                 log.info(
-                    f"Hub has recently adjusted limit, need to wait until it is set again! Current limit: {self.outputLimit:.0f}, new limit: {limit:.1f}"
+                    f"Hub has not yet confirmed the last limit, deferring new limit! Current limit: {self.outputLimit:.0f}, new limit: {limit:.1f}"
                 )
+                self.deferOutputLimit(limit)
                 return self.outputLimit
 
+            # a limit requested now replaces a deferred one
+            self.takePendingLimit()
+            return self.applyOutputLimit(limit)
+
+    def applyOutputLimit(self, limit: int) -> int:
         if limit < 0:
             limit = 0
 
@@ -585,35 +661,71 @@ class Solarflow:
             r = divmod(limit, 30)[1]
             limit = 30 * m + 30 * (r // 15)
 
-        outputlimit = {"properties": {"outputLimit": limit}}
         if self.outputLimit != limit:
-            (not self.dryrun) and self.client.publish(self.property_topic, json.dumps(outputlimit))
-            self.lastLimitTS = now
+            (not self.dryrun) and self.writeCommand("outputLimit", limit)
+            self.telemetry.publish(f"solarflow-hub/{self.deviceId}/telemetry/appliedOutputLimit", limit)
             log.info(f"{'[DRYRUN] ' if self.dryrun else ''}Setting solarflow output limit to {limit:.1f}W")
         else:
-            log.info(
+            # the hub already runs with this limit, a command still waiting for confirmation is obsolete
+            self.commands.cancel("outputLimit")
+            logs.SUMMARY or log.info(
                 f"{'[DRYRUN] ' if self.dryrun else ''}Not setting solarflow output limit to {limit:.1f}W as it is identical to current limit!"
             )
         return limit
 
+    def writeCommand(self, key: str, value: int):
+        self.commands.sent(key, value)
+        self.writer.write({key: value})
+
+    def resendProperty(self, key: str, value: int):
+        # a limit requested in the meantime supersedes the unconfirmed one
+        if key == "outputLimit" and self.pendingLimit is not None:
+            self.applyPendingLimit(force=True)
+        else:
+            self.writer.write({key: value})
+
+    def commandSettled(self, key: str, confirmed: bool):
+        key == "outputLimit" and self.applyPendingLimit()
+
+    def deferOutputLimit(self, limit: int):
+        with self.limitLock:
+            self.pendingLimit = limit
+            if self.pendingLimitJob is None:
+                self.pendingLimitJob = getScheduler().after(
+                    self.commands.blockedFor("outputLimit"), self.applyPendingLimit, name="hub.pendingLimit"
+                )
+        self.telemetry.publish(f"solarflow-hub/{self.deviceId}/telemetry/pendingOutputLimit", limit)
+
+    def takePendingLimit(self) -> int:
+        with self.limitLock:
+            limit, self.pendingLimit = self.pendingLimit, None
+            self.pendingLimitJob and self.pendingLimitJob.cancel()
+            self.pendingLimitJob = None
+        limit is not None and self.telemetry.publish(f"solarflow-hub/{self.deviceId}/telemetry/pendingOutputLimit", -1)
+        return limit
+
+    def applyPendingLimit(self, force: bool = False):
+        with self.limitLock:
+            limit = self.takePendingLimit()
+            if limit is None:
+                return
+            log.info(f"Applying pending solarflow output limit of {limit:.1f}W")
+            self.applyOutputLimit(limit) if force else self.setOutputLimit(limit)
+
     def setBuzzer(self, state: bool):
-        buzzer = {"properties": {"buzzerSwitch": 0 if not state else 1}}
-        self.client.publish(self.property_topic, json.dumps(buzzer))
+        self.writer.write({"buzzerSwitch": 0 if not state else 1})
         log.info(f"Turning hub buzzer {'ON' if state else 'OFF'}")
 
     def setACMode(self):
-        acmode = {"properties": {"acMode": 2}}
-        self.client.publish(self.property_topic, json.dumps(acmode))
+        self.writer.write({"acMode": AC_MODE_OUTPUT})
         log.info(f"Ensure hub AC Mode is set to output")
 
     def setAutorecover(self, state: bool):
-        autorecover = {"properties": {"autoRecover": 0 if not state else 1}}
-        self.client.publish(self.property_topic, json.dumps(autorecover))
+        self.writer.write({"autoRecover": 0 if not state else 1})
         log.info(f"Turning hub bypass autorecover {'ON' if state else 'OFF'}")
 
     def setBypass(self, state: bool):
-        passmode = {"properties": {"passMode": 2 if state else 1}}
-        self.client.publish(self.property_topic, json.dumps(passmode))
+        self.writeCommand("passMode", 2 if state else 1)
         log.info(f"Turning hub bypass {'ON' if state else 'OFF'}")
         if not state:
             self.bypass = state  # required for cases where we can't wait on confirmation on turning bypass off
@@ -621,7 +733,7 @@ class Solarflow:
     # return how much time has passed since last full charge (in hours)
     def getLastFullBattery(self) -> int:
         if self.lastFullTS:
-            diff = datetime.now() - self.lastFullTS
+            diff = clock.now() - self.lastFullTS
             return diff.total_seconds() / 3600
         else:
             return -1
@@ -629,7 +741,7 @@ class Solarflow:
     # return how much time has passed since last empty battery (in hours)
     def getLastEmptyBattery(self) -> int:
         if self.lastEmptyTS:
-            diff = datetime.now() - self.lastEmptyTS
+            diff = clock.now() - self.lastEmptyTS
             return diff.total_seconds() / 3600
         else:
             return -1
@@ -658,6 +770,45 @@ class Solarflow:
     def getBypass(self):
         return self.bypass
 
+    def checkpoint(self) -> dict:
+        return {
+            "sunriseSoC": self.sunriseSoC,
+            "sunsetSoC": self.sunsetSoC,
+            "daySoCIncrease": self.daySoCIncrease,
+            "nightConsumption": self.nightConsumption,
+            "solarInput": self.solarInputValues.checkpoint(),
+        }
+
+    def restore(self, state: dict, age: float):
+        # the SoC statistics are updated at sunrise and sunset, after a longer downtime they might have been missed
+        if age < DAY_STATE_MAX_AGE:
+            self.sunriseSoC = state["sunriseSoC"]
+            self.sunsetSoC = state["sunsetSoC"]
+            self.daySoCIncrease = state["daySoCIncrease"]
+            self.nightConsumption = state["nightConsumption"]
+            log.info(
+                f"Restored SoC at sunrise: {self.sunriseSoC}%, at sunset: {self.sunsetSoC}%, increase today: {self.daySoCIncrease}%, night consumption: {self.nightConsumption}%"
+            )
+        self.solarInputValues.restore(state["solarInput"], age)
+
+    def snapshot(self, text: bool = True) -> HubSnapshot:
+        return HubSnapshot(
+            text=str(self) if text else "",
+            ready=self.ready(),
+            electricLevel=self.electricLevel,
+            solarInputPower=self.getSolarInputPower(),
+            outputLimit=self.outputLimit,
+            inverseMaxPower=self.inverseMaxPower,
+            bypass=self.bypass,
+            dischargePower=self.packInputPower,
+            batteryLow=self.batteryLow,
+            batteryTarget=self.batteryTarget,
+            sunriseSoC=self.sunriseSoC,
+            daySoCIncrease=self.daySoCIncrease,
+            control_bypass=self.control_bypass,
+            force_drain=self.force_drain,
+        )
+
     def getCanDischarge(self):
         fullage = self.getLastFullBattery()
         can_discharge = (self.batteryTarget == BATTERY_TARGET_DISCHARGING) or (
@@ -673,8 +824,7 @@ class Solarflow:
         if not self.control_soc:
             return self.batteryHigh
 
-        payload = {"properties": {"socSet": level * 10}}
-        self.client.publish(self.property_topic, json.dumps(payload))
+        self.writeCommand("socSet", level * 10)
         log.info(f"Setting maximum charge level to {level}%")
         return level
 
@@ -686,8 +836,7 @@ class Solarflow:
         if not self.control_soc:
             return self.batteryLow
 
-        payload = {"properties": {"minSoc": level * 10}}
-        self.client.publish(self.property_topic, json.dumps(payload))
+        self.writeCommand("minSoc", level * 10)
         log.info(f"Setting minimum charge level to {level}%")
         return level
 
@@ -714,8 +863,7 @@ class Solarflow:
     def setInverseMaxPower(self, value: int) -> int:
         if value <= 100:
             value = 100
-        payload = {"properties": {"inverseMaxPower": value}}
-        self.client.publish(self.property_topic, json.dumps(payload))
+        self.writer.write({"inverseMaxPower": value})
         self.inverseMaxPower = value
         return value
 
@@ -724,6 +872,5 @@ class Solarflow:
 
     def setPvBrand(self, brand: int = 1):
         brand_str = INVERTER_BRAND.get(brand, f"Unkown [{brand}]")
-        payload = {"properties": {"pvBrand": brand}}
-        self.client.publish(self.property_topic, json.dumps(payload))
+        self.writer.write({"pvBrand": brand})
         log.info(f"Setting inverter brand to {brand_str}")
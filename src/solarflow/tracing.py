@@ -0,0 +1,205 @@
+import json
+import logging
+import sys
+import threading
+
+import clock
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+"""
+End-to-end latency of the limits sent to the inverter and the hub, from the message that triggered the control cycle
+to the device confirming the new limit. Every settled command is written as one span (a JSON line) with its stages:
+
+    filter      message arrival until it triggered a cycle (parsing, filters/smoothing buffers, trigger thresholds)
+    queue       trigger until the control cycle started (debounce, steering_interval, a cycle still running)
+    gated       the part of queue the cycle was held back by the steering_interval
+    decision    cycle start until the limit was requested from the device
+    lockout     request until the command was sent, e.g. while the hub hasn't confirmed its last limit
+    publish     command sent until the device reported the new value (property write spacing, broker, device)
+    total       message arrival (or trigger for timed cycles) until confirmation
+
+The message a cycle reacts to is the one whose trigger queued it, triggers merged into the pending cycle are counted.
+Tracing is enabled by configuring a trace_file, otherwise all calls return immediately.
+"""
+
+
+class Origin:
+    """The message (or timer) a control cycle was triggered by"""
+
+    __slots__ = ("source", "topic", "arrived", "triggered", "forced")
+
+    def __init__(self, source: str, topic: str, arrived: float, triggered: float, forced: bool):
+        self.source = source
+        self.topic = topic
+        self.arrived = arrived
+        self.triggered = triggered
+        self.forced = forced
+
+
+class Cycle:
+    """Timing of the control cycle a command was requested in"""
+
+    __slots__ = ("origin", "merged", "started", "gated", "requested")
+
+    def __init__(self, origin: Origin, merged: int, started: float, gated: float):
+        self.origin = origin
+        self.merged = merged
+        self.started = started
+        self.gated = gated
+        self.requested = None
+
+
+class FileSink:
+    """Appends spans as JSON lines to a file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "a", buffering=1)
+        self.lock = threading.Lock()
+
+    def __call__(self, span: dict):
+        line = json.dumps(span, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Tracer:
+    """Collects the timestamps of the stages and emits a span to sink (a function taking a dict) per settled command.
+
+    Arrivals and cycles are kept per thread: a message is handled and triggers on the thread dispatching it, a cycle
+    requests its limits on the thread running it. Requests are kept per device and property until the command is
+    sent, the latest request wins as the devices only apply the latest limit.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.enabled = sink is not None
+        self.local = threading.local()
+        self.requests = {}
+        self.spans = 0
+
+    def arrived(self, component: str, topic: str):
+        if self.enabled:
+            self.local.arrival = (component, topic, clock.monotonic())
+
+    def handled(self):
+        if self.enabled:
+            self.local.arrival = None
+
+    def triggered(self, source: str, forced: bool = False) -> Origin:
+        if not self.enabled:
+            return None
+        now = clock.monotonic()
+        arrival = getattr(self.local, "arrival", None)
+        if arrival is None:
+            # e.g. the periodic trigger
+            return Origin(source, None, None, now, forced)
+        return Origin(source, arrival[1], arrival[2], now, forced)
+
+    def begin(self, origin: Origin, merged: int, gated: float):
+        if self.enabled:
+            self.local.cycle = origin and Cycle(origin, merged, clock.monotonic(), gated)
+
+    def end(self):
+        if self.enabled:
+            self.local.cycle = None
+
+    def requested(self, device: str, key: str):
+        if not self.enabled:
+            return
+        cycle = getattr(self.local, "cycle", None)
+        if cycle is not None:
+            request = Cycle(cycle.origin, cycle.merged, cycle.started, cycle.gated)
+            request.requested = clock.monotonic()
+            self.requests[(device, key)] = request
+
+    def sent(self, device: str, key: str) -> Cycle:
+        # the request stays with the command, later resends are attributed to it as well
+        return self.requests.pop((device, key), None) if self.enabled else None
+
+    def settled(self, device: str, key: str, value: float, request: Cycle, sent: float, attempts: int, status: str):
+        if not self.enabled or request is None:
+            return
+        now = clock.monotonic()
+        origin = request.origin
+        start = origin.triggered if origin.arrived is None else origin.arrived
+        span = {
+            "ts": round(clock.time(), 3),
+            "device": device,
+            "property": key,
+            "value": value,
+            "status": status,
+            "attempts": attempts,
+            "source": origin.source,
+            "topic": origin.topic,
+            "forced": origin.forced,
+            "merged": request.merged,
+            "filter": None if origin.arrived is None else _ms(origin.triggered - origin.arrived),
+            "queue": _ms(request.started - origin.triggered),
+            "gated": _ms(min(request.gated, request.started - origin.triggered)),
+            "decision": _ms(request.requested - request.started),
+            "lockout": _ms(sent - request.requested),
+            "publish": _ms(now - sent) if status == "confirmed" else None,
+            "total": _ms(now - start) if status == "confirmed" else None,
+        }
+        self.spans += 1
+        try:
+            self.sink(span)
+        except Exception:
+            log.exception("Writing trace span failed")
+
+
+def _ms(seconds: float) -> float:
+    return round(max(seconds, 0) * 1000, 1)
+
+
+_tracer = Tracer()
+
+
+def getTracer() -> Tracer:
+    return _tracer
+
+
+def setTracer(tracer: Tracer):
+    global _tracer
+    _tracer = tracer
+
+
+# module level accessors, using the tracer that is current at call time
+def arrived(component: str, topic: str):
+    _tracer.arrived(component, topic)
+
+
+def handled():
+    _tracer.handled()
+
+
+def triggered(source: str, forced: bool = False) -> Origin:
+    return _tracer.triggered(source, forced)
+
+
+def begin(origin: Origin, merged: int, gated: float):
+    _tracer.begin(origin, merged, gated)
+
+
+def end():
+    _tracer.end()
+
+
+def requested(device: str, key: str):
+    _tracer.requested(device, key)
+
+
+def sent(device: str, key: str) -> Cycle:
+    return _tracer.sent(device, key)
+
+
+def settled(device: str, key: str, value: float, request: Cycle, sent: float, attempts: int, status: str):
+    _tracer.settled(device, key, value, request, sent, attempts, status)
@@ -1,18 +1,344 @@
-from datetime import datetime
-from datetime import timedelta
+from array import array
 from functools import reduce
-from threading import Timer
+import heapq
+import itertools
 import logging
+import math
+import queue
 import sys
+import threading
+import time
+
+import clock
+import metrics
+import tracing
 
 FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
 logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
 log = logging.getLogger("")
 
 
+class Job:
+    """A function scheduled on the Scheduler, either once or periodically, with its run-time statistics"""
+
+    def __init__(self, function, args, kwargs, interval: float, repeat: bool, fixed_rate: bool, name: str | None):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.repeat = repeat
+        self.fixed_rate = fixed_rate
+        self.name = name or getattr(function, "__qualname__", str(function))
+        self.cancelled = False
+        self.running = False
+        self.deadline = 0.0
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.lastRuntime = 0.0
+        self.maxRuntime = 0.0
+        self.totalRuntime = 0.0
+
+    def __str__(self):
+        return (
+            f"{self.name}: runs: {self.runs}, skipped: {self.skipped}, errors: {self.errors}, "
+            f"last: {self.lastRuntime * 1000:.1f}ms, avg: {self.avgRuntime() * 1000:.1f}ms, max: {self.maxRuntime * 1000:.1f}ms"
+        )
+
+    def avgRuntime(self) -> float:
+        return self.totalRuntime / self.runs if self.runs else 0.0
+
+    def record(self, runtime: float):
+        self.runs += 1
+        self.lastRuntime = runtime
+        self.maxRuntime = max(self.maxRuntime, runtime)
+        self.totalRuntime += runtime
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "last_runtime": self.lastRuntime,
+            "avg_runtime": self.avgRuntime(),
+            "max_runtime": self.maxRuntime,
+        }
+
+
+class Scheduler:
+    """Runs delayed and periodic jobs, driven by a heap of deadlines in a single scheduler thread.
+
+    Due jobs are handed to a small pool of long-lived worker threads, so a slow job doesn't delay the others.
+    Periodic jobs run either at a fixed rate (drift free, deadlines are multiples of the interval from the first one)
+    or with a fixed delay between the end of a run and the next start. Jobs never overlap with themselves: deadlines
+    that pass while a job is still running are skipped and counted instead of queued up.
+
+    Jobs which block on I/O are marked with blocking=True. All jobs run in the worker pool here, the flag matters for
+    the AsyncScheduler, which runs the other jobs on the event loop. A blocking job hands its result to callSoon(),
+    which runs it where the other jobs and the message handlers run.
+
+    Arguments for the function are passed positionally or as a kwargs dict, the keyword parameters of every() and
+    after() are the scheduler's own, so they can't collide with the function's.
+    """
+
+    def __init__(self, clock=clock.monotonic, workers: int = 4):
+        self.clock = clock
+        self.jobs = []
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._workers = workers
+        self._queue = queue.SimpleQueue()
+        self._stopped = False
+
+    def every(
+        self,
+        interval: float,
+        function,
+        *args,
+        kwargs: dict | None = None,
+        fixed_rate: bool = True,
+        name: str | None = None,
+        blocking: bool = False,
+    ) -> Job:
+        job = Job(function, args, kwargs or {}, interval, repeat=True, fixed_rate=fixed_rate, name=name)
+        self._schedule(job, self.clock() + interval)
+        return job
+
+    def after(
+        self,
+        delay: float,
+        function,
+        *args,
+        kwargs: dict | None = None,
+        name: str | None = None,
+        blocking: bool = False,
+    ) -> Job:
+        job = Job(function, args, kwargs or {}, delay, repeat=False, fixed_rate=False, name=name)
+        self._schedule(job, self.clock() + delay)
+        return job
+
+    def callSoon(self, function, *args):
+        """Applies the result of a blocking job: there is no event loop here, function runs in the calling thread"""
+        function(*args)
+
+    def stats(self) -> list:
+        with self._cond:
+            return [job.stats() for job in self.jobs if job.repeat]
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            for _ in range(self._workers):
+                self._queue.put(None)
+
+    def _schedule(self, job: Job, deadline: float):
+        with self._cond:
+            if job not in self.jobs:
+                self.jobs.append(job)
+            job.deadline = deadline
+            heapq.heappush(self._heap, (deadline, next(self._seq), job))
+            if self._thread is None:
+                # not daemons, like the timer threads before, the scheduler keeps the process alive. A
+                # ThreadPoolExecutor can't be used for the workers, it stops taking jobs when the main thread exits
+                self._thread = threading.Thread(target=self._loop, name="scheduler")
+                self._thread.start()
+                for i in range(self._workers):
+                    threading.Thread(target=self._work, name=f"job_{i}").start()
+            self._cond.notify()
+
+    def _unschedule(self, job: Job):
+        with self._cond:
+            job in self.jobs and self.jobs.remove(job)
+
+    def _next(self) -> Job:
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, _, job = self._heap[0]
+                if job.cancelled:
+                    heapq.heappop(self._heap)
+                    job in self.jobs and self.jobs.remove(job)
+                    continue
+                wait = deadline - self.clock()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                return job
+            return None
+
+    def _loop(self):
+        while (job := self._next()) is not None:
+            if job.repeat and job.fixed_rate:
+                deadline = job.deadline + job.interval
+                now = self.clock()
+                if deadline <= now:
+                    # we woke up late (e.g. suspended system), don't try to catch up with all missed runs
+                    missed = math.ceil((now - deadline) / job.interval)
+                    job.skipped += missed
+                    deadline += missed * job.interval
+                self._schedule(job, deadline)
+
+            if job.running:
+                job.skipped += 1
+                continue
+            job.running = True
+            self._queue.put(job)
+
+    def _work(self):
+        while (job := self._queue.get()) is not None:
+            self._run(job)
+
+    def _run(self, job: Job):
+        start = self.clock()
+        try:
+            job.function(*job.args, **job.kwargs)
+        except Exception:
+            job.errors += 1
+            log.exception(f"Scheduled job {job.name} failed")
+        end = self.clock()
+        job.record(end - start)
+        job.running = False
+
+        if not job.repeat or job.cancelled:
+            self._unschedule(job)
+        elif not job.fixed_rate:
+            self._schedule(job, end + job.interval)
+
+
+_scheduler = None
+
+
+def getScheduler() -> Scheduler:
+    """The scheduler shared by all components, created on first use"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
+
+
+def setScheduler(scheduler: Scheduler):
+    global _scheduler
+    _scheduler = scheduler
+
+
+class VirtualScheduler:
+    """Scheduler for replays and simulations, driven by a SimulatedClock.
+
+    Nothing runs by itself: the owner calls runUntil(t), which runs all jobs due until t inline and in order of their
+    deadlines, moving the clock to each deadline first. Inline ControlWorkers passed to drive() have their cycles run
+    the same way. Run times are measured on the real clock.
+    """
+
+    def __init__(self, clock):
+        self.simulated = clock
+        self.clock = clock.monotonic
+        self.jobs = []
+        self.workers = []
+        self._heap = []
+        self._seq = itertools.count()
+
+    def every(
+        self,
+        interval: float,
+        function,
+        *args,
+        kwargs: dict | None = None,
+        fixed_rate: bool = True,
+        name: str | None = None,
+        blocking: bool = False,
+    ) -> Job:
+        job = Job(function, args, kwargs or {}, interval, repeat=True, fixed_rate=fixed_rate, name=name)
+        self._schedule(job, self.clock() + interval)
+        return job
+
+    def after(
+        self,
+        delay: float,
+        function,
+        *args,
+        kwargs: dict | None = None,
+        name: str | None = None,
+        blocking: bool = False,
+    ) -> Job:
+        job = Job(function, args, kwargs or {}, delay, repeat=False, fixed_rate=False, name=name)
+        self._schedule(job, self.clock() + delay)
+        return job
+
+    def callSoon(self, function, *args):
+        function(*args)
+
+    def stats(self) -> list:
+        return [job.stats() for job in self.jobs if job.repeat]
+
+    def stop(self):
+        self._heap.clear()
+
+    def nextDeadline(self) -> float:
+        while self._heap and self._heap[0][2].cancelled:
+            job = heapq.heappop(self._heap)[2]
+            job in self.jobs and self.jobs.remove(job)
+        return self._heap[0][0] if self._heap else None
+
+    def drive(self, worker):
+        self.workers.append(worker)
+
+    def nextWorker(self):
+        due = [(worker.nextDue(), worker) for worker in self.workers if worker.nextDue() is not None]
+        return min(due, key=lambda d: d[0], default=(None, None))
+
+    def runUntil(self, t: float):
+        while True:
+            deadline = self.nextDeadline()
+            cycle_due, worker = self.nextWorker()
+            if cycle_due is not None and cycle_due <= t and (deadline is None or cycle_due <= deadline):
+                self.simulated.set(cycle_due)
+                worker.runDue()
+                continue
+            if deadline is None or deadline > t:
+                break
+
+            job = heapq.heappop(self._heap)[2]
+            self.simulated.set(deadline)
+            if job.repeat and job.fixed_rate:
+                self._schedule(job, deadline + job.interval)
+
+            start = time.perf_counter()
+            try:
+                job.function(*job.args, **job.kwargs)
+            except Exception:
+                job.errors += 1
+                log.exception(f"Scheduled job {job.name} failed")
+            job.record(time.perf_counter() - start)
+
+            if not job.repeat or job.cancelled:
+                job in self.jobs and self.jobs.remove(job)
+            elif not job.fixed_rate:
+                self._schedule(job, self.clock() + job.interval)
+        self.simulated.set(t)
+
+    def _schedule(self, job: Job, deadline: float):
+        if job not in self.jobs:
+            self.jobs.append(job)
+        job.deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), job))
+
+
 class RepeatedTimer:
+    """Calls a function every interval seconds, run by the shared scheduler thread"""
+
     def __init__(self, interval, function, *args, **kwargs):
-        self._timer = None
+        self._job = None
         self.interval = interval
         self.function = function
         self.args = args
@@ -20,58 +346,283 @@ class RepeatedTimer:
         self.is_running = False
         self.start()
 
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.function(*self.args, **self.kwargs)
-
     def start(self):
         if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
+            self._job = getScheduler().every(self.interval, self.function, *self.args, kwargs=self.kwargs)
             self.is_running = True
 
     def stop(self):
-        self._timer.cancel()
+        self._job.cancel()
         self.is_running = False
 
 
-def isExpired(value, now, maxage):
-    diff = now - value[0]
-    return diff.total_seconds() < maxage
+class TelemetryPublisher:
+    """Publishes telemetry values off the hot path.
+
+    Values are collected by publish() and sent in batches by a scheduled flush, only if they changed since they were
+    last sent. Every refresh interval all last known values are sent again, for subscribers that joined later.
+    """
+
+    def __init__(self, client, interval: float = 1, refresh: float = 300):
+        self.client = client
+        self.pending = {}
+        self.sent = {}
+        self.requested = 0
+        self.published = 0
+        self.lock = threading.Lock()
+        getScheduler().every(interval, self.flush, fixed_rate=False, name="telemetry.flush")
+        getScheduler().every(refresh, self.refresh, name="telemetry.refresh")
+
+    def publish(self, topic: str, value):
+        with self.lock:
+            self.requested += 1
+            if self.sent.get(topic) != value:
+                self.pending[topic] = value
+            else:
+                self.pending.pop(topic, None)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.sent.update(batch)
+        for topic, value in batch.items():
+            self.client.publish(topic, value)
+        self.published += len(batch)
+
+    def refresh(self):
+        with self.lock:
+            self.pending = {**self.sent, **self.pending}
+
+
+class Command:
+    """A command sent to a device, waiting for the telemetry confirming it"""
+
+    def __init__(self, key: str, value: float, expected: float):
+        self.key = key
+        self.value = value
+        self.expected = expected
+        self.requested = clock.monotonic()
+        self.sent = self.requested
+        self.attempts = 1
+        self.job = None
+        self.trace = None
+
+
+class CommandTracker:
+    """Correlates commands sent to a device with the telemetry confirming them.
+
+    Commands are registered with sent() and confirmed by confirm() once the device reports the value (within a
+    tolerance), or the value it is expected to apply if the device clamps or rounds what it was sent. Unconfirmed commands are resent with exponential backoff up to retries times. While a command waits
+    for its confirmation, but at most timeout seconds after it was (re)sent, it blocks follow-up commands of the same
+    kind. The apply latency (from request to confirmation) is recorded per command. on_settled(key, confirmed) is
+    called once a command has been confirmed or given up.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        resend,
+        timeout: float = 30,
+        retries: int = 3,
+        backoff: float = 2,
+        tolerance: float = 0,
+        on_settled=None,
+    ):
+        self.name = name
+        self.resend = resend
+        self.on_settled = on_settled
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.pending = {}
+        self.latency = {}
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        stats = [
+            f"{key}: {s['confirmed']}x avg {s['total'] / s['confirmed']:.1f}s max {s['max']:.1f}s"
+            for key, s in self.latency.items()
+        ]
+        return f"{self.name} apply latency: {', '.join(stats) or 'n/a'}, pending: {list(self.pending)}, failed: {self.failed}"
+
+    def sent(self, key: str, value: float, expected: float | None = None):
+        with self.lock:
+            previous = self.pending.get(key)
+            previous and previous.job and previous.job.cancel()
+            command = Command(key, value, value if expected is None else expected)
+            command.trace = tracing.sent(self.name, key)
+            self.pending[key] = command
+            command.job = getScheduler().after(self.timeout, self._expired, command, name=f"{self.name}.{key}.timeout")
+        metrics.commands.inc(self.name, key)
+        previous and self._traced(previous, "superseded")
+
+    def confirm(self, key: str, value: float) -> bool:
+        with self.lock:
+            command = self.pending.get(key)
+            if command is None or abs(command.expected - value) > max(self.tolerance, abs(command.expected) * 0.02):
+                return False
+            del self.pending[key]
+            command.job and command.job.cancel()
+            latency = clock.monotonic() - command.requested
+            stats = self.latency.setdefault(key, {"confirmed": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+            stats["confirmed"] += 1
+            stats["total"] += latency
+            stats["max"] = max(stats["max"], latency)
+            stats["last"] = latency
+        log.debug(f"{self.name} confirmed {key}={value} after {latency:.1f}s ({command.attempts} attempts)")
+        self._traced(command, "confirmed")
+        self.on_settled and self.on_settled(key, True)
+        return True
+
+    def isPending(self, key: str) -> bool:
+        return key in self.pending
+
+    def isBlocking(self, key: str) -> bool:
+        return self.blockedFor(key) > 0
+
+    def blockedFor(self, key: str) -> float:
+        command = self.pending.get(key)
+        return 0 if command is None else max(command.sent + self.timeout - clock.monotonic(), 0)
+
+    def cancel(self, key: str):
+        with self.lock:
+            command = self.pending.pop(key, None)
+            command and command.job and command.job.cancel()
+        command and self._traced(command, "cancelled")
+
+    def _expired(self, command: Command):
+        with self.lock:
+            if self.pending.get(command.key) is not command:
+                return
+            if command.attempts > self.retries:
+                del self.pending[command.key]
+                self.failed += 1
+                log.warning(
+                    f"{self.name} didn't confirm {command.key}={command.value} after {command.attempts} attempts, giving up"
+                )
+                settled = True
+            else:
+                settled = False
+                command.attempts += 1
+                command.sent = clock.monotonic()
+                delay = self.timeout * self.backoff ** (command.attempts - 1)
+                command.job = getScheduler().after(
+                    delay, self._expired, command, name=f"{self.name}.{command.key}.timeout"
+                )
+        if settled:
+            metrics.command_failures.inc(self.name, command.key)
+            self._traced(command, "failed")
+            self.on_settled and self.on_settled(command.key, False)
+            return
+        metrics.command_retries.inc(self.name, command.key)
+        log.info(
+            f"{self.name} didn't confirm {command.key}={command.value} yet, resending (attempt {command.attempts})"
+        )
+        self.resend(command.key, command.value)
+
+    def _traced(self, command: Command, status: str):
+        tracing.settled(
+            self.name, command.key, command.value, command.trace, command.requested, command.attempts, status
+        )
 
 
 class TimewindowBuffer:
-    def __init__(self, minutes: int = 2):
+    """Moving window of samples, aggregated into averages of 10s buckets counting back from the most recent value.
+
+    Samples are kept in an array backed ring buffer on a monotonic clock. Every bucket keeps a running sum and count
+    which are updated when samples enter or leave it, so adding a sample is O(1) amortized regardless of the rate.
+    Sums are kept as integers in 1/1000 units, so they don't drift when samples leave the buckets again.
+    """
+
+    name = "window"
+    BUCKET_SECONDS = 10
+    BUCKETS = 6
+    SCALE = 1000
+
+    def __init__(self, minutes: int = 2, capacity: int = 64, clock=clock.monotonic):
         self.aggregated_values = []
         self.minutes = minutes
-        self.values = []
+        self.maxage = minutes * 60
+        self.clock = clock
+        self._reset(capacity)
 
     def __str__(self):
         return "[ " + ",".join([f"{v:>3.1f}" for v in self.aggregated_values]) + " ]"
 
-    def add(self, value):
-        now = datetime.now()
-        self.values.append((now, value))
+    def _reset(self, capacity: int):
+        self.capacity = capacity
+        self._ts = array("d", [0.0]) * capacity
+        self._values = array("q", [0]) * capacity
+        # samples are addressed by a running sequence number, the ring slot is seq % capacity
+        self._head = 0
+        self._next = 0
+        # bucket i holds all samples younger than (i+2)*10s (at most the window length), like the moving averages did
+        self._spans = [min((i + 2) * self.BUCKET_SECONDS, self.maxage) for i in range(self.BUCKETS)]
+        self._tails = [0] * self.BUCKETS
+        self._sums = [0] * self.BUCKETS
+        self._counts = [0] * self.BUCKETS
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        ts = array("d", [0.0]) * capacity
+        values = array("q", [0]) * capacity
+        for seq in range(self._head, self._next):
+            ts[seq % capacity] = self._ts[seq % self.capacity]
+            values[seq % capacity] = self._values[seq % self.capacity]
+        self.capacity, self._ts, self._values = capacity, ts, values
+
+    def _push(self, ts: float, value: float):
+        if self._next - self._head == self.capacity:
+            self._grow()
+        value = round(value * self.SCALE)
+        slot = self._next % self.capacity
+        self._ts[slot] = ts
+        self._values[slot] = value
+        self._next += 1
+        for i in range(self.BUCKETS):
+            self._sums[i] += value
+            self._counts[i] += 1
+
+    def _expire(self, now: float):
+        cap = self.capacity
+        for i in range(self.BUCKETS):
+            span = self._spans[i]
+            tail = self._tails[i]
+            while tail < self._next and now - self._ts[tail % cap] >= span:
+                self._sums[i] -= self._values[tail % cap]
+                self._counts[i] -= 1
+                tail += 1
+            self._tails[i] = tail
 
-        self.values = list(filter(lambda v: isExpired(v, now, self.minutes * 60), self.values))
-        # self.aggregated_values = list(filter(lambda v: isExpired(v, now, self.minutes*60),self.aggregated_values))
+        while self._head < self._next and now - self._ts[self._head % cap] >= self.maxage:
+            self._head += 1
+        for i in range(self.BUCKETS):
+            self._tails[i] = max(self._tails[i], self._head)
 
+    def add(self, value):
+        now = self.clock()
+        self._push(now, value)
+        self._expire(now)
+        self._aggregate()
+
+    def _aggregate(self):
         # create moving averages of 10s back from most recent values
         self.aggregated_values = []
-        avg = last_avg = 0
-        i = 1
-        while True:
-            bucket = list(filter(lambda v: isExpired(v, now - timedelta(seconds=i * 10), 10), self.values))
-            avg = reduce(lambda a, b: a + b, [v[1] for v in bucket]) / len(bucket)
+        last_avg = last_count = 0
+        for i in range(self.BUCKETS):
+            count = self._counts[i]
+            if count == 0:
+                # only restored samples, older than the bucket
+                continue
+            avg = self._sums[i] / count / self.SCALE
             self.aggregated_values.insert(0, avg)
-            # log.info(f' Bucket {i}: {[v[1] for v in enumerate(bucket)]}')
-            # log.info(self.aggregated_values)
-            if avg == last_avg or i == 6:
+            # stop as soon as a bucket doesn't reach any older samples
+            if avg == last_avg or count == last_count:
                 break
-            else:
-                last_avg = avg
-                i += 1
+            last_avg = avg
+            last_count = count
 
     # number of entries in buffer
     def len(self):
@@ -95,32 +646,53 @@ class TimewindowBuffer:
         n = len(self.aggregated_values)
         if n == 0:
             return 0
-        return round(reduce(lambda a, b: a + b, [v[1] for v in self.aggregated_values]) / n, 1)
+        return round(sum(self.aggregated_values) / n, 1)
 
     # weighted moving average
     def wavg(self) -> float:
         n = len(self.aggregated_values)
         if n == 0:
             return 0
-        return round(reduce(lambda a, b: a + b, self.aggregated_values) / ((n * (n + 1)) / 2), 1)
+        return round(sum(self.aggregated_values) / ((n * (n + 1)) / 2), 1)
 
     # n^2 weighted moving average
     def qwavg(self) -> float:
         n = len(self.aggregated_values)
         if n == 0:
             return 0
-        return round(reduce(lambda a, b: a + b, self.aggregated_values) / ((n * (n + 1) * (2 * n + 1)) / 6), 1)
+        return round(sum(self.aggregated_values) / ((n * (n + 1) * (2 * n + 1)) / 6), 1)
 
     def clear(self):
         # self.values = []
-        self.aggregated_values = [self.aggregated_values[-1]]
+        self.aggregated_values = self.aggregated_values[-1:]
 
     # used to prepopulate smartmeter readings with fixed values for a certain amount of seconds
     def populate(self, duration, value):
-        now = datetime.now()
-        self.values = []
+        now = self.clock()
+        self._reset(max(self.capacity, duration + 1))
         for s in range(duration, -1, -1):
-            self.values.append((now - timedelta(seconds=s), value))
+            self._push(now - s, value)
+        self._expire(now)
+
+    def checkpoint(self) -> dict:
+        now = self.clock()
+        cap = self.capacity
+        samples = [
+            [round(now - self._ts[seq % cap], 3), self._values[seq % cap] / self.SCALE]
+            for seq in range(self._head, self._next)
+        ]
+        return {"filter": self.name, "samples": samples}
+
+    def restore(self, state: dict, age: float):
+        """Refills the window with the samples of a checkpoint taken age seconds ago, as far as they are still in it"""
+        if state.get("filter") != self.name:
+            return
+        now = self.clock()
+        self._reset(max(self.capacity, len(state["samples"])))
+        for sample_age, value in state["samples"]:
+            sample_age + age < self.maxage and self._push(now - sample_age - age, value)
+        self._expire(now)
+        self._aggregate()
 
 
 def deep_get(dictionary, keys, default=None):
@@ -0,0 +1,173 @@
+import logging
+import sys
+import threading
+import time
+
+import clock
+import logs
+import metrics
+import tracing
+
+FORMAT = "%(asctime)s:%(levelname)s: %(message)s"
+logging.basicConfig(stream=sys.stdout, level="INFO", format=FORMAT)
+log = logging.getLogger("")
+
+
+class Trigger:
+    """The pending request for a control cycle, all triggers arriving until it runs are merged into it"""
+
+    def __init__(self, now: float, due: float, force: bool, origin=None, gated: float = 0):
+        self.queued = now
+        self.due = due
+        self.force = force
+        self.merged = 1
+        # the trace origin of the trigger that queued the cycle and how long the interval holds the cycle back
+        self.origin = origin
+        self.gated = gated
+
+
+class ControlWorker:
+    """Runs control cycles in a dedicated thread, fed by a latest-wins trigger slot.
+
+    trigger() never blocks the caller (e.g. the MQTT network thread): it only records that a cycle is wanted. Triggers
+    arriving while a cycle is pending are merged into it, so a burst (e.g. the phases of a smartmeter) results in one
+    cycle after debounce seconds. Cycles start at least interval seconds apart, triggers arriving earlier are deferred
+    instead of dropped. Forced triggers only wait for the debounce.
+
+    With inline=True no thread is started and the owner calls runDue() to run a due cycle, e.g. in replays or
+    simulations driven by a virtual clock or on an event loop. on_trigger is called after every trigger, so the owner
+    can (re)arm its timer for nextDue().
+    """
+
+    def __init__(
+        self,
+        cycle,
+        *args,
+        interval: float = 15,
+        debounce: float = 0.5,
+        clock=clock.monotonic,
+        inline: bool = False,
+        name: str = "control",
+    ):
+        self.cycle = cycle
+        self.args = args
+        self.interval = interval
+        self.debounce = debounce
+        self.clock = clock
+        self.name = name
+        self.pending = None
+        self.lastStart = None
+        self.running = False
+        self.triggers = 0
+        self.cycles = 0
+        self.errors = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.lastWait = 0.0
+        self.totalRuntime = 0.0
+        self.maxRuntime = 0.0
+        self.lastRuntime = 0.0
+        self.totalCpu = 0.0
+        self.maxCpu = 0.0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self.on_trigger = None
+        if not inline:
+            self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+            self._thread.start()
+
+    def __str__(self):
+        cycles = self.cycles or 1
+        return (
+            f"{self.name}: {self.cycles} cycles for {self.triggers} triggers, errors: {self.errors}, "
+            f"queue wait: last {self.lastWait:.2f}s avg {self.totalWait / cycles:.2f}s max {self.maxWait:.2f}s, "
+            f"run: last {self.lastRuntime * 1000:.0f}ms avg {self.totalRuntime / cycles * 1000:.0f}ms max {self.maxRuntime * 1000:.0f}ms, "
+            f"cpu: avg {self.totalCpu / cycles * 1000:.1f}ms max {self.maxCpu * 1000:.1f}ms"
+        )
+
+    def trigger(self, force: bool = False, origin=None) -> bool:
+        """Request a cycle, returns if a new cycle was queued (False if the trigger was merged into a pending one)"""
+        with self._cond:
+            now = self.clock()
+            self.triggers += 1
+            due = now + self.debounce
+            if not force and self.lastStart is not None:
+                due = max(due, self.lastStart + self.interval)
+
+            queued = self.pending is None
+            if queued:
+                self.pending = Trigger(now, due, force, origin, due - now - self.debounce)
+            else:
+                # latest wins, the cycle reads the newest state anyway. A forced trigger may only move the cycle earlier
+                self.pending.merged += 1
+                if force and not self.pending.force:
+                    self.pending.force = True
+                    self.pending.due = min(self.pending.due, due)
+            self._cond.notify()
+        self.on_trigger and self.on_trigger()
+        return queued
+
+    def nextDue(self) -> float:
+        return None if self.pending is None else self.pending.due
+
+    def runDue(self) -> bool:
+        """Run the pending cycle if it is due, returns if a cycle was run"""
+        with self._cond:
+            if self.pending is None or self.running or self.pending.due > self.clock():
+                return False
+            trigger, self.pending = self.pending, None
+            self.running = True
+            start = self.clock()
+            self.lastStart = start
+
+        # the queue wait is measured on the (possibly simulated) clock, the cycle's run and CPU time on the real one
+        self.lastWait = start - trigger.queued
+        run_start, cpu_start = time.perf_counter(), time.process_time()
+        tracing.begin(trigger.origin, trigger.merged, trigger.gated)
+        try:
+            self.cycle(*self.args)
+        except Exception:
+            self.errors += 1
+            log.exception(f"{self.name} cycle failed")
+        finally:
+            tracing.end()
+        self.lastRuntime = time.perf_counter() - run_start
+        cpu = time.process_time() - cpu_start
+        # in summary mode the cycle logs itself
+        logs.SUMMARY or log.info(
+            f"{self.name} cycle took {self.lastRuntime * 1000:.0f}ms, queued {self.lastWait:.2f}s for {trigger.merged} {'forced ' if trigger.force else ''}triggers"
+        )
+
+        with self._cond:
+            self.running = False
+            self.cycles += 1
+            self.totalWait += self.lastWait
+            self.maxWait = max(self.maxWait, self.lastWait)
+            self.totalRuntime += self.lastRuntime
+            self.maxRuntime = max(self.maxRuntime, self.lastRuntime)
+            self.totalCpu += cpu
+            self.maxCpu = max(self.maxCpu, cpu)
+        metrics.cycle_seconds.observe(self.lastRuntime, self.name)
+        metrics.cycle_wait_seconds.observe(self.lastWait, self.name)
+        return True
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self.pending is None:
+                        self._cond.wait()
+                        continue
+                    wait = self.pending.due - self.clock()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stopped:
+                    return
+            self.runDue()
@@ -0,0 +1,207 @@
+import math
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils import TimewindowBuffer
+
+"""
+The ring buffer TimewindowBuffer against the list based implementation it replaced, on a scripted sequence of samples
+covering sparse and dense sampling, samples on the 10s bucket boundaries, gaps longer than the window, populate(),
+clear() and a restart from a checkpoint.
+"""
+
+START = datetime(2024, 6, 1, 12)
+
+
+class ScriptedClock:
+    def __init__(self):
+        self.t = 0.0
+
+    def monotonic(self) -> float:
+        return 1000.0 + self.t
+
+    def now(self) -> datetime:
+        return START + timedelta(seconds=self.t)
+
+
+def isExpired(value, now, maxage):
+    diff = now - value[0]
+    return diff.total_seconds() < maxage
+
+
+class BaselineBuffer:
+    """TimewindowBuffer before the ring buffer, with the clock injected and its sums taken with math.fsum instead of
+    reduce. Float sums of repeated values drift (32 times 600.2 average to 600.2000000000004), which moves the point
+    where the aggregation stops, the ring buffer sums exactly. avg() is left out, it fails on
+    the floats of aggregated_values."""
+
+    def __init__(self, minutes: int, clock):
+        self.aggregated_values = []
+        self.minutes = minutes
+        self.values = []
+        self.clock = clock
+
+    def add(self, value):
+        now = self.clock()
+        self.values.append((now, value))
+
+        self.values = list(filter(lambda v: isExpired(v, now, self.minutes * 60), self.values))
+
+        self.aggregated_values = []
+        avg = last_avg = 0
+        i = 1
+        while True:
+            bucket = list(filter(lambda v: isExpired(v, now - timedelta(seconds=i * 10), 10), self.values))
+            avg = math.fsum([v[1] for v in bucket]) / len(bucket)
+            self.aggregated_values.insert(0, avg)
+            if avg == last_avg or i == 6:
+                break
+            else:
+                last_avg = avg
+                i += 1
+
+    def len(self):
+        return len(self.aggregated_values)
+
+    def last(self) -> float:
+        n = len(self.aggregated_values)
+        if n == 0:
+            return 0
+        return round(self.aggregated_values[-1], 1)
+
+    def previous(self) -> float:
+        n = len(self.aggregated_values)
+        if n < 2:
+            return 0
+        return round(self.aggregated_values[-2], 1)
+
+    def wavg(self) -> float:
+        n = len(self.aggregated_values)
+        if n == 0:
+            return 0
+        return round(math.fsum(self.aggregated_values) / ((n * (n + 1)) / 2), 1)
+
+    def qwavg(self) -> float:
+        n = len(self.aggregated_values)
+        if n == 0:
+            return 0
+        return round(math.fsum(self.aggregated_values) / ((n * (n + 1) * (2 * n + 1)) / 6), 1)
+
+    def clear(self):
+        self.aggregated_values = [self.aggregated_values[-1]]
+
+    def populate(self, duration, value):
+        now = self.clock()
+        self.values = []
+        for s in range(duration, -1, -1):
+            self.values.append((now - timedelta(seconds=s), value))
+
+
+def script() -> list:
+    """(seconds since start, value) of the samples"""
+    t, samples = 0.0, []
+    # 1 Hz
+    for i in range(30):
+        samples.append((t, 200 + (i % 7) * 13.5))
+        t += 1
+    # a gap over two buckets, then 2 Hz
+    t += 25
+    for i in range(10):
+        samples.append((t, 950 - i * 40.2))
+        t += 0.5
+    # every sample on a bucket boundary of the previous ones
+    for i in range(12):
+        samples.append((t, 300.1 * (i % 3)))
+        t += 10
+    # a gap longer than the window
+    t += 130
+    for i in range(90):
+        samples.append((t, 150 + (i * 37) % 400))
+        t += 2.5
+    return samples
+
+
+def assertSame(buffer: TimewindowBuffer, baseline: BaselineBuffer):
+    assert buffer.aggregated_values == pytest.approx(baseline.aggregated_values, rel=1e-12)
+    assert buffer.len() == baseline.len()
+    # averages on a rounding tie (e.g. 450.15) are a few ulps apart and may round either way
+    step = pytest.approx(0, abs=0.1 + 1e-9)
+    assert buffer.last() - baseline.last() == step
+    assert buffer.previous() - baseline.previous() == step
+    assert buffer.wavg() - baseline.wavg() == step
+    assert buffer.qwavg() - baseline.qwavg() == step
+    n = len(baseline.aggregated_values)
+    assert buffer.avg() - (round(math.fsum(baseline.aggregated_values) / n, 1) if n else 0) == step
+
+
+def buffers(minutes: int):
+    clock = ScriptedClock()
+    return (
+        clock,
+        TimewindowBuffer(minutes=minutes, capacity=4, clock=clock.monotonic),
+        BaselineBuffer(minutes, clock.now),
+    )
+
+
+@pytest.mark.parametrize("minutes", [1, 2])
+def test_add(minutes):
+    clock, buffer, baseline = buffers(minutes)
+    for t, value in script():
+        clock.t = t
+        buffer.add(value)
+        baseline.add(value)
+        assertSame(buffer, baseline)
+
+
+@pytest.mark.parametrize("minutes", [1, 2])
+def test_populate(minutes):
+    clock, buffer, baseline = buffers(minutes)
+    for step, (t, value) in enumerate(script()):
+        clock.t = t
+        if step in (20, 45, 100):
+            # e.g. the smartmeter after a rapid change
+            buffer.populate(30, value)
+            baseline.populate(30, value)
+        buffer.add(value)
+        baseline.add(value)
+        assertSame(buffer, baseline)
+
+
+def test_clear():
+    clock, buffer, baseline = buffers(1)
+    for step, (t, value) in enumerate(script()):
+        clock.t = t
+        buffer.add(value)
+        baseline.add(value)
+        if step % 9 == 0:
+            buffer.clear()
+            baseline.clear()
+        assertSame(buffer, baseline)
+
+
+@pytest.mark.parametrize("downtime", [0, 15, 45])
+def test_restore(downtime):
+    samples = script()
+    clock, buffer, baseline = buffers(1)
+    for t, value in samples[:35]:
+        clock.t = t
+        buffer.add(value)
+        baseline.add(value)
+    state = buffer.checkpoint()
+
+    # restarted downtime seconds later, the baseline kept running without new samples
+    clock.t += downtime
+    restored = TimewindowBuffer(minutes=1, clock=clock.monotonic)
+    restored.restore(state, downtime)
+    for t, value in samples[35:]:
+        clock.t = t + downtime
+        restored.add(value)
+        baseline.add(value)
+        assertSame(restored, baseline)
+
+
+def test_restore_other_filter():
+    buffer = TimewindowBuffer(minutes=1)
+    buffer.restore({"filter": "ema", "current": 100.0}, 0)
+    assert buffer.len() == 0